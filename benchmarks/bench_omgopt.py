@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+"""
+Per-evaluation time of the omgopt metrics, on random gains:
+- the per grid point loops (as before the vectorization) against
+  whole-array operations,
+- the objectives with the gain products done by each metric against a
+  FieldCache shared by the metrics, with the flops of the gain products,
+- the optimizations of the workspace with finite difference gradients
+  against the analytic gradients,
+- the objectives from the fields against the precomputed quadratic
+  forms, and BFGS against the generalized eigenproblem,
+- the startup of a workspace from the text .gain files against the
+  memory-mapped .gains.npy store written by ConvertGains,
+- the optimizations with a callback evaluating the objective again
+  against the trace of the evaluations of the optimizer.
+
+Usage: python benchmarks/bench_omgopt.py [n1 n2 ...]
+where the n are the number of grid points per dimension.
+"""
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+from openmeeg_viz import omgopt
+
+
+def _loop_PhiN(inj, geom, grid, gains):
+    dv = numpy.prod(omgopt.GetGridDxDyDz(grid))
+    cur = omgopt.GetPotentialAndCurrent(inj, geom, grid, gains)[1]
+    return dv * numpy.sum([numpy.dot(cur[x], cur[x])
+                           for x in range(len(grid))])
+
+
+def _loop_PhiC(inj, geom, grid, gains):
+    dv = numpy.prod(omgopt.GetGridDxDyDz(grid))
+    cur = omgopt.GetPotentialAndCurrent(inj, geom, grid, gains)[1]
+    return dv * numpy.sum([omgopt.IsInsideCore(grid[x], geom) *
+                           numpy.dot(cur[x], cur[x])
+                           for x in range(len(grid))])
+
+
+def _loop_Chi(inj, geom, grid, gains):
+    x0, sigma = geom[2, 0:3], geom[2, 6]
+    dv = numpy.prod(omgopt.GetGridDxDyDz(grid))
+    cur = omgopt.GetPotentialAndCurrent(inj, geom, grid, gains)[1]
+    return dv * numpy.sum([omgopt.W(grid[i], x0, sigma) *
+                           numpy.dot(cur[i], cur[i])
+                           for i in range(len(grid))])
+
+
+def _loop_Ksi(inj, geom, grid, gains):
+    x0, sigma = geom[2, 0:3], geom[2, 6]
+    dv = numpy.prod(omgopt.GetGridDxDyDz(grid))
+    activ = omgopt.GetActivationFunction(inj, geom, grid, gains)
+    return dv * numpy.sum([omgopt.W(grid[i], x0, sigma) * (activ[i] ** 2)
+                           for i in range(len(grid))])
+
+
+def _loop_Omega(inj, geom, grid, gains):
+    x0, sigma, J0 = geom[2, 0:3], geom[2, 6], geom[2, 3:6]
+    dv = numpy.prod(omgopt.GetGridDxDyDz(grid))
+    cur = omgopt.GetPotentialAndCurrent(inj, geom, grid, gains)[1]
+    return dv * numpy.sum([omgopt.W(grid[i], x0, sigma) *
+                           (numpy.dot(cur[i], J0) ** 2)
+                           for i in range(len(grid))])
+
+
+LOOPS = (('PhiN', _loop_PhiN, omgopt.PhiN),
+         ('PhiC', _loop_PhiC, omgopt.PhiC),
+         ('Chi', _loop_Chi, omgopt.Chi),
+         ('Ksi', _loop_Ksi, omgopt.Ksi),
+         ('Omega', _loop_Omega, omgopt.Omega))
+
+
+OBJECTIVES = (('f_Phi', omgopt.f_Phi), ('f_Chi', omgopt.f_Chi),
+              ('f_Omega', omgopt.f_Omega), ('f_Ksi', omgopt.f_Ksi))
+
+
+def _unshared_flops(name, n_points, n_electrodes):
+    """Flops of the gain products when each metric does its own"""
+    product = 2 * n_points * n_electrodes
+    if name == 'f_Ksi':
+        # 4 products for PhiN, 3 matrix sums and 1 product for Ksi
+        return 4 * product + 3 * n_points * n_electrodes + product
+    # 4 products for PhiN and 4 for PhiC/Chi/Omega
+    return 8 * product
+
+
+def random_problem(n, n_electrodes=12, seed=0):
+    """A n**3 grid over the nerve with random gains"""
+    rng = numpy.random.RandomState(seed)
+    grid = omgopt.GenerateCubicGrid(-1., 1., n, -1., 1., n, -12., 12., n)
+    geom = numpy.array([[0., 0., 0., 5., .3, 0., 0.],
+                        [0., 0., 0., 12., .95, 0., 0.],
+                        [0., 0., 0., 0., 0., 1., .3]])
+    gains = rng.randn(5, len(grid), n_electrodes)
+    inj = omgopt.InjFromCinj(rng.randn(n_electrodes - 1), n_electrodes)
+    return inj, geom, grid, gains
+
+
+def _time(func, args, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        value = func(*args)
+        times.append(time.time() - t0)
+    return value, min(times)
+
+
+def run(sizes=(10, 20, 40), repeat=3):
+    print("%6s %8s %6s %12s %12s %8s %s"
+          % ('n', 'points', 'metric', 'loop (s)', 'array (s)', 'speedup',
+             'rel. diff'))
+    for n in sizes:
+        args = random_problem(n)
+        for name, loop, array in LOOPS:
+            old, t_old = _time(loop, args, 1)
+            new, t_new = _time(array, args, repeat)
+            print("%6d %8d %6s %12.5f %12.5f %8.1f %9.1e"
+                  % (n, n ** 3, name, t_old, t_new, t_old / t_new,
+                     abs(new - old) / abs(old)))
+
+
+def run_cache(sizes=(10, 20, 40), repeat=3):
+    print("%6s %8s %8s %12s %12s %8s %10s %10s"
+          % ('n', 'points', 'func', 'gains (s)', 'cache (s)', 'speedup',
+             'MFlop old', 'MFlop new'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        cache = omgopt.FieldCache(grid, gains)
+        for name, func in OBJECTIVES:
+            _, t_old = _time(func, (inj, geom, grid, gains), repeat)
+            times = []
+            for _ in range(repeat):
+                # a new injection each time, as in the optimization
+                inj = inj + 1e-9
+                products = cache.products
+                _, t_new = _time(func, (inj, geom, grid, cache), 1)
+                times.append(t_new)
+                assert cache.products == products + 1
+            flops = _unshared_flops(name, len(grid), len(inj))
+            print("%6d %8d %8s %12.5f %12.5f %8.1f %10.1f %10.1f"
+                  % (n, n ** 3, name, t_old, min(times), t_old / min(times),
+                     flops / 1e6, cache.FlopsPerProduct() / 1e6))
+
+
+def run_optimize(sizes=(10, 20), optimizers=('OptimizePhi', 'OptimizeChi')):
+    print("%6s %8s %12s %10s %12s %10s %10s"
+          % ('n', 'points', 'optimizer', 'gradient', 'time (s)', 'products',
+             'objective'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        for optimizer in optimizers:
+            for use_gradient in (False, True):
+                ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+                ws.Verbose = False
+                ws.UseGradient = use_gradient
+                ws.UseQuadraticForms = False
+                numpy.random.seed(0)
+                t0 = time.time()
+                getattr(ws, optimizer)()
+                elapsed = time.time() - t0
+                print("%6d %8d %12s %10s %12.3f %10d %10.5g"
+                      % (n, n ** 3, optimizer,
+                         'analytic' if use_gradient else 'numerical',
+                         elapsed, ws.fields.products,
+                         ws.CurrentFunc(ws.inj[:-1])))
+
+
+def run_quadratic(sizes=(10, 20), names=('Phi', 'Chi')):
+    print("%6s %8s %6s %10s %12s %12s %12s %12s %10s"
+          % ('n', 'points', 'func', 'build (s)', 'fields (s)', 'Q (s)',
+             'BFGS (s)', 'eigh (s)', 'rel. diff'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        for name in names:
+            forms = omgopt.QuadraticForms(grid, gains)
+            _, t_build = _time(forms.Solve, (name, geom), 1)
+            func = getattr(omgopt, 'f_' + name)
+            cache = omgopt.FieldCache(grid, gains)
+            # a new injection each time, as in the optimization
+            injs = [inj * (1 + 1e-9 * k) for k in range(5)]
+            _, t_fields = _time(lambda: [func(x, geom, grid, cache)
+                                         for x in injs], (), 3)
+            _, t_q = _time(lambda: [forms.Objective(name, x, geom)
+                                    for x in injs], (), 3)
+            ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+            ws.Verbose = False
+            ws.UseQuadraticForms = False
+            numpy.random.seed(0)
+            _, t_bfgs = _time(getattr(ws, 'Optimize' + name), (), 1)
+            bfgs = getattr(ws, 'f_' + name)(ws.inj)
+            (value, _), t_eigh = _time(forms.Solve, (name, geom), 1)
+            print("%6d %8d %6s %10.4f %12.6f %12.6f %12.4f %12.6f %10.2g"
+                  % (n, n ** 3, name, t_build, t_fields / len(injs),
+                     t_q / len(injs), t_bfgs, t_eigh,
+                     abs(bfgs - value) / value))
+
+
+def run_load(sizes=(10, 20)):
+    print("%6s %8s %12s %12s %12s %12s"
+          % ('n', 'points', 'text (MB)', 'text (s)', 'convert (s)',
+             'npy (s)'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        tempdir = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(tempdir, 'nerve')
+            for gain, suffix in zip(gains, omgopt.GainSuffixes):
+                numpy.savetxt(prefix + suffix + '.gain', gain)
+            size = sum(os.path.getsize(prefix + suffix + '.gain')
+                       for suffix in omgopt.GainSuffixes)
+            _, t_text = _time(omgopt.workspace, (None, prefix, grid), 1)
+            _, t_convert = _time(omgopt.ConvertGains, (geom, grid, prefix), 1)
+            _, t_npy = _time(omgopt.workspace, (None, prefix, grid), 1)
+            print("%6d %8d %12.1f %12.3f %12.3f %12.3f"
+                  % (n, n ** 3, size / 1e6, t_text, t_convert, t_npy))
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def run_vtk(sizes=(10, 20, 40)):
+    print("%6s %8s %12s %12s %12s %12s"
+          % ('n', 'points', 'ascii (MB)', 'ascii (s)', 'binary (MB)',
+             'binary (s)'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        tempdir = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(tempdir, 'nerve')
+            results = []
+            for binary in (False, True):
+                omgopt.BinaryVTK = binary
+                _, t = _time(omgopt.SaveFieldsVTK,
+                             (inj, geom, grid, gains, prefix), 1)
+                size = sum(os.path.getsize(os.path.join(tempdir, fname))
+                           for fname in os.listdir(tempdir))
+                results += [size / 1e6, t]
+                for fname in os.listdir(tempdir):
+                    os.remove(os.path.join(tempdir, fname))
+            print("%6d %8d %12.1f %12.3f %12.1f %12.3f"
+                  % ((n, n ** 3) + tuple(results)))
+        finally:
+            omgopt.BinaryVTK = True
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def run_multistart(sizes=(10, 20), starts=16, processes=(1, 2, 4),
+                   optimizer='OptimizeOmegaGeom'):
+    print("%6s %8s %10s %12s %12s %8s"
+          % ('n', 'points', 'processes', 'wall (s)', 'starts (s)', 'optima'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+        for p in processes:
+            results = ws.MultiStart(optimizer, starts, processes=p)
+            print("%6d %8d %10d %12.3f %12.3f %8d"
+                  % (n, n ** 3, p, results.WallTime,
+                     sum(s['Time'] for s in results.Starts),
+                     len(results.Optima)))
+
+
+def _single_metrics(injs, geom, grid, gains):
+    return [[getattr(omgopt, name)(inj, geom, grid, gains)
+             for name in ('f_Phi', 'f_Chi', 'f_Omega', 'f_Ksi')]
+            for inj in injs.T]
+
+
+def run_batch(sizes=(10, 20, 40), n_patterns=1000, n_single=50):
+    print("%6s %8s %14s %14s %14s" % ('n', 'points', 'single (p/s)',
+                                      'batch (p/s)', 'Q forms (p/s)'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        rng = numpy.random.RandomState(0)
+        injs = rng.randn(gains.shape[-1], n_patterns)
+        injs[-1] = -injs[:-1].sum(axis=0)
+        cache = omgopt.FieldCache(grid, gains)
+        _, t_single = _time(_single_metrics,
+                            (injs[:, :n_single], geom, grid, cache), 1)
+        _, t_batch = _time(omgopt.BatchMetrics, (injs, geom, grid, cache), 1)
+        forms = omgopt.QuadraticForms(grid, gains)
+        _, t_quad = _time(forms.BatchMetrics, (injs, geom), 1)
+        print("%6d %8d %14.0f %14.0f %14.0f"
+              % (n, n ** 3, n_single / t_single, n_patterns / t_batch,
+                 n_patterns / t_quad))
+
+
+def smooth_problem(n, n_electrodes=12, seed=0):
+    """A n x n x 2n grid with smooth gains, known on the shifted grids"""
+    rng = numpy.random.RandomState(seed)
+    grid = omgopt.GenerateCubicGrid(-1., 1., n, -1., 1., n, -12., 12., 2 * n)
+    k = rng.randn(n_electrodes, 3) * [1., 1., .15]
+    shifted = [grid, omgopt.CreateDGrid(grid, 0), omgopt.CreateDGrid(grid, 1),
+               omgopt.CreateDGrid(grid, 2), omgopt.CreateNegDGrid(grid, 2)]
+    gains = numpy.array([numpy.sin(numpy.dot(g, k.T)) for g in shifted])
+    geom = numpy.array([[0., 0., 0., 5., .3, 0., 0.],
+                        [0., 0., 0., 12., .95, 0., 0.],
+                        [.1, -.2, 1., .6, 0., .8, .3]])
+    inj = omgopt.InjFromCinj(rng.randn(n_electrodes - 1), n_electrodes)
+    return inj, geom, grid, gains
+
+
+def run_stencil(sizes=(10, 20, 40), repeat=20):
+    print("%6s %8s %12s %12s %12s %12s %10s %10s"
+          % ('n', 'points', 'gains (MB)', 'base (MB)', 'five (ms)',
+             'stencil (ms)', 'cur err', 'f_Chi err'))
+    for n in sizes:
+        inj, geom, grid, gains = smooth_problem(n)
+        five = omgopt.workspace(None, None, grid=grid, gains=gains)
+        one = omgopt.workspace(None, None, grid=grid, gains=gains,
+                               stencil=True)
+        _, t_five = _time(omgopt.StackedProduct, (five.gains, inj), repeat)
+        _, t_one = _time(omgopt.StackedProduct, (one.gains, inj), repeat)
+        errors = omgopt.StencilErrors(inj, geom, grid, gains)
+        print("%6d %8d %12.1f %12.1f %12.3f %12.3f %10.2e %10.2e"
+              % (n, len(grid), five.gains.nbytes / 1e6,
+                 one.gains.Base.nbytes / 1e6, 1e3 * t_five, 1e3 * t_one,
+                 errors['Current'], errors['f_Chi']))
+
+
+def _evaluate(func, injs, geom, grid, gains):
+    return [func(inj, geom, grid, gains) for inj in injs.T]
+
+
+def run_grid(sizes=(10, 20, 40), n_evaluations=20):
+    print("%6s %8s %8s %12s %12s" % ('n', 'points', 'metric', 'array (s)',
+                                     'Grid (s)'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        injs = numpy.random.RandomState(0).randn(gains.shape[-1],
+                                                 n_evaluations)
+        for name in ('f_Chi', 'f_Ksi'):
+            func = getattr(omgopt, name)
+            times = []
+            for points in (grid, omgopt.Grid(grid)):
+                cache = omgopt.FieldCache(points, gains)
+                _, t = _time(_evaluate, (func, injs, geom, points, cache), 1)
+                times.append(t)
+            print("%6d %8d %8s %12.3f %12.3f"
+                  % ((n, n ** 3, name) + tuple(times)))
+
+
+def _in_memory_grid_files(args, dir, name):
+    """SaveGridFiles with the full grids in memory, as before streaming"""
+    nx, ny, nz = args[2], args[5], args[8]
+    grid = numpy.resize(omgopt.GenerateMGrid(*args), (nx * ny * nz, 3))
+    numpy.savetxt(os.path.join(dir, name), grid)
+    for suffix, shifted in (('dx', omgopt.CreateDGrid(grid, 0)),
+                            ('dy', omgopt.CreateDGrid(grid, 1)),
+                            ('dz', omgopt.CreateDGrid(grid, 2)),
+                            ('-dz', omgopt.CreateNegDGrid(grid, 2))):
+        numpy.savetxt(os.path.join(dir, name + suffix), shifted)
+    omgopt.SaveGridVTK(grid, nx, ny, nz, os.path.join(dir, name + '.vtk'))
+
+
+def _grid_files(mode, n, dir):
+    """Write the grid files of a n**3 grid, print the time and peak RSS"""
+    args = (-1., 1., n, -1., 1., n, -12., 12., n)
+    t0 = time.time()
+    if mode == 'memory':
+        _in_memory_grid_files(args, dir, 'grid')
+    else:
+        omgopt.SaveGridFiles(*args, dir=dir, name='grid',
+                             binary=mode == 'binary')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print("%.3f %.1f" % (time.time() - t0, rss))
+
+
+def run_grid_files(sizes=(20, 50, 100), modes=('memory', 'text', 'binary')):
+    print("%6s %10s %8s %12s %14s %10s"
+          % ('n', 'points', 'mode', 'time (s)', 'peak RSS (MB)', 'MB'))
+    for n in sizes:
+        for mode in modes:
+            tempdir = tempfile.mkdtemp()
+            try:
+                # a new process for each, for its own peak RSS
+                out = subprocess.check_output(
+                    [sys.executable, __file__, '--grid-files', mode, str(n),
+                     tempdir])
+                t, rss = [float(x) for x in out.split()[-2:]]
+                size = sum(os.path.getsize(os.path.join(tempdir, fname))
+                           for fname in os.listdir(tempdir))
+                print("%6d %10d %8s %12.3f %14.1f %10.1f"
+                      % (n, n ** 3, mode, t, rss, size / 1e6))
+            finally:
+                shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def _in_memory_fields_vtk(inj, geom, grid, gains, fileprefix):
+    """SaveFieldsVTK with the full fields and trimmed copies in memory"""
+    pot, cur = omgopt.GetPotentialAndCurrent(inj, geom, grid, gains)
+    curmagn = omgopt.GetCurrentMagnitude(cur)
+    omgopt.SaveInjVTK(inj, fileprefix + "_inj.vtk")
+    nerve = omgopt.InsideNerveMask(geom, grid)
+    focus = omgopt.NearFocusMask(geom, grid)
+    for suffix, mask, field, name in (
+            ("_cmag_nerve.vtk", nerve, curmagn, "Current_Magnitude"),
+            ("_cmag_focus.vtk", focus, curmagn, "Current_Magnitude"),
+            ("_cur_nerve.vtk", nerve, cur, "Current"),
+            ("_pot_nerve.vtk", nerve, pot, "Potential"),
+            ("_cur_focus.vtk", focus, cur, "Current_Focus")):
+        omgopt.SaveTrimmedFieldVTK(grid, omgopt.ApplyMask(mask, field),
+                                   fileprefix + suffix, name, 1e-7)
+
+
+def _current_rss():
+    with open('/proc/self/statm') as fid:
+        return int(fid.read().split()[1]) * resource.getpagesize() / 2. ** 20
+
+
+def _fields_vtk(mode, n, dir):
+    """Save the fields of a n**3 grid, print the time and the peak memory
+    above the memory of the grid and the gains"""
+    inj, geom, grid, gains = random_problem(n)
+    rss = _current_rss()
+    t0 = time.time()
+    if mode == 'memory':
+        _in_memory_fields_vtk(inj, geom, grid, gains, os.path.join(dir, 'f'))
+    else:
+        omgopt.SaveFieldsVTK(inj, geom, grid, gains, os.path.join(dir, 'f'))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print("%.3f %.1f" % (time.time() - t0, peak - rss))
+
+
+def run_fields_vtk(sizes=(40, 80), modes=('memory', 'stream')):
+    print("%6s %10s %8s %12s %16s" % ('n', 'points', 'mode', 'time (s)',
+                                      'peak extra (MB)'))
+    for n in sizes:
+        for mode in modes:
+            tempdir = tempfile.mkdtemp()
+            try:
+                out = subprocess.check_output(
+                    [sys.executable, __file__, '--fields-vtk', mode, str(n),
+                     tempdir])
+                t, extra = [float(x) for x in out.split()[-2:]]
+                print("%6d %10d %8s %12.3f %16.1f"
+                      % (n, n ** 3, mode, t, extra))
+            finally:
+                shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def run_trace(sizes=(10, 20), optimizers=('OptimizeChi', 'OptimizeKsi')):
+    """The optimizations with the former callback, which evaluated the
+    objective again at each iterate, against the trace of the evaluations
+    of fmin_bfgs, with its time split"""
+    print("%6s %8s %12s %10s %6s %10s %10s %10s %10s %10s %10s"
+          % ('n', 'points', 'optimizer', 'callback', 'iter', 'n products',
+             'time (s)', 'products', 'masks', 'weights', 'other'))
+    for n in sizes:
+        inj, geom, grid, gains = random_problem(n)
+        for optimizer in optimizers:
+            for mode in ('evaluate', 'trace'):
+                ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+                ws.Verbose = False
+                ws.UseQuadraticForms = False
+                if mode == 'evaluate':
+                    minimize = ws.Minimize
+
+                    def evaluate(x):
+                        ws.CurrentFunc(x)
+
+                    def legacy(f, x0, fprime, **kwargs):
+                        ws.CurrentFunc = f
+                        return omgopt.scipy.optimize.fmin_bfgs(
+                            f, x0, fprime=fprime, callback=evaluate,
+                            gtol=ws.GTol, disp=False, **kwargs)
+                    ws.Minimize = legacy
+                numpy.random.seed(0)
+                t0 = time.time()
+                getattr(ws, optimizer)()
+                elapsed = time.time() - t0
+                if mode == 'evaluate':
+                    ws.Minimize = minimize
+                    print("%6d %8d %12s %10s %6s %10d %10.3f"
+                          % (n, n ** 3, optimizer, mode, '',
+                             ws.fields.products, elapsed))
+                    continue
+                trace = ws.LastTrace
+                print("%6d %8d %12s %10s %6d %10d %10.3f %10.3f %10.3f "
+                      "%10.3f %10.3f"
+                      % ((n, n ** 3, optimizer, mode, len(trace),
+                          ws.fields.products, elapsed) +
+                         tuple(trace.Column(c).sum() for c in
+                               ('Products', 'Masks', 'Weights', 'Other'))))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--fields-vtk']:
+        _fields_vtk(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+        sys.exit()
+    if sys.argv[1:2] == ['--grid-files']:
+        _grid_files(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+        sys.exit()
+    sizes = [int(arg) for arg in sys.argv[1:]] or (10, 20, 40)
+    run(sizes)
+    run_cache(sizes)
+    run_optimize(sizes)
+    run_quadratic(sizes)
+    run_load(sizes)
+    run_vtk(sizes)
+    run_multistart(sizes)
+    run_batch(sizes)
+    run_stencil(sizes)
+    run_grid(sizes)
+    run_grid_files()
+    run_fields_vtk()
+    run_trace(sizes)
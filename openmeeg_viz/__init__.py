@@ -21,3 +21,4 @@ __version__ = '0.1.dev0'
 
 from .om_display import display_vtp
 from .om_display import display_vtk
+from .om_snapshot import render_snapshots
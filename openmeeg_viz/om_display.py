@@ -15,33 +15,347 @@ under the supervision of Boris Burle
 """
 
 # works only for vtk >= 6
+import os
+from collections import OrderedDict
+
+import numpy as np
 import vtk
+from vtk.util import numpy_support
 
-# TODO: it only works for nested geometry: find a better alternative than
-# connectivity filter
+from .om_picker import ID_TYPE, get_picker, poly_triangles
+from .om_sources import LazySources
 
 # Common functions ##########################
-def update_color_bar(colorbar, mapper):
-    if mapper.GetScalarMode() == 1:
-        srange = mapper.GetInput().GetPointData().GetScalars().GetRange()
-    else:
-        srange = mapper.GetInput().GetCellData().GetScalars().GetRange()
-    tc = vtk.vtkColorTransferFunction()
-    tc.SetColorSpaceToDiverging()
+def update_color_bar(colorbar, mapper, srange=None):
+    # srange: the (min, max) of the colors, scanned from the active scalars
+    # if not given. The transfer function is created once per color bar.
+    if srange is None:
+        if mapper.GetScalarMode() == 1:
+            srange = mapper.GetInput().GetPointData().GetScalars().GetRange()
+        else:
+            srange = mapper.GetInput().GetCellData().GetScalars().GetRange()
+    tc = colorbar.GetLookupTable()
+    if not isinstance(tc, vtk.vtkColorTransferFunction):
+        tc = vtk.vtkColorTransferFunction()
+        tc.SetColorSpaceToDiverging()
+        mapper.SetLookupTable(tc)
+        colorbar.SetLookupTable(tc)
+        colorbar.SetNumberOfLabels(3)
+        colorbar.SetLabelFormat('%3.3e')
+    elif tuple(tc.GetRange()) == tuple(srange):
+        return
+    tc.RemoveAllPoints()
     tc.AddRGBPoint(srange[0], 0, 0, 1)
     tc.AddRGBPoint(sum(srange)/len(srange), 1, 1, 1)
     tc.AddRGBPoint(srange[1], 1, 0, 0)
-    mapper.SetLookupTable(tc)
-    colorbar.SetLookupTable(tc)
-    colorbar.SetNumberOfLabels(3)
-    colorbar.SetLabelFormat('%3.3e')
 
 
-# This callback function does plot the selected points
-def pick_data(object, event, selactor, state, view, text_init):
-    picker = object.GetPicker()
-    hsel = vtk.vtkHardwareSelector()
+def add_source_arrays(attributes, data, name):
+    """Attach the columns of data as name-0, name-1... without copying
+
+    Parameters
+    ----------
+    attributes : vtkPointData | vtkCellData
+        Where to add the arrays.
+    data : ndarray, shape (n_values, n_sources)
+        One column per source. Float64 Fortran ordered data is shared,
+        otherwise a single transposed copy is made.
+    name : str
+        The prefix of the array names (Potentials or Currents).
+
+    Returns
+    -------
+    buffer : ndarray, shape (n_sources, n_values)
+        The memory shared with the VTK arrays. Each VTK array also holds a
+        reference to its row, so it stays valid as long as the arrays live.
+    """
+    buffer = np.ascontiguousarray(np.asarray(data, dtype=np.float64).T)
+    for j in range(buffer.shape[0]):
+        array = numpy_support.numpy_to_vtk(buffer[j], deep=0)
+        array.SetName(name + '-' + str(j))
+        attributes.AddArray(array)
+    return buffer
+
+
+def add_indices_array(attributes, n_values):
+    """Attach the 'Indices' array 0, 1, ..., n_values - 1"""
+    array = numpy_support.numpy_to_vtk(np.arange(n_values, dtype=np.uint32),
+                                       deep=1,
+                                       array_type=vtk.VTK_UNSIGNED_INT)
+    array.SetName('Indices')
+    attributes.AddArray(array)
+
+
+def source_ranges(attributes, name, nb_sources, parts=(slice(None),)):
+    """min and max of each source array name-j over parts of it
+
+    Parameters
+    ----------
+    attributes : vtkPointData | vtkCellData
+        Where the arrays are.
+    name : str
+        The prefix of the array names (Potentials or Currents).
+    nb_sources : int
+        The number of arrays.
+    parts : list of slice | ndarray
+        The values (points or cells) over which each range is computed.
+
+    Returns
+    -------
+    ranges : ndarray, shape (nb_sources, len(parts), 2)
+    """
+    ranges = np.zeros((nb_sources, len(parts), 2))
+    for j in range(nb_sources):
+        array = attributes.GetArray(name + '-' + str(j))
+        if array is None:
+            continue
+        values = numpy_support.vtk_to_numpy(array)
+        for k, part in enumerate(parts):
+            if len(values[part]):
+                ranges[j, k] = values[part].min(), values[part].max()
+    return ranges
+
+
+def covering_range(ranges):
+    """The range covering all sources from ranges, shape (nb_sources, 2)"""
+    if not len(ranges):
+        return (0., 1.)
+    return (ranges[:, 0].min(), ranges[:, 1].max())
+
+
+def triangles_to_cell_array(triangles):
+    """A vtkCellArray of triangles from an array of shape (n_cells, 3)"""
+    polys = vtk.vtkCellArray()
+    if not hasattr(polys, 'GetOffsetsArray'):  # vtk < 9, legacy layout
+        cells = np.empty((len(triangles), 4), dtype=ID_TYPE)
+        cells[:, 0] = 3
+        cells[:, 1:] = triangles
+        polys.SetCells(len(triangles), numpy_support.numpy_to_vtkIdTypeArray(
+            cells.ravel(), deep=1))
+        return polys
+    offsets = np.arange(0, 3 * len(triangles) + 1, 3, dtype=ID_TYPE)
+    connectivity = np.ascontiguousarray(triangles, dtype=ID_TYPE).ravel()
+    polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=1),
+                  numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=1))
+    return polys
+
+
+class PolyMetadata(object):
+    """Index of the sources and meshes of a polydata written by OpenMEEG
+
+    Attributes
+    ----------
+    nb_sources : int
+        The number of Potentials-j arrays.
+    mesh_names : list of str
+        The mesh names, in the order of their first cell.
+    first_cells : ndarray, shape (n_meshes,)
+        The first cell of each mesh.
+    mesh_index : ndarray, shape (n_cells,)
+        The index of the mesh of each cell in mesh_names.
+    cell_ids : list of ndarray
+        The cells of each mesh.
+    cell_ranges : ndarray, shape (n_meshes, 2)
+        The first and last + 1 cell of each mesh.
+    point_ranges : ndarray, shape (n_meshes, 2)
+        The first and last + 1 point used by the cells of each mesh.
+    potential_ranges : ndarray, shape (nb_sources, 2)
+        The min and max of each Potentials-j array.
+    current_ranges : ndarray, shape (nb_sources, 2)
+        The min and max of each Currents-j array.
+    mesh_potential_ranges : ndarray, shape (nb_sources, n_meshes, 2)
+        The min and max of each Potentials-j array over each mesh.
+    mesh_current_ranges : ndarray, shape (nb_sources, n_meshes, 2)
+        The min and max of each Currents-j array over each mesh.
+    """
+    def __init__(self, poly):
+        point_data = poly.GetPointData()
+        # count the sources from the array names only
+        names = set(point_data.GetArrayName(i)
+                    for i in range(point_data.GetNumberOfArrays()))
+        nb_sources = 0
+        while 'Potentials-' + str(nb_sources) in names:
+            nb_sources += 1
+        self.nb_sources = nb_sources
+
+        # Get the mesh names: the labels are turned into integer categories
+        # (in C++), from which the first cell of each mesh is found at once
+        labels = vtk.vtkStringToCategory()
+        labels.SetInputData(poly)
+        labels.SetInputArrayToProcess(
+            0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS, 'Names')
+        labels.Update()
+        category = numpy_support.vtk_to_numpy(
+            labels.GetOutput().GetCellData().GetArray('category'))
+        strings = labels.GetOutput(1).GetRowData().GetAbstractArray('Strings')
+        categories, first_cells = np.unique(category, return_index=True)
+        order = np.argsort(first_cells)
+        self.first_cells = first_cells[order]
+        self.mesh_names = [strings.GetValue(int(c)) for c in categories[order]]
+        # index of the mesh of each cell, in the order of mesh_names
+        lookup = np.empty(categories.max() + 1 if len(categories) else 0,
+                          dtype=int)
+        lookup[categories[order]] = np.arange(len(order))
+        self.mesh_index = lookup[category]
+        sorted_cells = np.argsort(self.mesh_index, kind='mergesort')
+        bounds = np.cumsum(np.bincount(self.mesh_index,
+                                       minlength=len(order)))[:-1]
+        self.cell_ids = np.split(sorted_cells, bounds)
+        self.cell_ranges = np.array([(c[0], c[-1] + 1) for c in self.cell_ids],
+                                    dtype=int).reshape(-1, 2)
+        starts = np.concatenate(([0], bounds)).astype(int)
+        triangles = poly_triangles(poly)[sorted_cells]
+        self.point_ranges = np.empty((len(order), 2), dtype=int)
+        if len(order):
+            self.point_ranges[:, 0] = np.minimum.reduceat(
+                triangles.min(axis=1), starts)
+            self.point_ranges[:, 1] = np.maximum.reduceat(
+                triangles.max(axis=1), starts) + 1
+
+        # the color ranges of all sources, over the whole file and each mesh
+        point_parts = [slice(None)] + [slice(*r) for r in self.point_ranges]
+        cell_parts = [slice(None)]
+        for cells, (start, stop) in zip(self.cell_ids, self.cell_ranges):
+            cell_parts.append(slice(start, stop)
+                              if stop - start == len(cells) else cells)
+        ranges = source_ranges(point_data, 'Potentials', nb_sources,
+                               point_parts)
+        self.potential_ranges = ranges[:, 0]
+        self.mesh_potential_ranges = ranges[:, 1:]
+        ranges = source_ranges(poly.GetCellData(), 'Currents', nb_sources,
+                               cell_parts)
+        self.current_ranges = ranges[:, 0]
+        self.mesh_current_ranges = ranges[:, 1:]
+
+    @property
+    def nb_meshes(self):
+        return len(self.mesh_names)
+
+
+def share_mesh_attributes(poly, metadata, i, mesh):
+    """Attach to mesh the arrays of poly restricted to the mesh i
+
+    The point arrays are shared. The numeric cell arrays are sliced without
+    copy when the cells of the mesh are contiguous.
+    """
+    mesh.GetPointData().ShallowCopy(poly.GetPointData())
+    cells = metadata.cell_ids[i]
+    start, stop = metadata.cell_ranges[i]
+    src = poly.GetCellData()
+    cell_data = mesh.GetCellData()
+    cell_data.Initialize()
+    for k in range(src.GetNumberOfArrays()):
+        array = src.GetArray(k)
+        if array is None:  # the mesh names
+            continue
+        values = numpy_support.vtk_to_numpy(array)
+        if stop - start == len(cells):
+            values = values[start:stop]
+        else:
+            values = values[cells]
+        sub_array = numpy_support.numpy_to_vtk(
+            np.ascontiguousarray(values), deep=0,
+            array_type=array.GetDataType())
+        sub_array.SetName(array.GetName())
+        cell_data.AddArray(sub_array)
+    if src.GetScalars() is not None:
+        cell_data.SetActiveScalars(src.GetScalars().GetName())
+    mesh.Modified()
+
+
+def extract_mesh(poly, metadata, i):
+    """The mesh i of poly, found by its label, sharing the points of poly"""
+    mesh = vtk.vtkPolyData()
+    mesh.SetPoints(poly.GetPoints())
+    mesh.SetPolys(triangles_to_cell_array(
+        poly_triangles(poly)[metadata.cell_ids[i]]))
+    share_mesh_attributes(poly, metadata, i, mesh)
+    return mesh
+
+
+def read_vtk_polydata(fname):
+    """Read a VTK file as a polydata
+
+    Legacy .vtk files of any dataset type, .vtp, .vtu and .vts files are
+    read. The datasets which are not polydata are converted with
+    vtkGeometryFilter: the vertices of a point set are kept, a structured
+    grid gives its outer surface.
+    """
+    if fname.endswith('.vtp'):
+        reader = vtk.vtkXMLPolyDataReader()
+    elif fname.endswith('.vtu'):
+        reader = vtk.vtkXMLUnstructuredGridReader()
+    elif fname.endswith('.vts'):
+        reader = vtk.vtkXMLStructuredGridReader()
+    else:
+        reader = vtk.vtkDataSetReader()
+        reader.ReadAllScalarsOn()
+        reader.ReadAllVectorsOn()
+    reader.SetFileName(fname)
+    reader.Update()
+    data = reader.GetOutput()
+    if isinstance(data, vtk.vtkPolyData):
+        return data
+    geometry = vtk.vtkGeometryFilter()
+    geometry.SetInputData(data)
+    geometry.Update()
+    return geometry.GetOutput()
+
+
+def scalar_arrays_as_sources(attributes):
+    """Name the scalar arrays Potentials-0, Potentials-1... in place
+
+    The original name of each array is kept in a copy sharing its values.
+    Returns the number of sources.
+    """
+    arrays = [attributes.GetArray(i)
+              for i in range(attributes.GetNumberOfArrays())]
+    arrays = [array for array in arrays if array is not None and
+              array.GetNumberOfComponents() == 1 and
+              array.GetName() != 'Indices']
+    for j, array in enumerate(arrays):
+        source = array.NewInstance()
+        source.ShallowCopy(array)
+        source.SetName('Potentials-' + str(j))
+        attributes.AddArray(source)
+    return len(arrays)
+
+
+def tile_viewports(nb_views):
+    """(xmin, ymin, xmax, ymax) of nb_views viewports tiling the window"""
+    nb_cols = int(np.ceil(np.sqrt(nb_views)))
+    nb_rows = int(np.ceil(nb_views / float(nb_cols)))
+    return [((i % nb_cols) / float(nb_cols), (i // nb_cols) / float(nb_rows),
+             (i % nb_cols + 1) / float(nb_cols),
+             (i // nb_cols + 1) / float(nb_rows)) for i in range(nb_views)]
+
+
+# metadata of the last files opened, by (path, size, modification time).
+# Bounded, so that the entries of files rewritten during a session are
+# released.
+MAX_METADATA = 8
+_metadata_cache = OrderedDict()
+
+
+def get_metadata(poly, fname=None):
+    """The PolyMetadata of poly, cached by file if read from fname"""
+    if fname is None:
+        return PolyMetadata(poly)
+    st = os.stat(fname)
+    key = (os.path.abspath(fname), st.st_size, st.st_mtime)
+    metadata = _metadata_cache.pop(key, None)
+    if metadata is None:
+        metadata = PolyMetadata(poly)
+    _metadata_cache[key] = metadata
+    while len(_metadata_cache) > MAX_METADATA:
+        _metadata_cache.popitem(last=False)
+    return metadata
+
+
+def _hardware_selection(picker, state):
+    """The selection of vtkHardwareSelector, which needs a render pass"""
     ren = picker.GetRenderer()
+    hsel = vtk.vtkHardwareSelector()
     hsel.SetRenderer(ren)
     hsel.SetArea(int(ren.GetPickX1()), int(ren.GetPickY1()),
                  int(ren.GetPickX2()), int(ren.GetPickY2()))
@@ -50,78 +364,160 @@ def pick_data(object, event, selactor, state, view, text_init):
     else:
         hsel.SetFieldAssociation(vtk.vtkDataObject.FIELD_ASSOCIATION_POINTS)
     sel = hsel.Select()
+    if sel.GetNumberOfNodes() == 0:
+        return None
     ex = vtk.vtkExtractSelection()
-    if picker.GetMapper():
-        if (not sel.GetNumberOfNodes() == 0):
-            ex.SetInputConnection(picker.GetMapper().GetInputConnection(0, 0))
-            ex.SetInputData(1,sel)
-            ex.Update()
-            selmapper = vtk.vtkDataSetMapper()
-            data = ex.GetOutput()
-            selmapper.SetInputData(data)
-            selmapper.ScalarVisibilityOff()
-            selactor.SetMapper(selmapper)
-            selactor.PickableOff()
-            selactor.GetProperty().SetColor(0.0, 1.0, 0.0)
-            selactor.GetProperty().SetOpacity(0.5)
-            selactor.GetProperty().SetPointSize(6)
-            ren.AddActor(selactor)
-            plot_selected_data(data, state, view, text_init)
-
-
-def plot_selected_data(data, state, view, text_init):
-    nb_sources = 0
-    for i in range(data.GetPointData().GetNumberOfArrays()):
-        if data.GetPointData().GetGlobalIds('Potentials-'+str(i)):
-            nb_sources += 1
-    view.GetRenderer().RemoveActor2D(text_init)
+    ex.SetInputConnection(picker.GetMapper().GetInputConnection(0, 0))
+    ex.SetInputData(1, sel)
+    ex.Update()
+    return ex.GetOutput()
+
+
+def _cpu_selection(picker, state, click_size=2):
+    """The points (or cells) in the picked frustum, from a spatial index
+
+    A pick smaller than click_size pixels is a click: only the point (or
+    cell) the nearest to the camera is kept.
+    """
+    ren = picker.GetRenderer()
+    mesh_picker = get_picker(picker.GetMapper().GetInput())
+    ids = mesh_picker.frustum(picker.GetFrustum(), cells=bool(state))
+    if not len(ids):
+        return None
+    if abs(ren.GetPickX2() - ren.GetPickX1()) < click_size and \
+            abs(ren.GetPickY2() - ren.GetPickY1()) < click_size:
+        ids = [mesh_picker.nearest(ren.GetActiveCamera().GetPosition(), ids,
+                                   cells=bool(state))]
+    return mesh_picker.extract(ids, cells=bool(state))
+
+
+# This callback function does plot the selected points
+def pick_data(object, event, selactor, state, view, text_init,
+              sources=None, max_lines=100, hardware=False):
+    picker = object.GetPicker()
+    if not picker.GetMapper():
+        return
+    # the CPU selection also picks the points hidden behind the visible
+    # surface, vtkHardwareSelector only the visible ones
+    if hardware:
+        data = _hardware_selection(picker, state)
+    else:
+        data = _cpu_selection(picker, state)
+    if data is None:
+        return
+    ren = picker.GetRenderer()
+    selmapper = vtk.vtkDataSetMapper()
+    selmapper.SetInputData(data)
+    selmapper.ScalarVisibilityOff()
+    selactor.SetMapper(selmapper)
+    selactor.PickableOff()
+    selactor.GetProperty().SetColor(0.0, 1.0, 0.0)
+    selactor.GetProperty().SetOpacity(0.5)
+    selactor.GetProperty().SetPointSize(6)
+    ren.AddActor(selactor)
+    plot_selected_data(data, state, view, text_init, sources, max_lines)
+
+
+def selected_values(data, state, sources=None):
+    """The values of all sources at the extracted points (or cells)
+
+    Parameters
+    ----------
+    data : vtkDataSet
+        The extracted selection, with an Indices array.
+    state : int
+        1 for the currents of the cells, 0 for the potentials of the points.
+    sources : LazySources | None
+        The sources of the displayed data, if the columns are not all
+        attached to data.
+
+    Returns
+    -------
+    indices : ndarray, shape (n_selected,)
+        The Indices of the selected points (or cells).
+    values : ndarray, shape (n_selected, nb_sources)
+        One row per selected point (or cell).
+    """
+    if state:
+        attributes, name = data.GetCellData(), 'Currents'
+    else:
+        attributes, name = data.GetPointData(), 'Potentials'
+    indices = numpy_support.vtk_to_numpy(attributes.GetArray('Indices'))
+    if sources is not None:
+        return indices, sources.rows(indices)
+    columns = []
+    while attributes.GetArray(name + '-' + str(len(columns))) is not None:
+        columns.append(numpy_support.vtk_to_numpy(
+            attributes.GetArray(name + '-' + str(len(columns)))))
+    if not columns:
+        return indices, np.zeros((len(indices), 0))
+    return indices, np.column_stack(columns)
+
+
+def _add_column(table, values, name):
+    column = numpy_support.numpy_to_vtk(np.ascontiguousarray(values), deep=1)
+    column.SetName(name)
+    table.AddColumn(column)
+
+
+def plot_selected_data(data, state, view, text_init, sources=None,
+                       max_lines=100):
+    # sources: the LazySources of the displayed data, if the columns are
+    # not all attached to data
+    # max_lines: above this number of selected points, the mean and the
+    # 5-95 and 25-75 percentiles are plotted instead of one line per point
+    indices, values = selected_values(data, state, sources)
+    num_points, nb_sources = values.shape
+    view.GetRenderer().RemoveViewProp(text_init)
     chart = vtk.vtkChartXY()
     view.GetScene().RemoveItem(0)
     view.GetScene().AddItem(chart)
     chart.SetShowLegend(True)
     table = vtk.vtkTable()
-    X = vtk.vtkDoubleArray()
-    X.SetName("X")
     if state:
-        num_points = data.GetNumberOfCells()
         chart.GetAxis(0).SetTitle('Current')
     else:
-        num_points = data.GetNumberOfPoints()
         chart.GetAxis(0).SetTitle('Potential')
     chart.GetAxis(0).SetRange(0, nb_sources)
-    for j in range(nb_sources):
-        X.InsertNextValue(j)
-    table.AddColumn(X)
+    _add_column(table, np.arange(nb_sources, dtype=np.float64), "X")
+    if num_points > max_lines:
+        percentiles = np.percentile(values, [5, 25, 75, 95], axis=0)
+        for name, column in zip(['5%', '25%', '75%', '95%'], percentiles):
+            _add_column(table, column, name)
+        _add_column(table, values.mean(axis=0), "mean of %d" % num_points)
+        for low, high, opacity in (('5%', '95%', 0.2), ('25%', '75%', 0.4)):
+            area = chart.AddPlot(vtk.vtkChart.AREA)
+            area.SetInputData(table)
+            area.SetInputArray(0, 'X')
+            area.SetInputArray(1, low)
+            area.SetInputArray(2, high)
+            area.SetColor(0, 0, 255, int(255 * opacity))
+        line = chart.AddPlot(0)
+        line.SetInputData(table, 0, 5)
+        line.SetColor(0, 0, 0, 255)
+        line.SetWidth(2.0)
+        view.GetRenderWindow().Render()
+        return
     lut = vtk.vtkLookupTable()
     lut.SetHueRange(1, 0.0)
     lut.SetNumberOfColors(256)
     lut.Build()
     for i in range(num_points):
-        Y = vtk.vtkDoubleArray()
-        if state:
-            Y.SetName("id"+str(data.GetCellData().GetGlobalIds('Indices').GetValue(i)))
-        else:
-            Y.SetName("id"+str(data.GetPointData().GetGlobalIds('Indices').GetValue(i)))
-        for j in range(nb_sources):
-            if state:
-                Y.InsertNextValue(data.GetCellData().GetGlobalIds('Currents-'+str(j)).GetValue(i))
-            else:
-                Y.InsertNextValue(data.GetPointData().GetGlobalIds('Potentials-'+
-                                               str(j)).GetValue(i))
-        table.AddColumn(Y)
+        _add_column(table, values[i], "id"+str(indices[i]))
         # Now add the line plots
         line = chart.AddPlot(0)
         line.SetInputData(table, 0, i+1)
         rgb = [0.0, 0.0, 0.0]
         lut.GetColor(i/float(num_points), rgb)
-        line.SetColor(rgb[0],rgb[1],rgb[2])
+        line.SetColor(*[int(255 * c) for c in rgb] + [255])
         line.SetWidth(1.0)
     view.GetRenderWindow().Render()
 
 ##################################################
 
 
-def display_vtp(f, n=0):
+def display_vtp(f, n=0, potentials=None, currents=None, cache_size=8,
+                fixed_range=False, max_lines=100):
     """
     This function displays a VTK::vtp file generated with OpenMEEG.
     Such a file defines a polydata, containing points and triangles of several
@@ -130,6 +526,15 @@ def display_vtp(f, n=0):
     Results of the forward problem (or a cortical mapping) can be seen thanks
     to arrays associated to points and cells (respectively potentials and
     normals currents).
+    For large leadfields, potentials (n_points x n_sources) and currents
+    (n_cells x n_sources) can instead be given as arrays or as .npy or
+    OpenMEEG binary matrix files: they are memory-mapped and only the
+    displayed source is loaded, the last cache_size ones being kept.
+    The color ranges of all sources are computed when the file is loaded.
+    With fixed_range, the same range covering all sources is used whatever
+    the source.
+    When more than max_lines points (or cells) are selected, their mean
+    and percentiles are plotted instead of one line per point.
     """
     welcome = """Welcome\n\n
     Switch the button: To either see Potentials (on points) or Currents
@@ -140,32 +545,57 @@ def display_vtp(f, n=0):
     # This callback function updates the mappers for where n is the
     # slider value
     def clean_pick_data(object, event):
-        for i in range(4):
+        for i in range(nb_views):
             rens[i].RemoveActor(selactor)
         if button_widget.GetRepresentation().GetState():
-            pick_data(object, event, selactor, 1, view, text_init)
+            pick_data(object, event, selactor, 1, view, text_init, lazy_cur,
+                      max_lines)
         else:
-            pick_data(object, event, selactor, 0, view, text_init)
+            pick_data(object, event, selactor, 0, view, text_init, lazy_pot,
+                      max_lines)
+
+    def color_range(i, j):
+        # the color range of the viewport i for the source j
+        cell_mode = mappers[i].GetScalarMode() != 1
+        lazy = lazy_cur if cell_mode else lazy_pot
+        if lazy is not None:
+            return lazy.global_range() if fixed_range else lazy.range(j)
+        if i < nb_meshes:
+            ranges = (metadata.mesh_current_ranges if cell_mode else
+                      metadata.mesh_potential_ranges)[:, i]
+        else:
+            ranges = (metadata.current_ranges if cell_mode else
+                      metadata.potential_ranges)
+        return covering_range(ranges) if fixed_range else tuple(ranges[j])
 
     def select_source(object, event):  # object will be the slider2D
         slidervalue = int(round(object.GetRepresentation().GetValue()))
-        for i in range(4):
+        current_source[0] = slidervalue
+        if activate_source(slidervalue):
+            poly.Modified()
+            for i in range(nb_meshes):
+                share_mesh_attributes(poly, metadata, i, meshes[i])
+        for i in range(nb_views):
+            mappers[i].Update()
             mappers[i].GetInput().GetPointData().SetActiveScalars("Potentials-"+str(slidervalue))
             mappers[i].GetInput().GetCellData().SetActiveScalars("Currents-"+str(slidervalue))
             ren_win.SetWindowName(ren_win.GetWindowName()[0:(ren_win.GetWindowName().find('-')+1)]+str(slidervalue))
-            update_color_bar(color_bars[i], mappers[i])
+            if not fixed_range:
+                update_color_bar(color_bars[i], mappers[i],
+                                 color_range(i, slidervalue))
 
     # This callback function does updates the Scalar Mode To Use
     def SelectMode(object, event):
         # object will be the button_widget
-        for i in range(4):
+        for i in range(nb_views):
             if (object.GetRepresentation().GetState()):
                 mappers[i].SetScalarModeToUseCellData()
                 ren_win.SetWindowName(ren_win.GetWindowName().replace('Potentials', 'Currents'))
             else:
                 mappers[i].SetScalarModeToUsePointData()
                 ren_win.SetWindowName(ren_win.GetWindowName().replace('Currents', 'Potentials'))
-            update_color_bar(color_bars[i], mappers[i])
+            update_color_bar(color_bars[i], mappers[i],
+                             color_range(i, current_source[0]))
 
     # A window with an interactor
     ren_win = vtk.vtkRenderWindow()
@@ -182,52 +612,52 @@ def display_vtp(f, n=0):
     reader.Update()
     poly = reader.GetOutput()
     ren_win.SetWindowName(f+' Potentials-'+str(n))
+    metadata = get_metadata(poly, f)
+    current_source = [n]
+    # sources given apart from the file are attached one at a time
+    lazy_pot = lazy_cur = None
+    if potentials is not None:
+        lazy_pot = LazySources(potentials, 'Potentials', cache_size)
+        assert(lazy_pot.n_values == poly.GetNumberOfPoints())
+    if currents is not None:
+        lazy_cur = LazySources(currents, 'Currents', cache_size)
+        assert(lazy_cur.n_values == poly.GetNumberOfCells())
+
+    def activate_source(j):
+        # attach the arrays of the source j, returns True if poly changed
+        for lazy, attributes in ((lazy_pot, poly.GetPointData()),
+                                 (lazy_cur, poly.GetCellData())):
+            if lazy is not None:
+                lazy.activate(attributes, j)
+        return lazy_pot is not None or lazy_cur is not None
+
     # determine the number of sources
-    nb_sources = 0
-    for i in range(poly.GetPointData().GetNumberOfArrays()):
-        if poly.GetPointData().GetGlobalIds('Potentials-'+str(i)):
-            nb_sources += 1
+    nb_sources = metadata.nb_sources
+    for lazy in (lazy_pot, lazy_cur):
+        if lazy is not None:
+            nb_sources = lazy.n_sources
     if n < nb_sources:
+        activate_source(n)
         poly.GetPointData().SetActiveScalars('Potentials-'+str(n))
         poly.GetCellData().SetActiveScalars('Currents-'+str(n))
-    # Get the mesh names
-    cell_labels = poly.GetCellData().GetAbstractArray(0)
-    assert(cell_labels.GetName() == 'Names')
-    s = set()
-    nb_meshes = 0
-    cell_ids = list()
-    for i in range(cell_labels.GetNumberOfValues()):
-        s.add(cell_labels.GetValue(i))
-        if len(s)>nb_meshes:
-            # if a label is added, store the ID for the connectivity filter
-            cell_ids.append(i)
-            nb_meshes += 1
-    # Number of meshes
-    assert(nb_meshes<=4)
-    # Multiple viewports: 4
-    xmins = [0, .5, 0, .5]
-    xmaxs = [0.5, 1, 0.5, 1]
-    ymins = [0, 0, .5, .5]
-    ymaxs = [0.5, 0.5, 1, 1]
-
-    mappers = [vtk.vtkPolyDataMapper() for i in range(4)]
-    color_bars = [vtk.vtkScalarBarActor() for i in range(4)]
-    actors = [vtk.vtkActor() for i in range(4)]
-    rens = [vtk.vtkRenderer() for i in range(4)]
-
-    for i in range(4):
-        rens[i].SetViewport(xmins[i], ymins[i], xmaxs[i], ymaxs[i])
+    # Split the meshes by their labels
+    nb_meshes = metadata.nb_meshes
+    meshes = [extract_mesh(poly, metadata, i) for i in range(nb_meshes)]
+    # One viewport per mesh and one for the cut of the whole geometry
+    nb_views = nb_meshes + 1
+    viewports = tile_viewports(nb_views)
+
+    mappers = [vtk.vtkPolyDataMapper() for i in range(nb_views)]
+    color_bars = [vtk.vtkScalarBarActor() for i in range(nb_views)]
+    actors = [vtk.vtkActor() for i in range(nb_views)]
+    rens = [vtk.vtkRenderer() for i in range(nb_views)]
+
+    for i in range(nb_views):
+        rens[i].SetViewport(*viewports[i])
         # Display the meshes
         if (i < nb_meshes):
-            # Create a connectivity filter based on cell seeded region (to
-            # display only one mesh per viewport)
-            conn = vtk.vtkPolyDataConnectivityFilter()
-            conn.SetInputData(poly)
-            conn.SetExtractionModeToCellSeededRegions()
-            conn.AddSeed(cell_ids[i])
-            conn.Update()
             actor_meshname = vtk.vtkTextActor()
-            actor_meshname.SetInput(cell_labels.GetValue(cell_ids[i]))
+            actor_meshname.SetInput(metadata.mesh_names[i])
             actor_meshname.GetPositionCoordinate().SetCoordinateSystemToNormalizedViewport()
             actor_meshname.SetPosition(0.5, 0.85)
             tprop = actor_meshname.GetTextProperty()
@@ -235,13 +665,13 @@ def display_vtp(f, n=0):
             tprop.SetFontFamilyToArial()
             tprop.SetColor(1, 1, 1)
             tprop.SetJustificationToCentered()
-            mappers[i].SetInputConnection(conn.GetOutputPort())
+            mappers[i].SetInputData(meshes[i])
             mappers[i].SetScalarModeToUsePointData()
             mappers[i].Update()
             if nb_sources:
-                rens[i].AddActor2D(color_bars[i])
+                rens[i].AddViewProp(color_bars[i])
             actors[i].SetMapper(mappers[i])
-            rens[i].AddActor2D(actor_meshname)
+            rens[i].AddViewProp(actor_meshname)
             rens[i].AddActor(actors[i])
             if (i == 0):
                 cam = rens[i].GetActiveCamera()
@@ -264,7 +694,7 @@ def display_vtp(f, n=0):
             rens[i].AddActor(actors[i])
         rens[i].SetActiveCamera(cam)
         if nb_sources:
-            update_color_bar(color_bars[i], mappers[i])
+            update_color_bar(color_bars[i], mappers[i], color_range(i, n))
         ren_win.AddRenderer(rens[i])
         ren_win.Render()
 
@@ -321,18 +751,26 @@ def display_vtp(f, n=0):
         text_init.SetPosition(10, 300)
         text_init.SetInput(welcome)
         text_init.GetTextProperty().SetColor(1.0, 0.0, 0.0)
-        view.GetRenderer().AddActor2D(text_init)
+        view.GetRenderer().AddViewProp(text_init)
         view.GetInteractor().Initialize()
         iren.AddObserver(vtk.vtkCommand.EndPickEvent, clean_pick_data)
     iren.Initialize()
     iren.Start()
 
 
-def display_vtk(f, d = 0, n = 0):
+def display_vtk(f, d = 0, n = 0, cache_size=8, fixed_range=False,
+                max_lines=100):
     """
     This function displays a VTK::vtk file generated with OpenMEEG.
     Such a file defines a polydata, containing points and triangles of a single
     mesh. Most often a EEG helmet mesh and associated leadfield.
+    The potentials d (n_points x n_sources) can be an array, or for large
+    leadfields a memmap or a .npy or OpenMEEG binary matrix file name: then
+    only the displayed source is loaded, the last cache_size ones being kept.
+    With fixed_range, the same color range covering all sources is used
+    whatever the source.
+    When more than max_lines points are selected, their mean and
+    percentiles are plotted instead of one line per point.
     """
     welcome = """Welcome\n\n
     Move the slider to see all sources (columns of the input matrix)\n
@@ -342,13 +780,22 @@ def display_vtk(f, d = 0, n = 0):
     # value
     def clean_pick_data(object, event):
         ren.RemoveActor(selactor)
-        pick_data(object, event, selactor, 0, view, text_init)
+        pick_data(object, event, selactor, 0, view, text_init, lazy_pot,
+                  max_lines)
 
     def select_source(object, event): # object will be the slider2D
         slidervalue = int(round(object.GetRepresentation().GetValue()))
+        if lazy_pot is not None:
+            lazy_pot.activate(poly.GetPointData(), slidervalue)
         mapper.GetInput().GetPointData().SetActiveScalars("Potentials-"+str(slidervalue))
         ren_win.SetWindowName(ren_win.GetWindowName()[0:(ren_win.GetWindowName().find('-')+1)]+str(slidervalue))
-        update_color_bar(color_bar, mapper)
+        if not fixed_range:
+            update_color_bar(color_bar, mapper, color_range(slidervalue))
+
+    def color_range(j):
+        if lazy_pot is not None:
+            return lazy_pot.global_range() if fixed_range else lazy_pot.range(j)
+        return covering_range(ranges) if fixed_range else tuple(ranges[j])
 
     # A window with an interactor
     ren_win = vtk.vtkRenderWindow()
@@ -360,34 +807,37 @@ def display_vtk(f, d = 0, n = 0):
     picker = vtk.vtkRenderedAreaPicker()
     iren.SetPicker(picker)
     # Read the input file
-    reader = vtk.vtkPolyDataReader()
-    reader.SetFileName(f)
-    reader.Update()
-    poly = reader.GetOutput()
+    poly = read_vtk_polydata(f)
     ren_win.SetWindowName(f+' Potentials-'+str(n))
     # determine the number of sources
     nb_sources = 0
     for i in range(poly.GetPointData().GetNumberOfArrays()):
         if poly.GetPointData().GetGlobalIds('Potentials-'+str(i)):
             nb_sources += 1
+    if nb_sources == 0 and d.__class__ == int:
+        # e.g. the fields saved by omgopt: the scalar arrays are the sources
+        nb_sources = scalar_arrays_as_sources(poly.GetPointData())
+        if nb_sources and not poly.GetPointData().GetArray('Indices'):
+            add_indices_array(poly.GetPointData(), poly.GetNumberOfPoints())
+    lazy_pot = None
     if nb_sources == 0: #the file doesn't provide potentials
-        if not d.__class__ == int:
+        if isinstance(d, (str, np.memmap)):
+            lazy_pot = LazySources(d, 'Potentials', cache_size)
+            assert(lazy_pot.n_values == poly.GetNumberOfPoints())
+            nb_sources = lazy_pot.n_sources
+            lazy_pot.activate(poly.GetPointData(), n)
+        elif not d.__class__ == int:
             assert(d.shape[0] == poly.GetNumberOfPoints())
             nb_sources = d.shape[1]
-            pot = [vtk.vtkDoubleArray() for j in range(d.shape[1])]
-            for j in range(d.shape[1]):
-                pot[j].SetName('Potentials-'+str(j))
-                for i in range(d.shape[0]):
-                    pot[j].InsertNextValue(d[i, j])
-                poly.GetPointData().AddArray(pot[j])
+            add_source_arrays(poly.GetPointData(), d, 'Potentials')
         if not poly.GetPointData().GetGlobalIds('Indices'):
-            ind = vtk.vtkUnsignedIntArray()
-            ind.SetName('Indices')
-            for i in range(poly.GetNumberOfPoints()):
-                ind.InsertNextValue(i)
-            poly.GetPointData().AddArray(ind)
+            add_indices_array(poly.GetPointData(), poly.GetNumberOfPoints())
 
     poly.GetPointData().SetActiveScalars('Potentials-'+str(n))
+    if lazy_pot is None:
+        # the color ranges of all sources
+        ranges = source_ranges(poly.GetPointData(), 'Potentials',
+                               nb_sources)[:, 0]
 
     mapper = vtk.vtkPolyDataMapper()
     color_bar = vtk.vtkScalarBarActor()
@@ -399,8 +849,8 @@ def display_vtk(f, d = 0, n = 0):
     actor.SetMapper(mapper)
     ren.AddActor(actor)
     if nb_sources:
-        ren.AddActor2D(color_bar)
-        update_color_bar(color_bar, mapper)
+        ren.AddViewProp(color_bar)
+        update_color_bar(color_bar, mapper, color_range(n))
     ren_win.AddRenderer(ren)
     ren_win.Render()
 
@@ -434,7 +884,7 @@ def display_vtk(f, d = 0, n = 0):
         text_init.SetPosition(10, 300)
         text_init.SetInput(welcome)
         text_init.GetTextProperty().SetColor(1.0, 0.0, 0.0)
-        view.GetRenderer().AddActor2D(text_init)
+        view.GetRenderer().AddViewProp(text_init)
         view.GetInteractor().Initialize()
         iren.AddObserver(vtk.vtkCommand.EndPickEvent, clean_pick_data)
     iren.Initialize()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Readers for OpenMEEG .tri meshes and .geom geometry files
+
+@author: - A. Gramfort, alexandre.gramfort@telecom-paristech.fr
+"""
+
+import os
+from itertools import islice
+
+import numpy as np
+
+
+def read_geom(geom_file):
+    """readGeom : provides paths to meshes present in .geom file"""
+    f = open(geom_file, 'r')
+    lines = f.readlines()
+    mesh_files = []
+    for l in lines:
+        words = l.split()
+        if (len(words) > 1):
+            if (words[0] == "Interfaces"):
+                nb_mesh = int(words[1])
+                print("Nb mesh files : %d" % nb_mesh)
+                continue
+
+        if (len(words) == 1):
+            mesh_file = words[0]
+            if (mesh_file[-4:] == ".tri"):
+                mesh_files.append(mesh_file)
+            if not os.path.exists(mesh_file):
+                print("Could not find mesh : " + mesh_file)
+            continue
+
+        if ((len(words) > 1) and words[0].startswith('Interface')):
+            mesh_file = words[-1][1:-1]
+            if (mesh_file[-4:] == ".tri"):
+                mesh_files.append(mesh_file)
+            if not os.path.exists(mesh_file):
+                print("Could not find mesh : " + mesh_file)
+            continue
+
+    for k, fname in enumerate(mesh_files):
+        if not os.path.isabs(fname):
+            mesh_files[k] = os.path.join(os.path.dirname(geom_file), fname)
+
+    print('Found : %s' % mesh_files)
+    return mesh_files
+
+
+def _read_block(fid, n_rows, dtype, n_cols):
+    """Parse n_rows whitespace separated lines of fid in a single pass
+
+    n_cols is the shape of an empty block, else it is read from the first
+    line.
+    """
+    if n_rows == 0:  # don't consume the header of the next block
+        return np.empty((0, n_cols), dtype=dtype)
+    first = fid.readline()
+    n_cols = len(first.split())
+    text = first + ''.join(islice(fid, n_rows - 1))
+    data = np.fromstring(text, dtype=dtype, sep=' ')
+    if data.size != n_rows * n_cols:
+        raise ValueError('Expected %d values on %d lines in %s'
+                         % (n_rows * n_cols, n_rows, fid.name))
+    return data.reshape(n_rows, n_cols)
+
+
+def _tri_cache_fnames(fname):
+    """Paths of the binary sidecar files caching a .tri file"""
+    return fname + '.points.npy', fname + '.faces.npy'
+
+
+def _tri_stamp(fname):
+    """The (size, mtime) pair used to validate the sidecar cache"""
+    st = os.stat(fname)
+    return float(st.st_size), float(st.st_mtime)
+
+
+def _load_tri_cache(fname):
+    """Memory-map the sidecar cache of fname, None if missing or stale"""
+    points_fname, faces_fname = _tri_cache_fnames(fname)
+    if not (os.path.exists(points_fname) and os.path.exists(faces_fname)):
+        return None
+    try:
+        vertices = np.load(points_fname, mmap_mode='r')
+        faces = np.load(faces_fname, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    # the first row of the vertices stores the stamp of the source file
+    header = vertices[0]
+    if (tuple(header[:2]) != _tri_stamp(fname) or
+            int(header[2]) != len(vertices) - 1 or
+            int(header[3]) != len(faces)):
+        return None
+    n_normals = int(header[4])
+    return vertices[1:, :3], vertices[1:, 3:3 + n_normals], faces
+
+
+def _save_tri_cache(fname, points, normals, faces):
+    """Write the sidecar cache of fname next to it"""
+    points_fname, faces_fname = _tri_cache_fnames(fname)
+    vertices = np.empty((len(points) + 1, 6))
+    vertices[0] = _tri_stamp(fname) + (len(points), len(faces),
+                                       normals.shape[1], 0)
+    vertices[1:, :3] = points
+    vertices[1:, 3:3 + normals.shape[1]] = normals
+    vertices[1:, 3 + normals.shape[1]:] = 0.
+    try:
+        # write to a temporary file first so that concurrent readers never
+        # see a partial cache
+        for cache_fname, data in ((faces_fname, faces),
+                                  (points_fname, vertices)):
+            with open(cache_fname + '.tmp', 'wb') as fid:
+                np.save(fid, data)
+            os.rename(cache_fname + '.tmp', cache_fname)
+    except (IOError, OSError):
+        print("Could not write cache for : " + fname)
+
+
+def read_tri(fname, cache=False):
+    """Read .tri file
+
+    Parameters
+    ----------
+    fname : str
+        The file to read.
+    cache : bool
+        If True, a binary copy of the mesh is saved next to fname
+        (fname + '.points.npy' and fname + '.faces.npy') and is memory-mapped
+        on the next reads as long as the size and modification time of
+        fname are unchanged.
+
+    Returns
+    -------
+    points : ndarray, shape (n_points, 3)
+        The vertices
+    normals : ndarray, shape (n_points, 3)
+        The normals at the vertices
+    faces : ndarray, shape (n_faces, 3)
+        The faces
+    """
+    assert(fname.endswith('.tri'))
+    if cache:
+        cached = _load_tri_cache(fname)
+        if cached is not None:
+            return cached
+
+    with open(fname, "r") as fid:
+        # read the number of vertices
+        npoints = int(fid.readline().split()[1])
+        # fills the vertices arrays
+        vertices = _read_block(fid, npoints, np.float64, 6)
+        # Read the number of triangles
+        n_faces = int(fid.readline().split()[1])
+        # create the array of triangles
+        faces = _read_block(fid, n_faces, np.int32, 3)[:, :3]
+
+    points = np.ascontiguousarray(vertices[:, :3])
+    normals = np.ascontiguousarray(vertices[:, 3:])
+    faces = np.ascontiguousarray(faces)
+    if cache:
+        _save_tri_cache(fname, points, normals, faces)
+    return points, normals, faces
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+CPU picking of points and cells, without vtkHardwareSelector.
+
+The points (or the triangle centroids for cells) are sorted once along a
+k-d tree so that each block of leaf_size consecutive points is spatially
+compact. A pick only tests the points of the blocks whose bounding box
+intersects the picking frustum, with numpy. This needs no render pass and
+works the same with software rendering and offscreen.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+ID_TYPE = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+
+
+def poly_triangles(poly):
+    """The point ids of the triangles of poly, shape (n_cells, 3)"""
+    polys = poly.GetPolys()
+    if hasattr(polys, 'GetConnectivityArray'):  # vtk >= 9
+        return numpy_support.vtk_to_numpy(
+            polys.GetConnectivityArray()).reshape(-1, 3)
+    return numpy_support.vtk_to_numpy(polys.GetData()).reshape(-1, 4)[:, 1:]
+
+
+def _kd_order(points, leaf_size):
+    """Permutation of points grouping them by k-d tree leaves"""
+    order = np.arange(len(points))
+    stack = [(0, len(points))]
+    while stack:
+        start, stop = stack.pop()
+        if stop - start <= leaf_size:
+            continue
+        ids = order[start:stop]
+        extent = points[ids].max(axis=0) - points[ids].min(axis=0)
+        axis = int(np.argmax(extent))
+        # split at a multiple of leaf_size so that leaves never overlap
+        middle = leaf_size * (((stop - start) // 2 + leaf_size - 1)
+                              // leaf_size)
+        middle = min(middle, stop - start - 1)
+        part = np.argpartition(points[ids, axis], middle)
+        order[start:stop] = ids[part]
+        stack.append((start, start + middle))
+        stack.append((start + middle, stop))
+    return order
+
+
+class _BlockIndex(object):
+    """Blocks of leaf_size points with their bounding boxes
+
+    Only the points ids are indexed if given, all points otherwise.
+    """
+    def __init__(self, points, leaf_size, ids=None):
+        if ids is None:
+            ids = np.arange(len(points))
+        points = points[ids]
+        order = _kd_order(points, leaf_size)
+        self.order = ids[order]
+        self.points = np.ascontiguousarray(points[order])
+        self.starts = np.arange(0, len(points), leaf_size)
+        n_blocks = len(self.starts)
+        self.lower = np.minimum.reduceat(self.points, self.starts, axis=0) \
+            if n_blocks else np.zeros((0, 3))
+        self.upper = np.maximum.reduceat(self.points, self.starts, axis=0) \
+            if n_blocks else np.zeros((0, 3))
+        self.leaf_size = leaf_size
+        self._ranks = None
+
+    def inside(self, normals, origins):
+        """Ids of the points inside all planes (normals pointing outside)"""
+        offsets = np.einsum('pk,pk->p', normals, origins)
+        # a box is outside a plane if its corner the most inside is outside
+        corners = np.where(normals[:, None, :] > 0, self.lower[None],
+                           self.upper[None])
+        outside = (np.einsum('pbk,pk->pb', corners, normals) >
+                   offsets[:, None]).any(axis=0)
+        blocks = np.flatnonzero(~outside)
+        if not len(blocks):
+            return np.zeros(0, dtype=int)
+        ids = (self.starts[blocks][:, None] +
+               np.arange(self.leaf_size)[None]).ravel()
+        ids = ids[ids < len(self.points)]
+        keep = (np.dot(self.points[ids], normals.T) <=
+                offsets[None]).all(axis=1)
+        return self.order[ids[keep]]
+
+    def coordinates(self, ids):
+        """The coordinates of indexed points from their original ids"""
+        if self._ranks is None:
+            self._ranks = np.empty(self.order.max() + 1, dtype=int)
+            self._ranks[self.order] = np.arange(len(self.order))
+        return self.points[self._ranks[ids]]
+
+
+def _triangle_centroids(poly):
+    points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData())
+    return points[poly_triangles(poly)].mean(axis=1)
+
+
+class MeshPicker(object):
+    """Spatial index of the points and triangles of a polydata
+
+    Parameters
+    ----------
+    poly : vtkPolyData
+        The mesh, made of triangles.
+    leaf_size : int
+        The number of points per block of the index.
+    """
+    def __init__(self, poly, leaf_size=64):
+        self.poly = poly
+        self.leaf_size = leaf_size
+        points = numpy_support.vtk_to_numpy(poly.GetPoints().GetData())
+        # the points may be shared with other meshes: only index the points
+        # of the triangles
+        used = np.unique(poly_triangles(poly)) if poly.GetNumberOfPolys() \
+            else None
+        self._points = _BlockIndex(points, leaf_size, used)
+        self._cells = None  # built on the first cell pick
+
+    def _index(self, cells):
+        if not cells:
+            return self._points
+        if self._cells is None:
+            self._cells = _BlockIndex(_triangle_centroids(self.poly),
+                                      self.leaf_size)
+        return self._cells
+
+    def frustum(self, planes, cells=False):
+        """The points (or cells) inside a frustum
+
+        Parameters
+        ----------
+        planes : vtkPlanes
+            The frustum, e.g. vtkAreaPicker.GetFrustum(), normals pointing
+            outside.
+        cells : bool
+            Select the cells whose centroid is inside instead of the points.
+
+        Returns
+        -------
+        ids : ndarray
+            The ids of the points (or cells).
+        """
+        normals = numpy_support.vtk_to_numpy(planes.GetNormals())
+        origins = numpy_support.vtk_to_numpy(planes.GetPoints().GetData())
+        return self._index(cells).inside(np.asarray(normals, dtype=float),
+                                         np.asarray(origins, dtype=float))
+
+    def nearest(self, position, ids=None, cells=False):
+        """The point (or cell) the nearest to a 3D position
+
+        Parameters
+        ----------
+        position : array, shape (3,)
+            The position, e.g. of the camera.
+        ids : array | None
+            The candidates, e.g. the output of frustum. All points (or
+            cells) if None.
+        cells : bool
+            Compare the centroids of the cells instead of the points.
+
+        Returns
+        -------
+        id : int
+            The id of the point (or cell).
+        """
+        index = self._index(cells)
+        if ids is None:
+            points, ids = index.points, index.order
+        else:
+            points = index.coordinates(ids)
+        return ids[np.argmin(((points - position) ** 2).sum(axis=1))]
+
+    def extract(self, ids, cells=False):
+        """The points (or cells) ids of the mesh, with all their arrays
+
+        The output carries the Indices arrays of the mesh, as the output of
+        vtkExtractSelection with a vtkHardwareSelector selection.
+        """
+        node = vtk.vtkSelectionNode()
+        node.SetContentType(vtk.vtkSelectionNode.INDICES)
+        if cells:
+            node.SetFieldType(vtk.vtkSelectionNode.CELL)
+        else:
+            node.SetFieldType(vtk.vtkSelectionNode.POINT)
+        node.SetSelectionList(numpy_support.numpy_to_vtkIdTypeArray(
+            np.asarray(ids, dtype=ID_TYPE), deep=1))
+        selection = vtk.vtkSelection()
+        selection.AddNode(node)
+        ex = vtk.vtkExtractSelection()
+        ex.SetInputData(0, self.poly)
+        ex.SetInputData(1, selection)
+        ex.Update()
+        return ex.GetOutput()
+
+
+# pickers of the last meshes picked, by id of the polydata, rebuilt when
+# their points change. Bounded, so that the meshes of the windows closed
+# during a session are released.
+MAX_PICKERS = 4
+_pickers = OrderedDict()
+
+
+def get_picker(poly):
+    """The MeshPicker of poly, built on the first pick"""
+    key = id(poly)
+    mtime = poly.GetPoints().GetMTime()
+    entry = _pickers.pop(key, None)
+    if entry is None or entry[0] != mtime or entry[1].poly is not poly:
+        entry = (mtime, MeshPicker(poly))
+    _pickers[key] = entry
+    while len(_pickers) > MAX_PICKERS:
+        _pickers.popitem(last=False)
+    return entry[1]
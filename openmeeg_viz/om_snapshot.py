@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Headless rendering of OpenMEEG files to images.
+
+render_snapshots renders a fixed set of camera views of .tri, .geom, .vtk
+and .vtp files offscreen, without any interactor, so it can run on nodes
+without a display. It can be called as:
+from openmeeg_viz import render_snapshots
+or through the command line with: om_viz snapshot --out qc/ *.geom
+"""
+
+import glob
+import os
+import multiprocessing
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from .om_display import triangles_to_cell_array
+from .om_mesh import read_geom, read_tri
+
+# camera direction (from the focal point) and view up of each view
+VIEWS = {'left': ((-1, 0, 0), (0, 0, 1)),
+         'right': ((1, 0, 0), (0, 0, 1)),
+         'front': ((0, 1, 0), (0, 0, 1)),
+         'back': ((0, -1, 0), (0, 0, 1)),
+         'top': ((0, 0, 1), (0, 1, 0)),
+         'bottom': ((0, 0, -1), (0, 1, 0))}
+DEFAULT_VIEWS = ('left', 'right', 'front', 'back', 'top', 'bottom')
+
+
+def _polydata_from_meshes(meshes):
+    """Merge (points, faces) pairs into one polydata labelled by mesh"""
+    offsets = np.cumsum([0] + [len(points) for points, _ in meshes])
+    points = np.concatenate([points for points, _ in meshes])
+    faces = np.concatenate([faces + offset
+                            for (_, faces), offset in zip(meshes, offsets)])
+    poly = vtk.vtkPolyData()
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(points, deep=1))
+    poly.SetPoints(vtk_points)
+    poly.SetPolys(triangles_to_cell_array(faces))
+    if len(meshes) > 1:
+        mesh_ids = np.repeat(np.arange(len(meshes), dtype=np.float64),
+                             np.diff(offsets))
+        scalars = numpy_support.numpy_to_vtk(mesh_ids, deep=1)
+        scalars.SetName('Mesh')
+        poly.GetPointData().SetScalars(scalars)
+    return poly
+
+
+def read_polydata(fname):
+    """Read a .tri, .geom, .vtk or .vtp file as a vtkPolyData
+
+    For .vtk and .vtp files the first source (Potentials-0) is made the
+    active scalars. The meshes of a .geom file are merged and labelled with
+    a 'Mesh' point scalar.
+    """
+    if fname.endswith('.tri'):
+        points, _, faces = read_tri(fname)
+        return _polydata_from_meshes([(points, faces)])
+    if fname.endswith('.geom'):
+        meshes = [read_tri(fn) for fn in read_geom(fname)]
+        return _polydata_from_meshes([(points, faces)
+                                      for points, _, faces in meshes])
+    if fname.endswith('.vtp'):
+        reader = vtk.vtkXMLPolyDataReader()
+    elif fname.endswith('.vtk'):
+        reader = vtk.vtkPolyDataReader()
+    else:
+        raise ValueError('Unknown file format : ' + fname)
+    reader.SetFileName(fname)
+    reader.Update()
+    poly = reader.GetOutput()
+    if poly.GetPointData().GetArray('Potentials-0'):
+        poly.GetPointData().SetActiveScalars('Potentials-0')
+    return poly
+
+
+class SnapshotRenderer(object):
+    """Offscreen render window reused between files
+
+    Parameters
+    ----------
+    size : tuple of int
+        The width and height of the images.
+    views : list of str
+        The names of the views to render, keys of VIEWS.
+    """
+    def __init__(self, size=(600, 600), views=DEFAULT_VIEWS):
+        for view in views:
+            if view not in VIEWS:
+                raise ValueError('Unknown view : %s' % view)
+        self.views = list(views)
+        self.ren_win = vtk.vtkRenderWindow()
+        self.ren_win.SetOffScreenRendering(1)
+        self.ren_win.SetSize(*size)
+        self.ren = vtk.vtkRenderer()
+        self.ren.SetBackground(1, 1, 1)
+        self.ren_win.AddRenderer(self.ren)
+        self.mapper = vtk.vtkPolyDataMapper()
+        self.mapper.SetScalarModeToUsePointData()
+        self.actor = vtk.vtkActor()
+        self.actor.SetMapper(self.mapper)
+        self.ren.AddActor(self.actor)
+        self.w2i = vtk.vtkWindowToImageFilter()
+        self.w2i.SetInput(self.ren_win)
+        self.w2i.SetInputBufferTypeToRGB()
+        self.w2i.ReadFrontBufferOff()
+
+    def render(self, poly):
+        """Render all the views of a polydata
+
+        Returns
+        -------
+        images : dict of ndarray, shape (height, width, 3)
+            The RGB image of each view.
+        """
+        self.mapper.SetInputData(poly)
+        scalars = poly.GetPointData().GetScalars()
+        if scalars is None:
+            self.mapper.ScalarVisibilityOff()
+            self.actor.GetProperty().SetColor(0.95, 0.83, 0.83)
+        else:
+            self.mapper.ScalarVisibilityOn()
+            self.mapper.SetScalarRange(scalars.GetRange())
+        center = np.array(poly.GetCenter())
+        cam = self.ren.GetActiveCamera()
+        images = dict()
+        for view in self.views:
+            direction, view_up = VIEWS[view]
+            cam.SetFocalPoint(*center)
+            cam.SetPosition(*(center + direction))
+            cam.SetViewUp(*view_up)
+            self.ren.ResetCamera()
+            self.ren_win.Render()
+            self.w2i.Modified()
+            self.w2i.Update()
+            image = self.w2i.GetOutput()
+            width, height, _ = image.GetDimensions()
+            array = numpy_support.vtk_to_numpy(
+                image.GetPointData().GetScalars())
+            # VTK images start at the bottom left corner
+            images[view] = array.reshape(height, width, -1)[::-1].copy()
+        return images
+
+    def save(self, images, prefix):
+        """Save images as prefix_<view>.png, return the file names"""
+        fnames = []
+        writer = vtk.vtkPNGWriter()
+        for view in self.views:
+            height, width, n_comp = images[view].shape
+            image = vtk.vtkImageData()
+            image.SetDimensions(width, height, 1)
+            array = numpy_support.numpy_to_vtk(
+                images[view][::-1].reshape(-1, n_comp), deep=1)
+            image.GetPointData().SetScalars(array)
+            fname = '%s_%s.png' % (prefix, view)
+            writer.SetFileName(fname)
+            writer.SetInputData(image)
+            writer.Write()
+            fnames.append(fname)
+        return fnames
+
+    def close(self):
+        """Release the render window and its OpenGL context"""
+        self.w2i.SetInput(None)
+        self.ren_win.Finalize()
+        self.mapper.SetInputData(None)
+
+
+# renderer of the current worker process, created once by _init_worker
+_renderer = None
+
+
+def _init_worker(size, views):
+    global _renderer
+    _renderer = SnapshotRenderer(size, views)
+
+
+def _snapshot_file(args, renderer=None):
+    fname, prefix, return_images = args
+    if renderer is None:
+        renderer = _renderer
+    images = renderer.render(read_polydata(fname))
+    if prefix is not None:
+        renderer.save(images, prefix)
+    return images if return_images else None
+
+
+def _expand_fnames(fnames):
+    if isinstance(fnames, str):
+        fnames = [fnames]
+    expanded = []
+    for fname in fnames:
+        matches = sorted(glob.glob(fname))
+        expanded.extend(matches if matches else [fname])
+    return expanded
+
+
+def _output_prefixes(fnames, out_dir):
+    """Unique image name prefixes, from the paths below the common dir"""
+    fnames = [os.path.abspath(fname) for fname in fnames]
+    common = os.path.dirname(os.path.commonprefix(fnames))
+    return [os.path.join(out_dir,
+                         os.path.relpath(fname, common).replace(os.sep, '_'))
+            for fname in fnames]
+
+
+def render_snapshots(fnames, out_dir=None, views=DEFAULT_VIEWS,
+                     size=(600, 600), n_jobs=1, return_images=True):
+    """Render a fixed set of views of many files without a display
+
+    Parameters
+    ----------
+    fnames : str | list of str
+        The files (.tri, .geom, .vtk or .vtp) to render. Glob patterns are
+        expanded.
+    out_dir : str | None
+        If not None, the images are saved in out_dir as
+        <file name>_<view>.png, where the file name includes the directories
+        below the directory common to all files.
+    views : list of str
+        The views to render among 'left', 'right', 'front', 'back', 'top'
+        and 'bottom'.
+    size : tuple of int
+        The width and height of the images.
+    n_jobs : int
+        The number of processes rendering files in parallel. Each process
+        keeps one render window for all the files it renders.
+    return_images : bool
+        If False, the images are only saved to out_dir and None is returned
+        for each file, which avoids sending them back from the workers.
+
+    Returns
+    -------
+    images : list of dict
+        For each file, the RGB image, shape (height, width, 3), of each
+        view.
+    """
+    fnames = _expand_fnames(fnames)
+    if out_dir is not None and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if out_dir is None:
+        prefixes = [None] * len(fnames)
+    else:
+        prefixes = _output_prefixes(fnames, out_dir)
+    args = [(fname, prefix, return_images)
+            for fname, prefix in zip(fnames, prefixes)]
+    n_jobs = max(1, min(n_jobs, len(fnames)))
+    if n_jobs == 1:
+        # a renderer of the caller's own, released when done
+        renderer = SnapshotRenderer(size, views)
+        try:
+            return [_snapshot_file(arg, renderer) for arg in args]
+        finally:
+            renderer.close()
+    # do not fork a process that may already hold an OpenGL context
+    pool = multiprocessing.get_context('spawn').Pool(
+        n_jobs, initializer=_init_worker, initargs=(size, views))
+    try:
+        return pool.map(_snapshot_file, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
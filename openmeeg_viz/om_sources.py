@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand access to large source matrices (leadfields, potentials...).
+
+The matrix stays on disk, memory-mapped, and only the columns which are
+displayed are converted to VTK arrays, with a small LRU cache so that going
+back and forth between sources does not read them again.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from vtk.util import numpy_support
+
+
+def read_matrix(fname):
+    """Memory-map a matrix saved as .npy or in the OpenMEEG binary format
+
+    Parameters
+    ----------
+    fname : str
+        A .npy file or an OpenMEEG binary matrix (.bin): two uint32
+        (the number of lines and columns) followed by the float64 values in
+        column major order.
+
+    Returns
+    -------
+    data : ndarray | memmap, shape (n_values, n_sources)
+        The matrix, read only.
+    """
+    if fname.endswith('.npy'):
+        return np.load(fname, mmap_mode='r')
+    header = np.fromfile(fname, dtype=np.uint32, count=2)
+    if len(header) != 2:
+        raise ValueError('Not an OpenMEEG binary matrix : ' + fname)
+    n_lines, n_cols = int(header[0]), int(header[1])
+    return np.memmap(fname, dtype=np.float64, mode='r', offset=8,
+                     shape=(n_lines, n_cols), order='F')
+
+
+class LazySources(object):
+    """The columns of a source matrix, converted to VTK arrays on demand
+
+    Parameters
+    ----------
+    data : str | ndarray, shape (n_values, n_sources)
+        The matrix or the file to memory-map with read_matrix.
+    name : str
+        The prefix of the array names (Potentials or Currents).
+    cache_size : int
+        The number of columns kept as VTK arrays.
+    """
+    def __init__(self, data, name, cache_size=8):
+        if isinstance(data, str):
+            data = read_matrix(data)
+        self.data = data
+        self.name = name
+        self.cache_size = max(1, cache_size)
+        self.n_values, self.n_sources = data.shape
+        self._cache = OrderedDict()
+        self._active = None
+        self._ranges = dict()
+        self._global_range = None
+
+    def column(self, j):
+        """The VTK array of the source j"""
+        if j in self._cache:
+            array = self._cache.pop(j)
+        else:
+            values = np.ascontiguousarray(self.data[:, j], dtype=np.float64)
+            array = numpy_support.numpy_to_vtk(values, deep=0)
+            array.SetName(self.name + '-' + str(j))
+            if len(values):
+                self._ranges[j] = (values.min(), values.max())
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+        self._cache[j] = array
+        return array
+
+    def range(self, j):
+        """The (min, max) of the source j"""
+        if j not in self._ranges:
+            self.column(j)
+        return self._ranges.get(j, (0., 1.))
+
+    def global_range(self):
+        """The (min, max) over all sources, computed once in one pass"""
+        if self._global_range is None:
+            self._global_range = (float(np.min(self.data)),
+                                  float(np.max(self.data)))
+        return self._global_range
+
+    def rows(self, indices):
+        """The values of all sources at some points (or cells)
+
+        Returns
+        -------
+        values : ndarray, shape (len(indices), n_sources)
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        return np.asarray(self.data[indices], dtype=np.float64)
+
+    def activate(self, attributes, j):
+        """Make the source j the only one attached, as active scalars
+
+        Parameters
+        ----------
+        attributes : vtkPointData | vtkCellData
+            Where the array of the source is attached.
+        j : int
+            The source.
+        """
+        if self._active is not None:
+            attributes.RemoveArray(self.name + '-' + str(self._active))
+        attributes.AddArray(self.column(j))
+        attributes.SetActiveScalars(self.name + '-' + str(j))
+        self._active = j
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+Binary VTK writers for point sets and structured grids, with numpy only.
+
+write_vtk writes points and any number of named point arrays to:
+- .vtk: legacy VTK, binary (big endian) or ASCII,
+- .vtu: XML unstructured grid of vertices, with appended raw data,
+- .vts: XML structured grid, with appended raw data.
+The arrays are converted and written in chunks of chunk_size points, so
+that no text nor full size temporary copy is built, and they can be
+memory-mapped.
+
+VTKStreamWriter writes the same files from points and arrays given chunk
+by chunk, e.g. when the number of points is not known in advance, through
+temporary files.
+"""
+
+from collections import OrderedDict
+import tempfile
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+CHUNK_SIZE = 65536
+
+
+def structured_order(dims, start=0, stop=None):
+    """The VTK point order (x fastest) of a grid stored with z fastest
+
+    Parameters
+    ----------
+    dims : tuple of int
+        The number of points (nx, ny, nz) along each axis.
+    start, stop : int
+        The range of VTK points, all points by default.
+
+    Returns
+    -------
+    order : ndarray, shape (stop - start,)
+        The row of the grid of each VTK point.
+    """
+    nx, ny, nz = dims
+    if stop is None:
+        stop = nx * ny * nz
+    k, j, i = np.unravel_index(np.arange(start, stop), (nz, ny, nx))
+    return (i * ny + j) * nz + k
+
+
+def _n_components(array):
+    return 1 if np.ndim(array) == 1 else int(np.shape(array)[1])
+
+
+def _chunks(array, order, dtype, chunk_size):
+    """The bytes of array (in order if not None), chunk_size rows at once"""
+    n = len(array) if order is None else len(order)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        rows = slice(start, stop) if order is None else order[start:stop]
+        yield np.ascontiguousarray(array[rows], dtype=dtype).tobytes()
+
+
+def _ascii_chunks(array, order, chunk_size):
+    n = len(array) if order is None else len(order)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        rows = slice(start, stop) if order is None else order[start:stop]
+        values = np.reshape(np.asarray(array[rows], dtype=np.float64),
+                            (stop - start, -1))
+        yield ''.join(' '.join('%.7g' % x for x in row) + '\n'
+                      for row in values).encode('ascii')
+
+
+def _vertices_chunks(n, dtype, chunk_size, legacy):
+    """The vertex cells: (1, i) pairs for legacy, else the connectivity"""
+    for start in range(0, n, chunk_size):
+        ids = np.arange(start, min(start + chunk_size, n))
+        if legacy:
+            ids = np.column_stack((np.ones_like(ids), ids))
+        yield ids.astype(dtype).tobytes()
+
+
+def _check_point_data(point_data, n):
+    point_data = OrderedDict(point_data)
+    for name, array in point_data.items():
+        if len(array) != n:
+            raise ValueError('%s has %d values for %d points'
+                             % (name, len(array), n))
+        if ' ' in name:
+            raise ValueError('Array names cannot contain spaces : ' + name)
+    return point_data
+
+
+def _write_legacy(fid, points, point_data, dims, order, binary, title,
+                  chunk_size):
+    n = len(points) if order is None else len(order)
+
+    def write_array(array, dtype):
+        if binary:
+            for chunk in _chunks(array, order, dtype, chunk_size):
+                fid.write(chunk)
+            fid.write(b'\n')
+        else:
+            for chunk in _ascii_chunks(array, order, chunk_size):
+                fid.write(chunk)
+
+    header = ['# vtk DataFile Version 3.0', title[:255].replace('\n', ' '),
+              'BINARY' if binary else 'ASCII']
+    if dims is None:
+        header.append('DATASET POLYDATA')
+    else:
+        header.append('DATASET STRUCTURED_GRID')
+        header.append('DIMENSIONS %d %d %d' % tuple(dims))
+    header.append('POINTS %d float\n' % n)
+    fid.write('\n'.join(header).encode('ascii'))
+    write_array(points, '>f4')
+    if dims is None and n:
+        # one vertex per point, so that the points are rendered
+        fid.write(('VERTICES %d %d\n' % (n, 2 * n)).encode('ascii'))
+        if binary:
+            for chunk in _vertices_chunks(n, '>i4', chunk_size, True):
+                fid.write(chunk)
+            fid.write(b'\n')
+        else:
+            for start in range(0, n, chunk_size):
+                fid.write(''.join('1 %d\n' % i for i in range(
+                    start, min(start + chunk_size, n))).encode('ascii'))
+    if not point_data or not n:
+        return
+    fid.write(('POINT_DATA %d\n' % n).encode('ascii'))
+    for name, array in point_data.items():
+        n_components = _n_components(array)
+        if n_components == 1:
+            fid.write(('SCALARS %s float 1\nLOOKUP_TABLE default\n'
+                       % name).encode('ascii'))
+        elif n_components == 3:
+            fid.write(('VECTORS %s float\n' % name).encode('ascii'))
+        else:
+            fid.write(('FIELD FieldData 1\n%s %d %d float\n'
+                       % (name, n_components, n)).encode('ascii'))
+        write_array(array, '>f4')
+
+
+def _write_xml(fid, points, point_data, dims, order, chunk_size):
+    n = len(points) if order is None else len(order)
+    # the appended blocks: (xml attributes, number of bytes, chunks)
+    blocks = []
+    offset = 0
+
+    def add_block(attributes, nbytes, chunks):
+        blocks.append((attributes + ' format="appended" offset="%d"/>'
+                       % offset, nbytes, chunks))
+        return offset + 8 + nbytes
+
+    attributes = ''
+    scalars = [name for name, array in point_data.items()
+               if _n_components(array) == 1]
+    vectors = [name for name, array in point_data.items()
+               if _n_components(array) == 3]
+    if scalars:
+        attributes += ' Scalars=%s' % quoteattr(scalars[0])
+    if vectors:
+        attributes += ' Vectors=%s' % quoteattr(vectors[0])
+    xml_point_data = []
+    for name, array in point_data.items():
+        n_components = _n_components(array)
+        xml_point_data.append(len(blocks))
+        offset = add_block(
+            '<DataArray type="Float32" Name=%s NumberOfComponents="%d"'
+            % (quoteattr(name), n_components), 4 * n_components * n,
+            _chunks(array, order, '<f4', chunk_size))
+    xml_points = len(blocks)
+    offset = add_block('<DataArray type="Float32" Name="Points" '
+                       'NumberOfComponents="3"', 12 * n,
+                       _chunks(points, order, '<f4', chunk_size))
+    if dims is None:
+        xml_cells = len(blocks)
+        offset = add_block('<DataArray type="Int64" Name="connectivity"',
+                           8 * n, _vertices_chunks(n, '<i8', chunk_size,
+                                                   False))
+        offset = add_block(
+            '<DataArray type="Int64" Name="offsets"', 8 * n,
+            (np.arange(start + 1, min(start + chunk_size, n) + 1,
+                       dtype='<i8').tobytes()
+             for start in range(0, n, chunk_size)))
+        offset = add_block(
+            '<DataArray type="UInt8" Name="types"', n,
+            (np.ones(min(start + chunk_size, n) - start, dtype=np.uint8)
+             .tobytes() for start in range(0, n, chunk_size)))
+
+    if dims is None:
+        kind = 'UnstructuredGrid'
+        piece = '<Piece NumberOfPoints="%d" NumberOfCells="%d">' % (n, n)
+        grid = '<UnstructuredGrid>'
+    else:
+        kind = 'StructuredGrid'
+        extent = ' '.join('0 %d' % (d - 1) for d in dims)
+        piece = '<Piece Extent="%s">' % extent
+        grid = '<StructuredGrid WholeExtent="%s">' % extent
+    lines = ['<?xml version="1.0"?>',
+             '<VTKFile type="%s" version="1.0" byte_order="LittleEndian" '
+             'header_type="UInt64">' % kind, grid, piece,
+             '<PointData%s>' % attributes]
+    lines += [blocks[i][0] for i in xml_point_data]
+    lines += ['</PointData>', '<Points>', blocks[xml_points][0],
+              '</Points>']
+    if dims is None:
+        lines += ['<Cells>'] + [blocks[i][0]
+                                for i in range(xml_cells, xml_cells + 3)]
+        lines += ['</Cells>']
+    lines += ['</Piece>', '</%s>' % kind, '<AppendedData encoding="raw">',
+              '_']
+    fid.write('\n'.join(lines).encode('utf-8'))
+    for _, nbytes, chunks in blocks:
+        fid.write(np.array([nbytes], dtype='<u8').tobytes())
+        for chunk in chunks:
+            fid.write(chunk)
+    fid.write(('\n</AppendedData>\n</VTKFile>\n').encode('ascii'))
+
+
+def write_vtk(fname, points, point_data=(), dims=None, order=None,
+              binary=True, title=None, chunk_size=CHUNK_SIZE):
+    """Write points and named point arrays to a VTK file
+
+    Parameters
+    ----------
+    fname : str
+        The file: .vtk (legacy), .vtu or .vts (XML, appended raw data).
+    points : array, shape (n_points, 3)
+        The points. An array-like indexable by rows, e.g. a memmap.
+    point_data : list of (str, array) | dict
+        The named point arrays, shape (n_points,) or (n_points, 1) for
+        scalars, (n_points, 3) for vectors.
+    dims : tuple of int | None
+        The dimensions (nx, ny, nz) of a structured grid. Required for .vts.
+        Otherwise the points are written as vertices.
+    order : array of int | None
+        The rows of points and point_data to write, in VTK order, e.g.
+        structured_order(dims) for a grid stored with z fastest.
+    binary : bool
+        Write binary or ASCII legacy files. The XML files are binary.
+    title : str | None
+        The title of legacy files, fname if None.
+    chunk_size : int
+        The number of points converted and written at once.
+    """
+    n = len(points) if order is None else len(order)
+    point_data = _check_point_data(point_data, len(points))
+    if dims is not None and int(np.prod(dims)) != n:
+        raise ValueError('%d points for dimensions %s' % (n, tuple(dims)))
+    with open(fname, 'wb') as fid:
+        if fname.endswith('.vtk'):
+            _write_legacy(fid, points, point_data, dims, order, binary,
+                          fname if title is None else title, chunk_size)
+        elif fname.endswith('.vtu'):
+            if dims is not None:
+                raise ValueError('Use a .vts file for a structured grid')
+            _write_xml(fid, points, point_data, None, order, chunk_size)
+        elif fname.endswith('.vts'):
+            if dims is None:
+                raise ValueError('A .vts file needs the grid dimensions')
+            _write_xml(fid, points, point_data, dims, order, chunk_size)
+        else:
+            raise ValueError('Unknown VTK file format : ' + fname)
+
+
+class _StructuredOrder(object):
+    """structured_order(dims), computed slice by slice"""
+    def __init__(self, dims):
+        self.dims = tuple(dims)
+        self._len = int(np.prod(dims))
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, rows):
+        start, stop, _ = rows.indices(self._len)
+        return structured_order(self.dims, start, stop)
+
+
+class SpooledArray(object):
+    """An array appended by rows to a temporary file
+
+    It can be read back by slices of rows, e.g. by write_vtk, or by arrays
+    of rows, gathered through a memory map of the file.
+
+    Parameters
+    ----------
+    n_components : int | None
+        The number of columns, None for a 1D array.
+    dtype : str
+        The little endian float type of the file.
+    """
+    def __init__(self, n_components=None, dtype='<f8'):
+        self.n_components = n_components
+        self.ndim = 1 if n_components is None else 2
+        self.dtype = np.dtype(dtype)
+        self._size = 1 if n_components is None else n_components
+        self._file = tempfile.TemporaryFile()
+        self._len = 0
+
+    def append(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype)
+        self._file.seek(0, 2)
+        self._file.write(rows.tobytes())
+        self._len += len(rows)
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def shape(self):
+        if self.n_components is None:
+            return (self._len,)
+        return (self._len, self.n_components)
+
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice):
+            rows = np.asarray(rows, dtype=np.intp)
+            if not len(rows) or not self._len:
+                return np.zeros((0,) + self.shape[1:], self.dtype)[rows]
+            self._file.flush()
+            values = np.memmap(self._file, dtype=self.dtype, mode='r',
+                               shape=self.shape)
+            try:
+                return np.array(values[rows])
+            finally:
+                del values
+        start, stop, step = rows.indices(self._len)
+        if step != 1:
+            raise IndexError('Only contiguous rows can be read')
+        self._file.seek(self.dtype.itemsize * self._size * start)
+        values = np.fromfile(self._file, dtype=self.dtype,
+                             count=self._size * max(0, stop - start))
+        return values.reshape((-1,) + self.shape[1:])
+
+    def close(self):
+        self._file.close()
+
+
+class VTKStreamWriter(object):
+    """write_vtk from points and point arrays appended chunk by chunk
+
+    The chunks are spooled to temporary files, and the file is written by
+    write_vtk when the writer is closed, with the same bytes as if all the
+    points had been given at once. The spooling costs disk I/O: every value
+    is written to the spool, read back and written again to the file. The
+    spools are float32 for binary files (as the file) and float64 for ASCII
+    files.
+
+    Parameters
+    ----------
+    fname : str
+        The file, see write_vtk.
+    reorder : bool
+        If True, the points of the structured grid dims are appended in the
+        order of its storage (z fastest), e.g. reading memory-mapped arrays
+        of the grid sequentially, and the spools are read in the VTK order
+        of structured_order(dims) when the file is written. Else the points
+        are appended in the final (VTK) order.
+    **kwargs
+        The other arguments of write_vtk (dims, binary, title, chunk_size).
+    """
+    def __init__(self, fname, reorder=False, **kwargs):
+        if reorder and kwargs.get('dims') is None:
+            raise ValueError('Reordering needs the grid dimensions')
+        self.fname = fname
+        self.reorder = reorder
+        self.kwargs = kwargs
+        binary = kwargs.get('binary', True) or not fname.endswith('.vtk')
+        self.dtype = '<f4' if binary else '<f8'
+        self.points = SpooledArray(3, self.dtype)
+        self.point_data = None
+
+    def append(self, points, point_data=()):
+        point_data = OrderedDict(point_data)
+        if self.point_data is None:
+            self.point_data = OrderedDict(
+                (name, SpooledArray(None if np.ndim(array) == 1 else
+                                    np.shape(array)[1], self.dtype))
+                for name, array in point_data.items())
+        for name, array in point_data.items():
+            self.point_data[name].append(array)
+        self.points.append(np.reshape(points, (-1, 3)))
+
+    def close(self, write=True):
+        """Write the file (unless write is False) and remove the spools"""
+        point_data = self.point_data if self.point_data is not None else ()
+        try:
+            if write:
+                order = _StructuredOrder(self.kwargs['dims']) \
+                    if self.reorder else None
+                write_vtk(self.fname, self.points, point_data, order=order,
+                          **self.kwargs)
+        finally:
+            self.points.close()
+            for array in dict(point_data).values():
+                array.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(write=exc_type is None)
@@ -1,8 +1,20 @@
 #!/usr/bin/python
+import csv
+import functools
+import json
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy
+import os
 import re
-import scipy.io
+import scipy.linalg
 import scipy.optimize
+import scipy.sparse
+import sys
+import time
+import warnings
+
+from .om_vtk_writer import VTKStreamWriter, structured_order, write_vtk
 
 alpha=.1   
 #For partial differences. Let x1 and x2 be consecutive x values of grid points.
@@ -12,43 +24,163 @@ alpha=.1
 conductivity=.0006
 #This constant should be changed to match your model!
 
+BinaryVTK=True
+#The legacy .vtk files are written in binary, which is much smaller and faster than ASCII.
+
+GridChunkSize=2**20
+#Number of grid points generated and written at once by SaveGridFiles and SaveCubicGrid.
+
+FieldChunkSize=65536
+#Number of grid points whose fields are computed and written at once by SaveFieldsVTK.
+
+SymmetricalCuffs=False
+#The outer cuffs are at the same distance of the central one, so that exchanging them (Mirror type 3)
+#is a symmetry of the electrodes, used by SymmetricalImages and the MultiStart merging of optima.
+
+BatchBytes=64*2**20
+#Memory bound of one chunk of grid points in the batched metrics (BatchMetrics): its fields and the
+#temporaries of the metrics, see BatchChunkSize.  The masks and weights of the grid come in addition.
+
+ActiveTrace=None
+#The OptimizationTrace of the running optimization, to which the Timed functions add their time.
+
+def Timed(category):
+    #Decorator adding the time spent in the function to ActiveTrace.Times[category] while an
+    #optimization is traced.  Only the outermost Timed call is counted.
+    def decorator(function):
+        @functools.wraps(function)
+        def timed(*args,**kwargs):
+            trace=ActiveTrace
+            if trace is None or trace.Timing:
+                return function(*args,**kwargs)
+            trace.Timing=True
+            t0=time.perf_counter()
+            try:
+                return function(*args,**kwargs)
+            finally:
+                trace.Times[category]+=time.perf_counter()-t0
+                trace.Timing=False
+        return timed
+    return decorator
+
 def GenerateCubicGrid(xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz):
     if(xmin>xmax or nx<=0 or ymin>ymax or ny<=0 or zmin>zmax or nz<=0):
-        print "Bad Arguments to MakeCubicGrid"
+        print("Bad Arguments to MakeCubicGrid")
         return
-    return numpy.resize(GenerateMGrid(xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz),(nx*ny*nz,3))
+    return numpy.asarray(CubicGridPoints(xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz))
 def GenerateMGrid(xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz):
     if(xmin>xmax or nx<=0 or ymin>ymax or ny<=0 or zmin>zmax or nz<=0):
-        print "Bad Arguments to MakeCubicGrid"
+        print("Bad Arguments to MakeCubicGrid")
         return
     return numpy.mgrid[xmin:xmax:1j*nx,ymin:ymax:1j*ny,zmin:zmax:1j*nz].swapaxes(0,1).swapaxes(1,2).swapaxes(2,3)
 def CubicGridToMGrid(grid,nx,ny,nz):
     return numpy.resize(grid,(nx,ny,nz,3))
-def SaveCubicGrid(grid,filename):
+
+class CubicGridPoints:
+    #The points of GenerateCubicGrid (z fastest), or of its shifted grids (Shifted, as CreateDGrid
+    #and CreateNegDGrid), computed on demand from the coordinates along each axis: only the rows
+    #which are indexed (a slice or indices) are built, so a grid of any size can be written chunk
+    #by chunk (SaveCubicGrid, write_vtk).  InVTKOrder gives the points with x fastest, the order of
+    #VTK structured grids.  numpy.asarray gives all the points.
+    def __init__(self,xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz):
+        self.Axes=[numpy.mgrid[xmin:xmax:1j*nx],numpy.mgrid[ymin:ymax:1j*ny],numpy.mgrid[zmin:zmax:1j*nz]]
+        self.Dimensions=(nx,ny,nz)
+        self.Bounds=tuple((float(a.min()),float(a.max())) for a in self.Axes)
+        self.Spacing=[GetGridSpacing(a) if len(a)>1 else 0. for a in self.Axes]
+        self.shape=(nx*ny*nz,3)
+        self.ndim=2
+        self.dtype=numpy.dtype(float)
+        self.Fastest=2
+        self.Shift=None
+    def Copy(self,**changes):
+        points=CubicGridPoints.__new__(CubicGridPoints)
+        points.__dict__.update(self.__dict__)
+        points.__dict__.update(changes)
+        return points
+    def Shifted(self,index,sign=1):
+        #The grid of CreateDGrid(grid,index) (sign 1) or CreateNegDGrid(grid,index) (sign -1)
+        return self.Copy(Shift=(index,sign,alpha*self.Spacing[index]))
+    def InVTKOrder(self):
+        return self.Copy(Fastest=0)
+    def __len__(self):
+        return self.shape[0]
+    def __getitem__(self,index):
+        if isinstance(index,tuple):
+            return self[index[0]][(slice(None),)+tuple(index[1:])]
+        if isinstance(index,slice):
+            ids=numpy.arange(*index.indices(len(self)))
+        else:
+            ids=numpy.asarray(index)
+            if ids.ndim==0:
+                return self[ids.reshape(1)][0]
+        nx,ny,nz=self.Dimensions
+        if self.Fastest==2:
+            i,j,k=numpy.unravel_index(ids,(nx,ny,nz))
+        else:
+            k,j,i=numpy.unravel_index(ids,(nz,ny,nx))
+        points=numpy.column_stack((self.Axes[0][i],self.Axes[1][j],self.Axes[2][k]))
+        if self.Shift is not None:
+            index,sign,delta=self.Shift
+            if sign>0:
+                points[:,index]=points[:,index]+delta
+            else:
+                points[:,index]=points[:,index]-delta
+        return points
+    def __array__(self,dtype=None,copy=None):
+        return numpy.asarray(self[0:len(self)],dtype=dtype)
+
+def SaveCubicGrid(grid,filename,chunk=None):
+    #Text (read by LoadCubicGrid with numpy.loadtxt), or .npy if filename ends with ".npy".  The grid
+    #(an array or CubicGridPoints) is written chunk points at a time, with the same bytes.
+    if chunk is None:
+        chunk=GridChunkSize
+    n=len(grid)
+    if filename.endswith(".npy"):
+        #written with the file, not memory-mapped, so that the written pages are not kept in memory
+        file=open(filename,'wb')
+        numpy.lib.format.write_array_header_1_0(file,{'descr':'<f8','fortran_order':False,'shape':(n,3)})
+        for start in range(0,n,chunk):
+            file.write(numpy.ascontiguousarray(grid[start:start+chunk],dtype='<f8').tobytes())
+        file.close()
+        return
     file=open(filename,'w')
-    scipy.io.write_array(file,grid)
+    for start in range(0,n,chunk):
+        numpy.savetxt(file,grid[start:start+chunk])
     file.close()
 def LoadCubicGrid(filename):
-    file=open(filename,'r')
-    return scipy.io.read_array(file)
-def SaveGridFiles(xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz,dir,name):
-    y=re.compile('/\Z')
+    #A .npy grid is memory-mapped, read only
+    if filename.endswith(".npy"):
+        return numpy.load(filename,mmap_mode="r")
+    return numpy.loadtxt(filename,ndmin=2)
+def SaveGridFiles(xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz,dir,name,shifted=True,binary=False,chunk=None):
+    #With shifted=False the dx, dy, dz and -dz grids are not saved: the gain of the grid alone is
+    #enough for a workspace with stencil=True (see StencilGains).
+    #The grids are generated and written chunk by chunk (GridChunkSize points), so the memory does not
+    #depend on the size of the grid.  With binary=True they are saved as .npy files (name.npy,
+    #namedx.npy...) instead of text.
+    y=re.compile(r'/\Z')
     if(y.match(dir) is None):
         dir=dir+"/"
     if(xmin>xmax or nx<=0 or ymin>ymax or ny<=0 or zmin>zmax or nz<=0):
-        print "Bad Arguments to MakeCubicGrid"
+        print("Bad Arguments to MakeCubicGrid")
         return
-    grid=GenerateCubicGrid(xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz)
-    SaveCubicGrid(grid,dir+name)
-    SaveCubicGrid(CreateDGrid(grid,0),dir+name+"dx")
-    SaveCubicGrid(CreateDGrid(grid,1),dir+name+"dy")
-    SaveCubicGrid(CreateDGrid(grid,2),dir+name+"dz")
-    SaveCubicGrid(CreateNegDGrid(grid,2),dir+name+"-dz")
-    SaveGridVTK(grid,nx,ny,nz,dir+name+".vtk")
+    if chunk is None:
+        chunk=GridChunkSize
+    ext=".npy" if binary else ""
+    grid=CubicGridPoints(xmin,xmax,nx,ymin,ymax,ny,zmin,zmax,nz)
+    SaveCubicGrid(grid,dir+name+ext,chunk)
+    SaveGridHeader(grid,GridHeaderFileName(dir+name))
+    if shifted:
+        SaveCubicGrid(grid.Shifted(0),dir+name+"dx"+ext,chunk)
+        SaveCubicGrid(grid.Shifted(1),dir+name+"dy"+ext,chunk)
+        SaveCubicGrid(grid.Shifted(2),dir+name+"dz"+ext,chunk)
+        SaveCubicGrid(grid.Shifted(2,-1),dir+name+"-dz"+ext,chunk)
+    #as SaveGridVTK, without the permutation of all points
+    write_vtk(dir+name+".vtk",grid.InVTKOrder(),dims=(nx,ny,nz),binary=BinaryVTK,chunk_size=chunk)
     
 def CreateDGrid(grid,index):
     if(index not in set([0,1,2])):
-        print "Index must be 0,1, or 2\n"
+        print("Index must be 0,1, or 2\n")
         sys.exit()
     delta=GetGridSpacing(grid[:,index])
     tileunit=[0,0,0]
@@ -57,7 +189,7 @@ def CreateDGrid(grid,index):
     return grid+alpha*delta*vec
 def CreateNegDGrid(grid,index):
     if(index not in set([0,1,2])):
-        print "Index must be 0,1, or 2\n"
+        print("Index must be 0,1, or 2\n")
         sys.exit()
     delta=GetGridSpacing(grid[:,index])
     tileunit=[0,0,0]
@@ -66,7 +198,6 @@ def CreateNegDGrid(grid,index):
     return grid-alpha*delta*vec
 def SaveInjVTK(inj,filename):
     #Saves a VTK file with 12 glyphs representing injected current.  Locations are hardwired.
-    file=open(filename,'w')
     N=12
     locations=numpy.array([
        [  1.11    ,   0.00    ,  -6.00    ],
@@ -81,74 +212,87 @@ def SaveInjVTK(inj,filename):
        [  0.00    ,   1.11    ,   6.00    ],
        [ -1.11    ,   0.00    ,   6.00    ],
        [  0.00    ,  -1.11    ,   6.00    ]])
-    file.write("# vtk DataFile Version 2.0\n")
-    file.write(filename+"\n")
-    file.write("ASCII\n")
-    file.write("DATASET POLYDATA\n")
-    file.write("POINTS "+str(N)+" float\n")    
-    scipy.io.write_array(file,locations,keep_open=True)
-    file.write("POINT_DATA "+str(N)+"\n")
-    file.write("SCALARS Injected_Current float 1\n")
-    file.write("LOOKUP_TABLE default\n")
-    scipy.io.write_array(file,inj)
-    file.close()
+    write_vtk(filename,locations[0:N],[("Injected_Current",numpy.asarray(inj,float))],binary=BinaryVTK)
 def SaveGridVTK(grid,nx,ny,nz,filename):
-    file=open(filename,'w')
-    file.write("# vtk DataFile Version 2.0\n")
-    file.write(filename+"\n")
-    file.write("ASCII\n")
-    file.write("DATASET STRUCTURED_GRID\n")
-    file.write("DIMENSIONS "+str(nx)+" "+str(ny)+" "+str(nz)+"\n")
-    file.write("POINTS "+str(nx*ny*nz)+" float\n")    
-    scipy.io.write_array(file,grid.reshape((nx,ny,nz,3)).reshape((nx*ny*nz,3),order="F"))
-    file.close()
+    #The grid points are stored with z fastest, VTK wants x fastest
+    write_vtk(filename,grid,dims=(nx,ny,nz),order=structured_order((nx,ny,nz)),binary=BinaryVTK)
 def SavePolyVTK(grid,N,filename):
-    file=open(filename,'w')
-    file.write("# vtk DataFile Version 2.0\n")
-    file.write(filename+"\n")
-    file.write("ASCII\n")
-    file.write("DATASET POLYDATA\n")
-    file.write("POINTS "+str(N)+" float\n")    
-    scipy.io.write_array(file,grid.reshape((N,3),order="F"))
-    file.close()
+    write_vtk(filename,grid[0:N],binary=BinaryVTK)
 def SaveTrimmedFieldVTK(gridxyz,field,filename,FieldName,epsilon):
     #Careful.  This function requires the field as a rank 2 array (that is, a matrix)
     #This way a scalar field is written as a vector field of 1 component vectors
     #In particular, it allows the same framework to apply to both potential and current
-    m=len(field.transpose())
-    indices=numpy.where(numpy.apply_along_axis(numpy.linalg.norm,1,field)>epsilon)
-    N=numpy.size(indices)
-    tempgrid=numpy.array(gridxyz[indices])
-    tempfield=numpy.array(field[indices])
-    
-    SavePolyVTK(tempgrid,N,filename)
-    file=open(filename,'a')
-    file.write("POINT_DATA "+str(N)+"\n")
-    if(m==1):
-        file.write("SCALARS "+FieldName+" float 1\n")
-        file.write("LOOKUP_TABLE default\n")
-    else:
-        file.write("VECTORS "+FieldName+" float\n")
-    
-    scipy.io.write_array(file,tempfield.reshape((N,m),order="F"))
-def SaveFieldsVTK(inj,geom,grid,gains,fileprefix):
+    indices=numpy.flatnonzero(numpy.sqrt(RowDot(field,field))>epsilon)
+    write_vtk(filename,gridxyz[indices],[(FieldName,field[indices])],binary=BinaryVTK)
+def SaveFieldsVTK(inj,geom,grid,gains,fileprefix,ext=None,chunk=None):
     #Saves a bunch of VTK files for visualization.
     #Ie current, current magnitude, potential
-    pot,cur=GetPotentialAndCurrent(inj,geom,grid,gains)
-    curmagn=GetCurrentMagnitude(cur)
+    #With ext (".vtk", ".vtu" or ".vts"), all of them are saved in one file fileprefix+"_fields"+ext
+    #instead, as the named arrays Potential, Current and Current_Magnitude (trimmed to the nerve)
+    #and the Nerve and Focus masks.  The full cubic grid is saved as a structured grid (except in .vtu
+    #files), a compacted grid (of a workspace) as points, which .vts files do not allow.
+    #The grid is processed chunk points at a time (FieldChunkSize), in the order of the gains (contiguous
+    #rows, so memory-mapped gains are read once, sequentially): the fields, masks and thresholded points of
+    #a chunk are appended to all the files at once, so the memory does not depend on the size of the grid.
+    #The files are spooled (VTKStreamWriter) and written when complete, in the VTK order (x fastest) for a
+    #structured grid: it costs a temporary copy on disk of each output.
+    if chunk is None:
+        chunk=FieldChunkSize
     epsilon=1e-7
     SaveInjVTK(inj,fileprefix+"_inj.vtk")
     
-    SaveTrimmedFieldVTK(grid,TrimFieldNerve(geom,grid,curmagn),fileprefix+"_cmag_nerve.vtk","Current_Magnitude",epsilon)
-    SaveTrimmedFieldVTK(grid, TrimFieldFocus(geom,grid,curmagn),fileprefix+"_cmag_focus.vtk","Current_Magnitude",epsilon)
-    SaveTrimmedFieldVTK(grid, TrimFieldNerve(geom,grid,cur),fileprefix+"_cur_nerve.vtk","Current",epsilon)
-    SaveTrimmedFieldVTK(grid, TrimFieldNerve(geom,grid,pot),fileprefix+"_pot_nerve.vtk","Potential",epsilon)
-    SaveTrimmedFieldVTK(grid, TrimFieldFocus(geom,grid,cur),fileprefix+"_cur_focus.vtk","Current_Focus",epsilon)
+    dxdydz=GetFiniteDifferenceDxDyDz(grid)
+    dims=None
+    if ext is not None:
+        dims=GetDimensions(grid)
+        if ext==".vtu" or numpy.prod(dims)!=len(grid):
+            dims=None
+        writers=[VTKStreamWriter(fileprefix+"_fields"+ext,reorder=dims is not None,dims=dims,binary=BinaryVTK)]
+    else:
+        #(file suffix, mask, field, array name) of the trimmed fields
+        outputs=[("_cmag_nerve.vtk","nerve","curmagn","Current_Magnitude"),
+                 ("_cmag_focus.vtk","focus","curmagn","Current_Magnitude"),
+                 ("_cur_nerve.vtk","nerve","cur","Current"),
+                 ("_pot_nerve.vtk","nerve","pot","Potential"),
+                 ("_cur_focus.vtk","focus","cur","Current_Focus")]
+        writers=[VTKStreamWriter(fileprefix+suffix,binary=BinaryVTK) for suffix,_,_,_ in outputs]
+    try:
+        for start in range(0,len(grid),chunk):
+            rows=slice(start,start+chunk)
+            points=numpy.asarray(grid[rows])
+            pot,cur=PotentialAndCurrentFromFields(ChunkFields(inj,gains,rows),dxdydz)
+            chunkfields=dict(pot=pot,cur=cur,curmagn=GetCurrentMagnitude(cur))
+            masks=dict(nerve=InsideNerveMask(geom,points),focus=NearFocusMask(geom,points))
+            if ext is not None:
+                nerve=masks["nerve"]
+                writers[0].append(points,[("Potential",ApplyMask(nerve,pot)),("Current",ApplyMask(nerve,cur)),
+                                          ("Current_Magnitude",ApplyMask(nerve,chunkfields["curmagn"])),
+                                          ("Nerve",nerve),("Focus",masks["focus"])])
+                continue
+            for writer,(_,mask,field,name) in zip(writers,outputs):
+                #as SaveTrimmedFieldVTK
+                field=ApplyMask(masks[mask],chunkfields[field])
+                indices=numpy.flatnonzero(numpy.sqrt(RowDot(field,field))>epsilon)
+                writer.append(points[indices],[(name,field[indices])])
+    except BaseException:
+        for writer in writers:
+            writer.close(write=False)
+        raise
+    for writer in writers:
+        writer.close()
     
     #SaveTrimmedFieldVTK(grid, TrimFieldCore(geom,grid,curmagn),fileprefix+"_cmag_core.vtk")
     #SaveTrimmedFieldVTK(grid, TrimFieldCore(geom,grid,cur),fileprefix+"_cur_core.vtk")    
+def ChunkFields(inj,gains,rows):
+    #The fields of the first four gains (potential and currents) at some rows of the grid only
+    gains=BatchGains(gains)
+    if isinstance(gains,StencilGains):
+        return gains[0:4].BatchFields(rows,numpy.reshape(inj,(-1,1)))[:,:,0]
+    return StackedProduct(gains[0:4,rows],inj)
 def GetDimensions(grid):
     #Get the number of grid points in each dimension of the grid
+    if GridGeometry(grid) is not None and grid.IsFull():
+        return grid.Dimensions
     nx=Get1Dimension(grid[:,0])
     ny=Get1Dimension(grid[:,1])
     nz=Get1Dimension(grid[:,2])
@@ -157,32 +301,390 @@ def Get1Dimension(x):
     M=max(x)
     m=min(x)
     return int(round(1+(M-m)/GetGridSpacing(x)))
-def LoadGain(geom,grid,filename):
+GainSuffixes=["","dx","dy","dz","-dz"]
+def ReadGainMatrix(filename):
+    #.npy and OpenMEEG binary (.bin) matrices are memory-mapped, read only.  The OpenMEEG binary
+    #format is two uint32 (the number of lines and columns) then the float64 values, column major.
+    if filename.endswith(".npy"):
+        return numpy.load(filename,mmap_mode="r")
+    if filename.endswith(".bin"):
+        header=numpy.fromfile(filename,dtype=numpy.uint32,count=2)
+        if len(header)!=2:
+            raise ValueError("Not an OpenMEEG binary matrix : "+filename)
+        return numpy.memmap(filename,dtype=numpy.float64,mode="r",offset=8,
+                            shape=(int(header[0]),int(header[1])),order="F")
+    return numpy.loadtxt(filename,ndmin=2)
+def GainFileName(fileprefix,suffix):
+    #The binary gain file if there is one, else the text .gain file
+    if os.path.exists(fileprefix+suffix+".bin"):
+        return fileprefix+suffix+".bin"
+    return fileprefix+suffix+".gain"
+def LoadGain(geom,grid,filename,rows=None):
     #Loads Gain matrix, then uses grid information to zero out all gain elements corresponding to 
     #grid locations outside the nerve.  We do this because solver gives undefined results outside nerve.
-    return TrimFieldNerve(geom,grid,scipy.io.read_array(filename))
-    #return scipy.io.read_array(filename)
-def LoadGains(geom,grid,fileprefix):
+    #If rows (the grid points inside the nerve) is given, only these rows are kept instead.
+    gain=ReadGainMatrix(filename)
+    if rows is not None:
+        return gain[rows]
+    return TrimFieldNerve(geom,grid,gain)
+def LoadGains(geom,grid,fileprefix,rows=None):
     #fileprefix has form like "/somewhere/nerve1.mycut"
-    gain=LoadGain(geom, grid,fileprefix+".gain")
-    gaindx=LoadGain(geom, grid,fileprefix+"dx.gain")
-    gaindy=LoadGain(geom, grid,fileprefix+"dy.gain")
-    gaindz=LoadGain(geom, grid,fileprefix+"dz.gain")
-    gainminusdz=LoadGain(geom, grid,fileprefix+"-dz.gain")
-    return gain,gaindx,gaindy,gaindz,gainminusdz
-def GetPotentialAndCurrent(inj,geom,grid,gains):
-    [dx,dy,dz]=GetFiniteDifferenceDxDyDz(grid)
-    pot=numpy.dot(gains[0],inj)
-    curx=-conductivity*(numpy.dot(gains[1],inj)-pot)/dx
-    cury=-conductivity*(numpy.dot(gains[2],inj)-pot)/dy
-    curz=-conductivity*(numpy.dot(gains[3],inj)-pot)/dz
+    return tuple(LoadStackedGains(geom,grid,fileprefix,rows))
+def LoadStackedGains(geom,grid,fileprefix,rows=None):
+    #The five gains as one (5,len(grid),n_electrodes) array, with the rows outside the nerve set
+    #to zero, or only the rows inside the nerve if given.
+    #If the gains were converted with ConvertGains, fileprefix+".gains.npy" is memory-mapped.  It
+    #holds the rows of fileprefix+".gains.rows.npy" only: when these are the rows asked for (the
+    #workspace of the same geometry) the memmap is returned as is, without a copy, and only the
+    #pages used are read.  Other rows are copied from it (zero outside the stored rows).
+    #Else the gain files are read one by one into the stacked array, without a second copy for
+    #stacking: the rows are gathered from all the file, convert the gains once to avoid it.
+    if os.path.exists(fileprefix+".gains.npy"):
+        gains=numpy.load(fileprefix+".gains.npy",mmap_mode="r")
+        if os.path.exists(fileprefix+".gains.rows.npy"):
+            stored=numpy.load(fileprefix+".gains.rows.npy")
+        else:
+            stored=numpy.arange(len(grid)) #stores of the full grid
+        if rows is None:
+            rows=numpy.arange(len(grid))
+        if len(rows)==len(stored) and numpy.array_equal(rows,stored):
+            return gains
+        #fallback: copy the rows asked for from the stored ones
+        index=numpy.searchsorted(stored,rows)
+        found=index<len(stored)
+        found[found]=stored[index[found]]==rows[found]
+        copied=numpy.zeros((len(gains),len(rows),gains.shape[-1]))
+        copied[:,found]=gains[:,index[found]]
+        return copied
+    gains=None
+    for k,suffix in enumerate(GainSuffixes):
+        gain=LoadGain(geom,grid,GainFileName(fileprefix,suffix),rows)
+        if gains is None:
+            gains=numpy.empty((len(GainSuffixes),)+gain.shape)
+        gains[k]=gain
+    return gains
+def ConvertGains(geom,grid,fileprefix):
+    #One-time conversion of the five gain files (text or OpenMEEG binary) to fileprefix+".gains.npy",
+    #read with memory mapping by LoadStackedGains.  Only the rows of the grid points inside the
+    #nerve of geom are stored, the workspace compacts the gains to them, and the rows are saved in
+    #fileprefix+".gains.rows.npy".  The gains are written one at a time, so only one gain is in
+    #memory at once.
+    filename=fileprefix+".gains.npy"
+    rows=numpy.flatnonzero(InsideNerveMask(geom,grid))
+    gains=None
+    for k,suffix in enumerate(GainSuffixes):
+        gain=LoadGain(geom,grid,GainFileName(fileprefix,suffix),rows)
+        if gains is None:
+            gains=numpy.lib.format.open_memmap(filename+".tmp",mode="w+",dtype=numpy.float64,
+                                               shape=(len(GainSuffixes),)+gain.shape)
+        gains[k]=gain
+        del gain
+    gains.flush()
+    del gains
+    numpy.save(fileprefix+".gains.rows.npy",rows)
+    os.rename(filename+".tmp",filename)
+    return filename
+def GetFields(inj,grid,gains):
+    #The fields of all gains, shape (len(gains),len(grid)): gains[k] times inj for all k.
+    #gains can be a FieldCache, then the product is only done once per injection.
+    if isinstance(gains,FieldCache):
+        return gains.Fields(inj)
+    return StackedProduct(gains,inj)
+@Timed('Products')
+def StackedProduct(gains,inj):
+    #The gains are stacked as one (len(gains)*len(grid),n_electrodes) matrix: one product instead of one per gain
+    if isinstance(gains,StencilGains):
+        return gains.Fields(inj)
+    stacked=numpy.reshape(gains,(-1,numpy.shape(gains)[-1]))
+    return numpy.dot(stacked,inj).reshape(len(gains),-1)
+def PotentialAndCurrentFromFields(fields,dxdydz):
+    [dx,dy,dz]=dxdydz
+    pot=fields[0]
+    curx=-conductivity*(fields[1]-pot)/dx
+    cury=-conductivity*(fields[2]-pot)/dy
+    curz=-conductivity*(fields[3]-pot)/dz
     return numpy.transpose(numpy.array([pot])),numpy.transpose(numpy.array([curx,cury,curz]))
-def GetActivationFunction(inj,geom,grid,gains):
-    [dx,dy,dz]=GetFiniteDifferenceDxDyDz(grid)
-    activation=numpy.dot(gains[3]+gains[4]-2*gains[0],inj)/(dz*dz)
+def ActivationFunctionFromFields(fields,dxdydz):
+    dz=dxdydz[2]
+    activation=(fields[3]+fields[4]-2*fields[0])/(dz*dz)
     return numpy.transpose(numpy.array([activation]))
+def GetPotentialAndCurrent(inj,geom,grid,gains):
+    if isinstance(gains,FieldCache):
+        return gains.PotentialAndCurrent(inj)
+    return PotentialAndCurrentFromFields(StackedProduct(gains[0:4],inj),GetFiniteDifferenceDxDyDz(grid))
+def GetActivationFunction(inj,geom,grid,gains):
+    if isinstance(gains,FieldCache):
+        return gains.ActivationFunction(inj)
+    return ActivationFunctionFromFields(StackedProduct(gains,inj),GetFiniteDifferenceDxDyDz(grid))
+
+class FieldCache:
+    #Memoizes the fields of the last injection, shared by all the metric functions.
+    #f_Phi, f_Chi, f_Omega and f_Ksi call PhiN and then PhiC/Chi/Omega/Ksi with the same injection:
+    #the gain products are done once for both.  The fields do not depend on geom (only the
+    #metrics do, through the masks and weights), so the cache is keyed on inj only.
+    #It can be passed to the metric functions in place of the gains.
+    def __init__(self,grid,gains):
+        self.grid=grid
+        self.gains=gains
+        self.NumberOfGains=len(gains)
+        self.NumberOfElectrodes=numpy.shape(gains)[-1]
+        self.dxdydz=GetFiniteDifferenceDxDyDz(grid)
+        self.masks=RegionMasks(grid)
+        self.key=None
+        self.derived={}
+        self.products=0 #number of stacked products done
+        self.hits=0 #number of calls served from the cache
+        self.adjoints=0 #number of transposed products done, one per gradient
+    def __len__(self):
+        return self.NumberOfGains
+    def __getitem__(self,index):
+        return self.gains[index]
+    def Fields(self,inj):
+        key=numpy.asarray(inj,float).tobytes()
+        if key==self.key:
+            self.hits+=1
+            return self.values
+        self.values=StackedProduct(self.gains,inj)
+        self.key=key
+        self.derived={}
+        self.products+=1
+        return self.values
+    def PotentialAndCurrent(self,inj):
+        fields=self.Fields(inj)
+        if 'pot_cur' not in self.derived:
+            self.derived['pot_cur']=PotentialAndCurrentFromFields(fields,self.dxdydz)
+        return self.derived['pot_cur']
+    def ActivationFunction(self,inj):
+        fields=self.Fields(inj)
+        if 'activation' not in self.derived:
+            self.derived['activation']=ActivationFunctionFromFields(fields,self.dxdydz)
+        return self.derived['activation']
+    def AdjointProduct(self,u):
+        self.adjoints+=1
+        return StackedAdjointProduct(self.gains,u)
+    def FlopsPerProduct(self):
+        #multiply-adds of one stacked product, the cost of an evaluation with a new injection
+        return 2*self.NumberOfGains*len(self.grid)*self.NumberOfElectrodes
+class StencilGains:
+    #The five gains of a cubic grid (as LoadStackedGains) from the gain of the grid alone.
+    #The gains of the shifted grids (dx, dy, dz and -dz) are replaced by their Taylor expansion
+    #from the grid-neighbor derivatives of the base gain:
+    #  gains[1]=gain+dx*Dx(gain), gains[2]=gain+dy*Dy(gain),
+    #  gains[3]=gain+dz*Dz(gain)+dz**2/2*Dzz(gain), gains[4]=gain-dz*Dz(gain)+dz**2/2*Dzz(gain)
+    #with dx,dy,dz from GetFiniteDifferenceDxDyDz, so that the currents are -conductivity times the
+    #derivatives of the potential and the activation function is Dzz of the potential.
+    #The derivatives are central differences between the neighbors of the (nx,ny,nz) layout of
+    #GenerateCubicGrid (z fastest), one-sided next to the points outside the grid or not in rows.
+    #The rows with neither a central nor a one-sided second difference along z (fewer than three
+    #consecutive rows along z) have no Dzz: their activation function is 0.  They are reported in
+    #NoDzz (the rows of base), with a warning.
+    #Only the base gain is stored: the fields of an injection cost one product instead of five,
+    #and the stencils are applied to the fields.  An int index gives one gain as an array, and a
+    #tuple (gains,rows[,electrodes]) only these rows of the gains, as the arrays would.
+    def __init__(self,grid,rows,base,operators=None,gainindices=None):
+        #grid: the full cubic grid, rows: the rows of grid kept in base (e.g. NerveRows)
+        #operators: the (Operators,NoDzz) of StencilOperators
+        self.Base=base
+        self.Operators,self.NoDzz=StencilOperators(grid,rows) if operators is None else operators
+        if operators is None and len(self.NoDzz):
+            warnings.warn("%d rows without a second difference along z: their activation function is 0"%len(self.NoDzz))
+        self.GainIndices=list(range(len(self.Operators))) if gainindices is None else gainindices
+        self.shape=(len(self.GainIndices),)+numpy.shape(base)
+        self.ndim=3
+        self.dtype=numpy.dtype(float)
+    def WithBase(self,base):
+        return StencilGains(None,None,base,(self.Operators,self.NoDzz),self.GainIndices)
+    def __len__(self):
+        return len(self.GainIndices)
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return StencilGains(None,None,self.Base,(self.Operators,self.NoDzz),self.GainIndices[index])
+        if isinstance(index,tuple):
+            if len(index) not in (2,3) or any(i is Ellipsis or i is None for i in index):
+                raise TypeError("StencilGains index must be (gains,rows[,electrodes]), not %r"%(index,))
+            return self.Rows(*index)
+        return self.Operators[self.GainIndices[index]].dot(self.Base)
+    def Rows(self,gains,rows,electrodes=slice(None)):
+        #gains[gains,rows,electrodes] from the stencils of the rows only
+        def Gain(k):
+            if numpy.ndim(rows)==0 and not isinstance(rows,slice):
+                return self.Operators[k][[rows]].dot(self.Base)[0,electrodes]
+            return self.Operators[k][rows].dot(self.Base)[:,electrodes]
+        if isinstance(gains,slice):
+            return numpy.array([Gain(k) for k in self.GainIndices[gains]])
+        return Gain(self.GainIndices[gains])
+    def __array__(self,dtype=None,copy=None):
+        return numpy.array([self[k] for k in range(len(self))],dtype=dtype)
+    def Fields(self,inj):
+        #StackedProduct (or StackedBatchProduct for a matrix of injections)
+        pot=numpy.dot(self.Base,inj)
+        return numpy.array([self.Operators[k].dot(pot) for k in self.GainIndices])
+    def BatchFields(self,rows,injs):
+        #The fields of the rows (a slice) only, from the base fields of their neighbors
+        operators=[self.Operators[k][rows] for k in self.GainIndices]
+        needed=numpy.unique(numpy.concatenate([op.indices for op in operators]))
+        pot=numpy.dot(self.Base[needed],injs)
+        return numpy.array([op[:,needed].dot(pot) for op in operators])
+    def AdjointProduct(self,u):
+        #StackedAdjointProduct: sum_k gains[k]^T u[k]=Base^T sum_k Operators[k]^T u[k]
+        v=sum(self.Operators[k].T.dot(u[i]) for i,k in enumerate(self.GainIndices))
+        return numpy.dot(v,self.Base)
+def StencilOperators(grid,rows):
+    #The sparse matrices of the five gains of StencilGains, on the rows of the cubic grid, and the
+    #rows (indices in rows) without a second difference along z
+    dims=GetDimensions(grid)
+    if numpy.prod(dims)!=len(grid):
+        raise ValueError("The stencils need the full cubic grid of GenerateCubicGrid")
+    n=len(rows)
+    compact=-numpy.ones(len(grid),dtype=int)
+    compact[rows]=numpy.arange(n)
+    position=numpy.array(numpy.unravel_index(rows,dims))
+    def Neighbor(axis,step):
+        #The row (in rows) of the neighbor of each row along axis, -1 if there is none
+        p=position.copy()
+        p[axis]+=step
+        inside=(p[axis]>=0)&(p[axis]<dims[axis])
+        neighbor=-numpy.ones(n,dtype=int)
+        neighbor[inside]=compact[numpy.ravel_multi_index(p[:,inside],dims)]
+        return neighbor
+    def Matrix(terms):
+        #terms: (neighbor, coefficient) of each row, coefficients of the rows without neighbor are 0
+        i=numpy.concatenate([numpy.flatnonzero(c!=0) for _,c in terms])
+        j=numpy.concatenate([nb[c!=0] for nb,c in terms])
+        v=numpy.concatenate([c[c!=0] for _,c in terms])
+        return scipy.sparse.csr_matrix((v,(i,j)),shape=(n,n))
+    def D(axis,h):
+        plus,minus=Neighbor(axis,1),Neighbor(axis,-1)
+        both=(plus>=0)&(minus>=0)
+        onlyplus=(plus>=0)&(minus<0)
+        onlyminus=(minus>=0)&(plus<0)
+        self_=numpy.arange(n)
+        return Matrix([(plus,(both*.5+onlyplus)/h),(minus,-(both*.5+onlyminus)/h),
+                       (self_,(onlyminus*1.-onlyplus)/h)])
+    def Dzz(h):
+        plus,minus=Neighbor(2,1),Neighbor(2,-1)
+        plus2,minus2=Neighbor(2,2),Neighbor(2,-2)
+        both=(plus>=0)&(minus>=0)
+        forward=~both&(plus>=0)&(plus2>=0)
+        backward=~both&~forward&(minus>=0)&(minus2>=0)
+        self_=numpy.arange(n)
+        nodzz=numpy.flatnonzero(~(both|forward|backward))
+        return Matrix([(plus,(both-2.*forward)/h**2),(minus,(both-2.*backward)/h**2),
+                       (plus2,forward/h**2),(minus2,backward/h**2),
+                       (self_,(-2.*both+forward+backward)/h**2)]),nodzz
+    h=GetGridDxDyDz(grid)
+    d=GetFiniteDifferenceDxDyDz(grid)
+    I=scipy.sparse.identity(n,format="csr")
+    Dz=D(2,h[2])
+    second,nodzz=Dzz(h[2])
+    second=(d[2]**2/2)*second
+    return [I,(I+d[0]*D(0,h[0])).tocsr(),(I+d[1]*D(1,h[1])).tocsr(),
+            (I+d[2]*Dz+second).tocsr(),(I-d[2]*Dz+second).tocsr()],nodzz
+def StencilErrors(inj,geom,grid,gains,stencilgains=None):
+    #Validation of the stencils against the five gains (on the same grid and rows): the relative
+    #L2 errors of the potential, the currents and the activation function inside the nerve, and the
+    #relative errors of the metrics and objectives.  stencilgains is built from gains[0] if None.
+    if stencilgains is None:
+        stencilgains=StencilGains(grid,numpy.arange(len(grid)),numpy.asarray(gains[0]))
+    nerve=InsideNerveMask(geom,grid)
+    errors={}
+    def Relative(a,b):
+        return numpy.linalg.norm(a-b)/numpy.linalg.norm(b)
+    pot,cur=GetPotentialAndCurrent(inj,geom,grid,gains)
+    spot,scur=GetPotentialAndCurrent(inj,geom,grid,stencilgains)
+    errors['Potential']=Relative(ApplyMask(nerve,spot),ApplyMask(nerve,pot))
+    errors['Current']=Relative(ApplyMask(nerve,scur),ApplyMask(nerve,cur))
+    errors['Activation']=Relative(ApplyMask(nerve,GetActivationFunction(inj,geom,grid,stencilgains)),
+                                  ApplyMask(nerve,GetActivationFunction(inj,geom,grid,gains)))
+    five=BatchMetrics(numpy.reshape(inj,(-1,1)),geom,grid,gains)
+    one=BatchMetrics(numpy.reshape(inj,(-1,1)),geom,grid,stencilgains)
+    for name in sorted(five):
+        errors[name]=abs(one[name][0]-five[name][0])/abs(five[name][0])
+    return errors
+def StencilReport(errors):
+    return "\n".join("%-12s %10.3e"%(name,errors[name]) for name in sorted(errors))
+class Grid(numpy.ndarray):
+    #The (N,3) grid points, as an array, with the geometry of the cubic grid computed once:
+    #Bounds ((xmin,xmax),(ymin,ymax),(zmin,zmax)), Dimensions (nx,ny,nz), Spacing [dx,dy,dz] and
+    #the volume element DV, used by GetGridDxDyDz, GetFiniteDifferenceDxDyDz, GetGridDV and
+    #GetDimensions instead of sorting the grid columns at each call.  They are read from the header
+    #saved by SaveGridFiles (LoadGrid), or computed from the points.  The rows of a Grid (e.g. the
+    #points in the nerve) keep the Spacing and DV, and the Bounds and Dimensions of the full grid.
+    def __new__(cls,points,bounds=None,dimensions=None,spacing=None):
+        grid=numpy.asarray(points,float).view(cls)
+        if spacing is None:
+            spacing=[GetGridSpacing(numpy.asarray(grid[:,i])) for i in range(3)]
+        if bounds is None:
+            bounds=[(float(numpy.min(grid[:,i])),float(numpy.max(grid[:,i]))) for i in range(3)]
+        if dimensions is None:
+            dimensions=[int(round(1+(M-m)/h)) for (m,M),h in zip(bounds,spacing)]
+        grid.Bounds=tuple(tuple(float(x) for x in b) for b in bounds)
+        grid.Dimensions=tuple(int(n) for n in dimensions)
+        grid.Spacing=[float(h) for h in spacing]
+        grid.DV=numpy.prod(grid.Spacing)
+        return grid
+    def __array_finalize__(self,obj):
+        #rows of a grid keep its geometry, other arrays (columns, ufunc results...) have none
+        same=obj is not None and numpy.ndim(self)==2 and numpy.shape(self)[1:]==(3,)
+        for name in ("Bounds","Dimensions","Spacing","DV"):
+            setattr(self,name,getattr(obj,name,None) if same else None)
+    def __array_wrap__(self,array,context=None,return_scalar=False):
+        #grid-x0, grid*2... are plain arrays
+        if return_scalar:
+            return array[()]
+        return numpy.asarray(array)
+    def __reduce__(self):
+        #pickled (e.g. for the MultiStart workers) as the points and the geometry
+        return (Grid,(numpy.asarray(self),self.Bounds,self.Dimensions,self.Spacing))
+    def IsFull(self):
+        #True for all the points of the cubic grid, False for some of its rows
+        return self.Dimensions is not None and numpy.prod(self.Dimensions)==len(self)
+def GridGeometry(grid):
+    #The Grid, or None for an array (or an array without geometry)
+    if isinstance(grid,Grid) and grid.Spacing is not None:
+        return grid
+    return None
+def SaveGridHeader(grid,filename):
+    #The header of a grid file: its bounds, dimensions and spacing, read by LoadGridHeader
+    if not isinstance(grid,CubicGridPoints) and GridGeometry(grid) is None:
+        grid=Grid(grid)
+    file=open(filename,'w')
+    file.write("bounds "+" ".join(repr(float(x)) for b in grid.Bounds for x in b)+"\n")
+    file.write("dimensions "+" ".join(str(n) for n in grid.Dimensions)+"\n")
+    file.write("spacing "+" ".join(repr(float(h)) for h in grid.Spacing)+"\n")
+    file.close()
+def LoadGridHeader(filename):
+    #dict of the bounds, dimensions and spacing, the keyword arguments of Grid
+    header={}
+    for line in open(filename):
+        words=line.split()
+        if words:
+            header[words[0]]=words[1:]
+    return dict(bounds=numpy.reshape([float(x) for x in header["bounds"]],(3,2)),
+                dimensions=[int(n) for n in header["dimensions"]],spacing=[float(h) for h in header["spacing"]])
+def GridHeader(grid):
+    #The keyword arguments of Grid to rebuild grid without computing its geometry
+    return dict(bounds=grid.Bounds,dimensions=grid.Dimensions,spacing=grid.Spacing)
+def GridHeaderFileName(filename):
+    #name.header for the grid file name or name.npy
+    if filename.endswith(".npy"):
+        filename=filename[:-4]
+    return filename+".header"
+def LoadGrid(filename):
+    #LoadCubicGrid as a Grid, with the geometry from the header if there is one
+    points=LoadCubicGrid(filename)
+    if os.path.exists(GridHeaderFileName(filename)):
+        return Grid(points,**LoadGridHeader(GridHeaderFileName(filename)))
+    return Grid(points)
 def GetGridDxDyDz(grid):
+    if GridGeometry(grid) is not None:
+        return list(grid.Spacing)
     return [GetGridSpacing(grid[:,i]) for i in range (3)]
+def GetGridDV(grid):
+    #The volume element dx*dy*dz of the grid
+    if GridGeometry(grid) is not None:
+        return grid.DV
+    return numpy.prod(GetGridDxDyDz(grid))
 def GetGridSpacing(x):
     v=x-x[0]
     v=numpy.unique(abs(v))
@@ -192,19 +694,21 @@ def GetGridSpacing(x):
         return v[0]
 def GetFiniteDifferenceDxDyDz(grid):
     #These are the deltas used to calculate currents from potentials via finite differences and ohms law.
-    return [alpha*GetGridSpacing(grid[:,i]) for i in range (3)]
+    return [alpha*h for h in GetGridDxDyDz(grid)]
 def TrimFieldNerve(geom,grid,field):
     #If grid[i] is outside of the nerve region, we set field[i]=0 (or 0,0,0 for current)
-    newfield=numpy.array([field[i]*IsInsideNerve(grid[i],geom) for i in range(len(field))])
-    return newfield
+    return ApplyMask(InsideNerveMask(geom,grid),field)
 def TrimFieldCore(geom,grid,field):
     #If grid[i] is outside of the core region, we set field[i]=0 (or 0,0,0 for current)
-    newfield=numpy.array([field[i]*IsInsideCore(grid[i],geom) for i in range(len(field))])
-    return newfield
+    return ApplyMask(InsideCoreMask(geom,grid),field)
 def TrimFieldFocus(geom,grid,field):
     #If grid[i] is outside of the focus region, we set field[i]=0 (or 0,0,0 for current)
-    newfield=numpy.array([field[i]*IsNearFocus(grid[i],geom) for i in range(len(field))])
-    return newfield
+    return ApplyMask(NearFocusMask(geom,grid),field)
+@Timed('Masks')
+def ApplyMask(mask,field):
+    #field[i]*mask[i] for all grid points, whatever the number of components of the field
+    field=numpy.asarray(field)
+    return field*numpy.reshape(mask,(-1,)+(1,)*(field.ndim-1))
 def IsNearFocus(x,geom):
     x0=geom[2,0:3]
     r=geom[2,6]
@@ -235,9 +739,63 @@ def IsInsideCore(x,geom):
         return float(True)
     else:
         return float(False)
-    
+@Timed('Masks')
+def InsideCylinderMask(row,grid):
+    #Vectorized IsInsideNerve/IsInsideCore for a geometry row [x,y,z,l,r,*,*]:
+    #1. for the grid points inside the cylinder, 0. elsewhere
+    d=grid[:,0:2]-row[0:2]
+    inside=numpy.logical_and(numpy.sqrt(RowDot(d,d))<=row[4],abs(grid[:,2]-row[2])<=row[3])
+    return inside.astype(float)
+def InsideNerveMask(geom,grid):
+    return InsideCylinderMask(geom[1],grid)
+def InsideCoreMask(geom,grid):
+    return InsideCylinderMask(geom[0],grid)
+@Timed('Masks')
+def NearFocusMask(geom,grid):
+    #Vectorized IsNearFocus
+    d=grid-geom[2,0:3]
+    return (numpy.sqrt(RowDot(d,d))<geom[2,6]).astype(float)
+
+class RegionMasks:
+    #The masks (and Gaussian weights) of the grid points, each computed in one vectorized pass
+    #and kept for the last value of the geometry row it depends on: the focus can move at every
+    #step of the *Geom optimizers, so only one geometry is kept per region.
+    def __init__(self,grid):
+        self.grid=grid
+        self.cache={}
+        self.computed=0 #number of masks computed
+    def Get(self,name,geom,row,function):
+        key=geom[row].tobytes()
+        if name not in self.cache or self.cache[name][0]!=key:
+            self.cache[name]=(key,function(geom,self.grid))
+            self.computed+=1
+        return self.cache[name][1]
+    def Nerve(self,geom):
+        return self.Get('Nerve',geom,1,InsideNerveMask)
+    def Core(self,geom):
+        return self.Get('Core',geom,0,InsideCoreMask)
+    def Focus(self,geom):
+        return self.Get('Focus',geom,2,NearFocusMask)
+    def Weights(self,geom):
+        return self.Get('Weights',geom,2,lambda geom,grid: GaussianWeights(grid,geom[2,0:3],geom[2,6]))
+def GetCoreMask(geom,grid,gains):
+    #InsideCoreMask, cached if gains is a FieldCache
+    if isinstance(gains,FieldCache):
+        return gains.masks.Core(geom)
+    return InsideCoreMask(geom,grid)
+def GetGaussianWeights(geom,grid,gains):
+    #GaussianWeights around the focus, cached if gains is a FieldCache
+    if isinstance(gains,FieldCache):
+        return gains.masks.Weights(geom)
+    return GaussianWeights(grid,geom[2,0:3],geom[2,6])
+
 class workspace:
-    def __init__(self,gridfilename,gainfilename):
+    def __init__(self,gridfilename,gainfilename,grid=None,gains=None,stencil=False):
+        #The grid and the gains can be given as arrays instead of file names.
+        #With stencil=True only the gain of the grid is used (gainfilename+".gain", or gains[0] or
+        #a single gain): the currents and the activation function are taken from grid-neighbor
+        #stencils (StencilGains) instead of the gains of the shifted grids.  It needs the full
+        #cubic grid of GenerateCubicGrid.
         self.geom=numpy.array([[0.,0.,0.,5.,.3,0.0,0.0],[0.,0.,0.,12.,.95,0.0,0.0],[0.0,0.0,0.0,0.0,0.0,1.0,.3]])
         
         #self.geom[2,3:6] = J0.  This MUST HAVE LENGTH 1 !
@@ -245,14 +803,48 @@ class workspace:
         #geom[0]=CORE= [x,y,z,l,r,*,*]
         #geom[1]=NERVE = [x,y,z,l,r,*,*]
         #geom[2]=Focus/Chi/Omega = [x,y,z,J0_x,J0_y,J0_z,sigma]
-        self.grid=LoadCubicGrid(gridfilename)
+        if grid is None:
+            grid=LoadGrid(gridfilename)
+        elif GridGeometry(grid) is None:
+            grid=Grid(grid)
+        #The solver gives undefined results outside the nerve: the grid and the gains are compacted
+        #to the grid points inside the nerve (of the geometry at load), instead of storing zeros.
+        self.FullGrid=grid
+        self.NerveRows=numpy.flatnonzero(InsideNerveMask(self.geom,grid))
+        #Arrays already inside the nerve (e.g. shared with the MultiStart workers) are not copied.
+        compact=len(self.NerveRows)<len(grid)
+        self.grid=grid[self.NerveRows] if compact else grid
 
-        g0,g1,g2,g3,g4=LoadGains(self.geom,self.grid,gainfilename)   
-        self.gains=numpy.array([g0,g1,g2,g3,g4])
-        self.NumberOfElectrodes=len(self.gains[0,0])
+        if isinstance(gains,StencilGains):
+            pass #already compacted, e.g. shared with the MultiStart workers
+        elif stencil:
+            if gains is None:
+                base=LoadGain(self.geom,grid,GainFileName(gainfilename,""),self.NerveRows)
+            else:
+                base=numpy.asarray(gains)
+                if base.ndim==3:
+                    base=base[0]
+                if compact:
+                    base=base[self.NerveRows]
+            gains=StencilGains(grid,self.NerveRows,base)
+        elif gains is None:
+            gains=LoadStackedGains(self.geom,grid,gainfilename,self.NerveRows)
+        else:
+            gains=numpy.asarray(gains)
+            if compact:
+                gains=gains[:,self.NerveRows]
+        self.gains=gains
+        self.fields=FieldCache(self.grid,self.gains)
+        self.masks=self.fields.masks
+        self.Q=QuadraticForms(self.grid,self.gains)
+        self.NumberOfElectrodes=numpy.shape(self.gains)[-1]
         self.ConstrainedNumberOfElectrodes=self.NumberOfElectrodes-1
         self.SetRandomInj()
         self.GTol=.0005 #Tolerance (for norm of gradient) for when to stop optimization iterations.  
+        self.UseGradient=True #Give the analytic gradients to fmin_bfgs, else it uses finite differences.
+        self.UseQuadraticForms=True #Evaluate f_Phi, f_Chi, f_Omega and f_Ksi with the Q matrices, else with the fields.
+        self.Verbose=True #Print the iterations of the optimizations.
+        self.LastTrace=None #The OptimizationTrace of the last optimization.
     def SetRandomInj(self): #randomize the injection current
         self.cinj=numpy.random.sample(self.ConstrainedNumberOfElectrodes)-.5 #Constrained injected current: only the first N-1 positions.
         self.inj=numpy.concatenate((self.cinj,[-sum(self.cinj)]))
@@ -260,56 +852,107 @@ class workspace:
         self.cinj=self.cinj*alpha
         self.inj=self.inj*alpha
     def f_Phi(self,inj):
-        return f_Phi(inj,self.geom,self.grid,self.gains)
+        if self.UseQuadraticForms:
+            return self.Q.Objective('Phi',inj,self.geom)
+        return f_Phi(inj,self.geom,self.grid,self.fields)
     def Constrained_f_Phi(self,cinj):
         y=numpy.concatenate((cinj,[-sum(cinj)]))
         return self.f_Phi(y)
+    def fprime_Phi(self,inj):
+        if self.UseQuadraticForms:
+            return self.Q.ObjectiveGrad('Phi',inj,self.geom)
+        return fprime_Phi(inj,self.geom,self.grid,self.fields)
+    def Constrained_fprime_Phi(self,cinj):
+        y=numpy.concatenate((cinj,[-sum(cinj)]))
+        return ConstrainedGrad(self.fprime_Phi(y))
     def f_Omega(self,inj):
-        return f_Omega(inj,self.geom,self.grid,self.gains)
+        if self.UseQuadraticForms:
+            return self.Q.Objective('Omega',inj,self.geom)
+        return f_Omega(inj,self.geom,self.grid,self.fields)
     def Constrained_f_Omega(self,cinj):
         y=numpy.concatenate((cinj,[-sum(cinj)]))
         return self.f_Omega(y)
+    def fprime_Omega(self,inj):
+        if self.UseQuadraticForms:
+            return self.Q.ObjectiveGrad('Omega',inj,self.geom)
+        return fprime_Omega(inj,self.geom,self.grid,self.fields)
+    def Constrained_fprime_Omega(self,cinj):
+        y=numpy.concatenate((cinj,[-sum(cinj)]))
+        return ConstrainedGrad(self.fprime_Omega(y))
     def f_Chi(self,inj):
-        return f_Chi(inj,self.geom,self.grid,self.gains)
+        if self.UseQuadraticForms:
+            return self.Q.Objective('Chi',inj,self.geom)
+        return f_Chi(inj,self.geom,self.grid,self.fields)
     def Constrained_f_Chi(self,cinj):
         y=numpy.concatenate((cinj,[-sum(cinj)]))
         return self.f_Chi(y)
+    def fprime_Chi(self,inj):
+        if self.UseQuadraticForms:
+            return self.Q.ObjectiveGrad('Chi',inj,self.geom)
+        return fprime_Chi(inj,self.geom,self.grid,self.fields)
+    def Constrained_fprime_Chi(self,cinj):
+        y=numpy.concatenate((cinj,[-sum(cinj)]))
+        return ConstrainedGrad(self.fprime_Chi(y))
     def f_Ksi(self,inj):
-        return f_Ksi(inj,self.geom,self.grid,self.gains)
+        if self.UseQuadraticForms:
+            return self.Q.Objective('Ksi',inj,self.geom)
+        return f_Ksi(inj,self.geom,self.grid,self.fields)
     def Constrained_f_Ksi(self,cinj):
         y=numpy.concatenate((cinj,[-sum(cinj)]))
         return self.f_Ksi(y)
+    def fprime_Ksi(self,inj):
+        if self.UseQuadraticForms:
+            return self.Q.ObjectiveGrad('Ksi',inj,self.geom)
+        return fprime_Ksi(inj,self.geom,self.grid,self.fields)
+    def Constrained_fprime_Ksi(self,cinj):
+        y=numpy.concatenate((cinj,[-sum(cinj)]))
+        return ConstrainedGrad(self.fprime_Ksi(y))
     def OptimizePhi(self):
         self.SetRandomInj()
         self.CurrentFunc=self.Constrained_f_Phi
-        temp=scipy.optimize.fmin_bfgs(self.Constrained_f_Phi,self.cinj, callback=self.MyCallback,gtol=self.GTol)
+        temp=self.Minimize(self.Constrained_f_Phi,self.cinj,self.Constrained_fprime_Phi)
         self.SetInj(temp)
         return temp
     def OptimizeOmega(self):
         self.geom[2,3:6]=(1/numpy.linalg.norm(self.geom[2,3:6]))*self.geom[2,3:6]
         self.SetRandomInj()
         self.CurrentFunc=self.Constrained_f_Omega
-        temp=scipy.optimize.fmin_bfgs(self.Constrained_f_Omega,self.cinj,callback=self.MyCallback,gtol=self.GTol)
+        temp=self.Minimize(self.Constrained_f_Omega,self.cinj,self.Constrained_fprime_Omega)
         self.SetInj(temp)
         return temp
     def OptimizeChi(self):
         self.SetRandomInj()
         self.CurrentFunc=self.Constrained_f_Chi
-        temp=scipy.optimize.fmin_bfgs(self.Constrained_f_Chi,self.cinj,callback=self.MyCallback,gtol=self.GTol)
+        temp=self.Minimize(self.Constrained_f_Chi,self.cinj,self.Constrained_fprime_Chi)
         self.SetInj(temp)
         return temp
     def OptimizeKsi(self):
         self.SetRandomInj()
         self.CurrentFunc=self.Constrained_f_Ksi
-        temp=scipy.optimize.fmin_bfgs(self.Constrained_f_Ksi,self.cinj,retall=1,callback=self.MyCallback,gtol=self.GTol)
+        temp=self.Minimize(self.Constrained_f_Ksi,self.cinj,self.Constrained_fprime_Ksi,retall=1)
         return temp
     def OptimizeOmegaGeom(self):
         self.SetRandomInj()
         self.CurrentFunc=self.f_OmegaGeom
         x=numpy.concatenate((self.cinj,self.geom[2,0:3]))
-        temp=scipy.optimize.fmin_bfgs(self.f_OmegaGeom,x,callback=self.MyCallback,gtol=self.GTol)
+        temp=self.Minimize(self.f_OmegaGeom,x,self.fprime_OmegaGeom)
         self.SetInjGeom(temp)
         return temp
+    def Solve(self,name):
+        #Direct minimum of f_Phi, f_Chi, f_Omega or f_Ksi ('Phi', 'Chi', 'Omega' or 'Ksi') for the
+        #current geometry, from the generalized eigenproblem of the Q matrices. The Optimize*
+        #methods reach the same minimum iteratively.
+        if name=='Omega':
+            self.geom[2,3:6]=(1/numpy.linalg.norm(self.geom[2,3:6]))*self.geom[2,3:6]
+        value,inj=self.Q.Solve(name,self.geom)
+        self.cinj=inj[0:self.ConstrainedNumberOfElectrodes]
+        self.SetInj(self.cinj)
+        return value
+    def BatchMetrics(self,injs):
+        #The metrics and objectives of many injections, the columns of injs (n_electrodes,n_patterns)
+        if self.UseQuadraticForms:
+            return self.Q.BatchMetrics(injs,self.geom)
+        return BatchMetrics(injs,self.geom,self.grid,self.fields)
     def SetInj(self,cinj):
         self.inj[0:self.ConstrainedNumberOfElectrodes]=cinj
         self.inj[self.ConstrainedNumberOfElectrodes]=-sum(cinj)
@@ -325,7 +968,14 @@ class workspace:
         g2=self.geom[2]
         g2[0:3]=x[self.ConstrainedNumberOfElectrodes:self.ConstrainedNumberOfElectrodes+3]
         geom=numpy.array([self.geom[0],self.geom[1],g2])
-        return f_Omega(inj,geom,self.grid,self.gains)
+        return f_Omega(inj,geom,self.grid,self.fields)
+    def fprime_OmegaGeom(self,x):
+        cinj=x[0:self.ConstrainedNumberOfElectrodes]
+        inj=numpy.concatenate((cinj,[-sum(cinj)]))
+        geom=numpy.array(self.geom)
+        geom[2,0:3]=x[self.ConstrainedNumberOfElectrodes:self.ConstrainedNumberOfElectrodes+3]
+        g=fprime_Omega(inj,geom,self.grid,self.fields)
+        return numpy.concatenate((ConstrainedGrad(g),fprime_OmegaFocus(inj,geom,self.grid,self.fields)))
     def SetRandomOmegaGeom(self):
         self.geom[2,0:3]=(numpy.random.sample(3)-.5)*.5
         self.geom[2,2]=(numpy.random.sample(1)[0]-.5)*12.0
@@ -335,7 +985,7 @@ class workspace:
         self.SetRandomOmegaGeom()
         self.CurrentFunc=self.f_ChiGeom
         x=numpy.concatenate((self.cinj,self.geom[2,0:3]))
-        temp=scipy.optimize.fmin_bfgs(self.f_ChiGeom,x,callback=self.MyCallback,gtol=self.GTol)
+        temp=self.Minimize(self.f_ChiGeom,x,self.fprime_ChiGeom)
         self.SetInjGeom(temp)
         return temp    
     def f_ChiGeom(self,x):
@@ -344,13 +994,20 @@ class workspace:
         g2=self.geom[2]
         g2[0:3]=x[self.ConstrainedNumberOfElectrodes:self.ConstrainedNumberOfElectrodes+3]
         geom=numpy.array([self.geom[0],self.geom[1],g2])
-        return f_Chi(inj,geom,self.grid,self.gains)
+        return f_Chi(inj,geom,self.grid,self.fields)
+    def fprime_ChiGeom(self,x):
+        cinj=x[0:self.ConstrainedNumberOfElectrodes]
+        inj=numpy.concatenate((cinj,[-sum(cinj)]))
+        geom=numpy.array(self.geom)
+        geom[2,0:3]=x[self.ConstrainedNumberOfElectrodes:self.ConstrainedNumberOfElectrodes+3]
+        g=fprime_Chi(inj,geom,self.grid,self.fields)
+        return numpy.concatenate((ConstrainedGrad(g),fprime_ChiFocus(inj,geom,self.grid,self.fields)))
     def OptimizeKsiGeom(self):
         self.SetRandomInj()
         self.SetRandomOmegaGeom()
         self.CurrentFunc=self.f_KsiGeom
         x=numpy.concatenate((self.cinj,self.geom[2,0:3]))
-        temp=scipy.optimize.fmin_bfgs(self.f_KsiGeom,x,callback=self.MyCallback,gtol=self.GTol)
+        temp=self.Minimize(self.f_KsiGeom,x,self.fprime_KsiGeom)
         self.SetInjGeom(temp)
         return temp
     def f_KsiGeom(self,x):
@@ -359,12 +1016,67 @@ class workspace:
         g2=self.geom[2]
         g2[0:3]=x[self.ConstrainedNumberOfElectrodes:self.ConstrainedNumberOfElectrodes+3]
         geom=numpy.array([self.geom[0],self.geom[1],g2])
-        return f_Ksi(inj,geom,self.grid,self.gains)
-    def MyCallback(self,x):
-        print "Callback."
-        print "params = ", x
-        print self.CurrentFunc(x)
-        
+        return f_Ksi(inj,geom,self.grid,self.fields)
+    def fprime_KsiGeom(self,x):
+        cinj=x[0:self.ConstrainedNumberOfElectrodes]
+        inj=numpy.concatenate((cinj,[-sum(cinj)]))
+        geom=numpy.array(self.geom)
+        geom[2,0:3]=x[self.ConstrainedNumberOfElectrodes:self.ConstrainedNumberOfElectrodes+3]
+        g=fprime_Ksi(inj,geom,self.grid,self.fields)
+        return numpy.concatenate((ConstrainedGrad(g),fprime_KsiFocus(inj,geom,self.grid,self.fields)))
+    def Minimize(self,f,x0,fprime,**kwargs):
+        #fmin_bfgs of f from x0, traced in self.LastTrace (printed if Verbose).  The trace takes the
+        #values from the evaluations of fmin_bfgs itself, nothing is evaluated again.
+        trace=OptimizationTrace(f.__name__,self.Verbose)
+        self.LastTrace=trace
+        with trace:
+            return scipy.optimize.fmin_bfgs(trace.Objective(f),x0,fprime=trace.Gradient(self.FPrime(fprime)),callback=trace.Callback,gtol=self.GTol,disp=self.Verbose,**kwargs)
+    def FPrime(self,fprime):
+        #The gradient given to fmin_bfgs: None to validate against finite differences
+        if self.UseGradient:
+            return fprime
+        return None
+    def MultiStart(self,optimizer,starts,processes=None,seed=0,tol=1e-3):
+        #Runs the optimizer (e.g. 'OptimizeChi' or 'OptimizeOmegaGeom') from starts seeded random
+        #injections (and focus), start i with seed+i, on a pool of processes (one per core if None).
+        #The grid and the gains are copied once to shared memory, read by all the workers.
+        #The optima are ranked and those equal up to the symmetries of the geometry are merged.
+        settings=dict(geom=numpy.array(self.geom),GTol=self.GTol,UseGradient=self.UseGradient,UseQuadraticForms=self.UseQuadraticForms)
+        tasks=[(optimizer,i,seed+i) for i in range(starts)]
+        t0=time.time()
+        if processes==1:
+            #the starts run on this workspace, whose state is restored afterwards
+            state=dict((name,numpy.copy(getattr(self,name)) if name in ('geom','cinj','inj') else getattr(self,name))
+                       for name in ('geom','cinj','inj','Verbose','LastTrace','CurrentFunc') if hasattr(self,name))
+            randomstate=numpy.random.get_state()
+            self.Verbose=False
+            try:
+                results=[RunStartOn(self,settings['geom'],task) for task in tasks]
+            finally:
+                for name,value in state.items():
+                    setattr(self,name,value)
+                numpy.random.set_state(randomstate)
+            return MultiStartResults(optimizer,results,time.time()-t0,tol,settings['geom'])
+        memory=[]
+        try:
+            grid=(SharedArray(self.grid,memory),GridHeader(self.grid))
+            if isinstance(self.gains,StencilGains):
+                #only the base gain is shared, the stencils are small
+                gains=(self.gains.WithBase(None),SharedArray(self.gains.Base,memory))
+            else:
+                gains=SharedArray(self.gains,memory)
+            pool=multiprocessing.Pool(processes,initializer=InitMultiStartWorker,initargs=(grid,gains,settings))
+            try:
+                results=pool.map(RunStart,tasks,chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            for block in memory:
+                block.close()
+                block.unlink()
+        return MultiStartResults(optimizer,results,time.time()-t0,tol,settings['geom'])
+
 def f_Phi(inj,geom,grid,gains):
     a=PhiN(inj,geom,grid,gains)
     b=PhiC(inj,geom,grid,gains)
@@ -373,39 +1085,43 @@ def f_Phi(inj,geom,grid,gains):
     return a*d/(float(b)*float(c))
 
 def PhiN(inj,geom,grid,gains):
-    dv=numpy.product(GetGridDxDyDz(grid))
+    dv=GetGridDV(grid)
     cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
-    return dv*numpy.sum([numpy.dot(cur[x],cur[x]) for x in range(len(grid))])
+    return dv*numpy.sum(CurSqField(cur))
 def PhiC(inj,geom,grid,gains):
-    dv=numpy.product(GetGridDxDyDz(grid))
+    dv=GetGridDV(grid)
     cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
-    return dv*numpy.sum([IsInsideCore(grid[x],geom)*numpy.dot(cur[x],cur[x]) for x in range(len(grid))])
+    return dv*numpy.sum(GetCoreMask(geom,grid,gains)*CurSqField(cur))
 
+def RowDot(a,b):
+    #numpy.dot(a[i],b[i]) (or numpy.dot(a[i],b) for a single vector b) for all rows at once.
+    #The results are equal to the per-point loops up to summation order (rtol 1e-12).
+    return numpy.matmul(a[:,None,:],numpy.reshape(b,numpy.shape(b)+(1,)))[:,0,0]
+def CurSqField(cur):
+    #numpy.dot(cur[i],cur[i]) for all grid points at once
+    return RowDot(cur,cur)
 def GetCurrentMagnitude(cur):
-    func=lambda x: numpy.linalg.norm(x)
-    return numpy.reshape(numpy.apply_along_axis(func,1,cur),(-1,1)) # -1 means unspecified value - inferred from the data
+    return numpy.reshape(numpy.sqrt(CurSqField(cur)),(-1,1)) # -1 means unspecified value - inferred from the data
 def GetCurSq(cur):
-    func = lambda x: numpy.linalg.norm(x)**2.
-    return numpy.reshape(numpy.apply_along_axis(func,1,cur),(-1,1))
+    return numpy.reshape(CurSqField(cur),(-1,1))
 
 def W(x,x0,sigma):
-    return sigma**(-1)*(2*scipy.pi)**(-.5)*scipy.exp(-.5*((numpy.linalg.norm(x-x0)/sigma)**2))
+    return sigma**(-1)*(2*numpy.pi)**(-.5)*numpy.exp(-.5*((numpy.linalg.norm(x-x0)/sigma)**2))
+@Timed('Weights')
+def GaussianWeights(grid,x0,sigma):
+    #W(grid[i],x0,sigma) for all grid points at once
+    d=grid-x0
+    r=numpy.sqrt(RowDot(d,d))
+    return sigma**(-1)*(2*numpy.pi)**(-.5)*numpy.exp(-.5*((r/sigma)**2))
 
 def Chi(inj,geom,grid,gains):
-    x0=geom[2,0:3]
-    sigma=geom[2,6]
-    dv=numpy.product(GetGridDxDyDz(grid))
-
+    dv=GetGridDV(grid)
     cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
-    Omega_i=lambda i: W(grid[i],x0,sigma)*numpy.dot(cur[i],cur[i])
-    return dv*numpy.sum([Omega_i(i) for i in range(len(grid))])
+    return dv*numpy.sum(GetGaussianWeights(geom,grid,gains)*CurSqField(cur))
 def Ksi(inj,geom,grid,gains):
-    x0=geom[2,0:3]
-    sigma=geom[2,6]
-    dv=numpy.product(GetGridDxDyDz(grid))
-    activ=GetActivationFunction(inj,geom,grid,gains)
-    Omega_i=lambda i: W(grid[i],x0,sigma)*(activ[i]**2)
-    return dv*numpy.sum([Omega_i(i) for i in range(len(grid))])
+    dv=GetGridDV(grid)
+    activ=GetActivationFunction(inj,geom,grid,gains)[:,0]
+    return dv*numpy.sum(GetGaussianWeights(geom,grid,gains)*(activ**2))
 def f_Chi(inj,geom,grid,gains):
     a=PhiN(inj,geom,grid,gains)
     b=Chi(inj,geom,grid,gains)
@@ -419,17 +1135,330 @@ def f_Ksi(inj,geom,grid,gains):
     b=Ksi(inj,geom,grid,gains)
     return 1000000*a/float(b)
 def VolumeNerve(geom,grid):
-    return scipy.pi*geom[1,3]*geom[1,4]**2
+    return numpy.pi*geom[1,3]*geom[1,4]**2
 def VolumeCore(geom,grid):
-    return scipy.pi*geom[0,3]*geom[0,4]**2
+    return numpy.pi*geom[0,3]*geom[0,4]**2
 def Omega(inj,geom,grid,gains):
+    J0=geom[2,3:6]
+    dv=GetGridDV(grid)
+    cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
+    return dv*numpy.sum(GetGaussianWeights(geom,grid,gains)*(RowDot(cur,J0)**2))
+
+#Batched metrics.  injs is a (n_electrodes,n_patterns) matrix of injections, one per column.
+#The fields of all patterns are computed with one matrix-matrix product per chunk of grid points,
+#and the metrics are accumulated chunk by chunk, so that only (5,chunk,n_patterns) fields are in memory.
+BatchMetricNames=['PhiN','PhiC','Chi','Omega','Ksi']
+@Timed('Products')
+def StackedBatchProduct(gains,injs):
+    #The fields of all gains for all patterns, shape (len(gains),len(grid),n_patterns)
+    if isinstance(gains,StencilGains):
+        return gains.Fields(injs)
+    stacked=numpy.reshape(gains,(-1,numpy.shape(gains)[-1]))
+    return numpy.dot(stacked,injs).reshape(len(gains),-1,numpy.shape(injs)[1])
+def BatchPotentialAndCurrentFromFields(fields,dxdydz):
+    #pot shape (len(grid),n_patterns), cur shape (len(grid),3,n_patterns), computed in place
+    pot=fields[0]
+    cur=numpy.empty((pot.shape[0],3)+pot.shape[1:])
+    for k in range(3):
+        numpy.subtract(fields[k+1],pot,out=cur[:,k])
+        cur[:,k]*=-conductivity
+        cur[:,k]/=dxdydz[k]
+    return pot,cur
+def BatchActivationFunctionFromFields(fields,dxdydz):
+    dz=dxdydz[2]
+    return (fields[3]+fields[4]-2*fields[0])/(dz*dz)
+def BatchGains(gains):
+    #The gains arrays of gains or of a FieldCache
+    if isinstance(gains,FieldCache):
+        return gains.gains
+    return gains
+def GetBatchPotentialAndCurrent(injs,geom,grid,gains):
+    return BatchPotentialAndCurrentFromFields(StackedBatchProduct(BatchGains(gains)[0:4],injs),GetFiniteDifferenceDxDyDz(grid))
+def GetBatchActivationFunction(injs,geom,grid,gains):
+    return BatchActivationFunctionFromFields(StackedBatchProduct(BatchGains(gains),injs),GetFiniteDifferenceDxDyDz(grid))
+BatchTemporaries=8
+#The number of arrays of the size of one field alive at once in a chunk of BatchMetrics, besides the
+#fields: the three currents, their squares, the squared magnitude and the products of the metrics.
+def BatchChunkSize(NumberOfGains,NumberOfPatterns):
+    #The number of grid points whose fields and temporaries for all patterns fit in BatchBytes
+    return max(1,int(BatchBytes//(8*(NumberOfGains+BatchTemporaries)*max(1,NumberOfPatterns))))
+def BatchMetrics(injs,geom,grid,gains,chunk=None):
+    #PhiN, PhiC, Chi, Omega and Ksi of all patterns, as a dict of arrays of shape (n_patterns,),
+    #and the objectives f_Phi, f_Chi, f_Omega and f_Ksi.
+    injs=numpy.asarray(injs,float)
+    core=GetCoreMask(geom,grid,gains)
+    w=GetGaussianWeights(geom,grid,gains)
+    J0=geom[2,3:6]
+    gains=BatchGains(gains)
+    dxdydz=GetFiniteDifferenceDxDyDz(grid)
+    if chunk is None:
+        chunk=BatchChunkSize(len(gains),injs.shape[1])
+    sums=dict((name,numpy.zeros(injs.shape[1])) for name in BatchMetricNames)
+    for start in range(0,len(grid),chunk):
+        rows=slice(start,start+chunk)
+        if isinstance(gains,StencilGains):
+            fields=gains.BatchFields(rows,injs)
+        else:
+            #one product per gain, gains[:,rows] is not contiguous and would be copied to be stacked
+            fields=numpy.empty((len(gains),len(core[rows]),injs.shape[1]))
+            for k in range(len(gains)):
+                fields[k]=numpy.dot(gains[k,rows],injs)
+        pot,cur=BatchPotentialAndCurrentFromFields(fields,dxdydz)
+        cursq=numpy.sum(cur*cur,axis=1)
+        sums['PhiN']+=numpy.sum(cursq,axis=0)
+        sums['PhiC']+=numpy.dot(core[rows],cursq)
+        sums['Chi']+=numpy.dot(w[rows],cursq)
+        sums['Omega']+=numpy.dot(w[rows],numpy.einsum('k,ikp->ip',J0,cur)**2)
+        sums['Ksi']+=numpy.dot(w[rows],BatchActivationFunctionFromFields(fields,dxdydz)**2)
+        del fields,pot,cur,cursq #before the next chunk is allocated
+    dv=GetGridDV(grid)
+    metrics=dict((name,dv*value) for name,value in sums.items())
+    return BatchObjectives(metrics,geom,grid)
+def BatchObjectives(metrics,geom,grid):
+    #Adds the objectives of the metrics of a batch, as f_Phi, f_Chi, f_Omega and f_Ksi do.
+    for name,(a,b,scale) in QuadraticForms.Objectives.items():
+        if scale is None:
+            scale=VolumeCore(geom,grid)/float(VolumeNerve(geom,grid))
+        metrics['f_'+name]=scale*metrics[a]/metrics[b]
+    return metrics
+
+#Gradients.  Every metric is dv*sum(w*q**2) where q is a linear map of inj through the gains,
+#so its gradient is 2*dv*L^T(w*q) where L^T is the transpose of the map.  The gradient of a
+#metric is first written as an adjoint field u, shape (len(gains),len(grid)), such that the
+#gradient is sum_k gains[k]^T u[k]: the adjoint fields of the two metrics of an objective
+#are combined so that each gradient costs a single (transposed) stacked product.
+def GetAdjointProduct(u,grid,gains):
+    #sum_k numpy.dot(u[k],gains[k])
+    if isinstance(gains,FieldCache):
+        return gains.AdjointProduct(u)
+    return StackedAdjointProduct(gains,u)
+@Timed('Products')
+def StackedAdjointProduct(gains,u):
+    if isinstance(gains,StencilGains):
+        return gains.AdjointProduct(u)
+    stacked=numpy.reshape(gains,(-1,numpy.shape(gains)[-1]))
+    return numpy.dot(numpy.ravel(u),stacked)
+def CurrentAdjoint(v,dxdydz,NumberOfGains):
+    #Adjoint field of sum(v*cur): cur[:,k]=-conductivity*(fields[k+1]-fields[0])/dxdydz[k]
+    u=numpy.zeros((NumberOfGains,len(v)))
+    for k in range(3):
+        u[k+1]=-conductivity*v[:,k]/dxdydz[k]
+    u[0]=-(u[1]+u[2]+u[3])
+    return u
+def ActivationAdjoint(v,dxdydz,NumberOfGains):
+    #Adjoint field of sum(v*activation): activation=(fields[3]+fields[4]-2*fields[0])/dz**2
+    dz=dxdydz[2]
+    u=numpy.zeros((NumberOfGains,len(v)))
+    u[3]=v/(dz*dz)
+    u[4]=v/(dz*dz)
+    u[0]=-2*v/(dz*dz)
+    return u
+def PhiNAdjoint(inj,geom,grid,gains):
+    dv=GetGridDV(grid)
+    cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
+    return CurrentAdjoint(2*dv*cur,GetFiniteDifferenceDxDyDz(grid),len(gains))
+def PhiCAdjoint(inj,geom,grid,gains):
+    dv=GetGridDV(grid)
+    cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
+    mask=GetCoreMask(geom,grid,gains)
+    return CurrentAdjoint(2*dv*mask[:,None]*cur,GetFiniteDifferenceDxDyDz(grid),len(gains))
+def ChiAdjoint(inj,geom,grid,gains):
+    dv=GetGridDV(grid)
+    cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
+    w=GetGaussianWeights(geom,grid,gains)
+    return CurrentAdjoint(2*dv*w[:,None]*cur,GetFiniteDifferenceDxDyDz(grid),len(gains))
+def OmegaAdjoint(inj,geom,grid,gains):
+    J0=geom[2,3:6]
+    dv=GetGridDV(grid)
+    cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
+    w=GetGaussianWeights(geom,grid,gains)
+    v=(2*dv*w*RowDot(cur,J0))[:,None]*J0
+    return CurrentAdjoint(v,GetFiniteDifferenceDxDyDz(grid),len(gains))
+def KsiAdjoint(inj,geom,grid,gains):
+    dv=GetGridDV(grid)
+    activ=GetActivationFunction(inj,geom,grid,gains)[:,0]
+    w=GetGaussianWeights(geom,grid,gains)
+    return ActivationAdjoint(2*dv*w*activ,GetFiniteDifferenceDxDyDz(grid),len(gains))
+def PhiNGrad(inj,geom,grid,gains):
+    return GetAdjointProduct(PhiNAdjoint(inj,geom,grid,gains),grid,gains)
+def PhiCGrad(inj,geom,grid,gains):
+    return GetAdjointProduct(PhiCAdjoint(inj,geom,grid,gains),grid,gains)
+def ChiGrad(inj,geom,grid,gains):
+    return GetAdjointProduct(ChiAdjoint(inj,geom,grid,gains),grid,gains)
+def OmegaGrad(inj,geom,grid,gains):
+    return GetAdjointProduct(OmegaAdjoint(inj,geom,grid,gains),grid,gains)
+def KsiGrad(inj,geom,grid,gains):
+    return GetAdjointProduct(KsiAdjoint(inj,geom,grid,gains),grid,gains)
+def FocusGrad(values,geom,grid,gains=None):
+    #Gradient with respect to the focus position geom[2,0:3] of dv*sum(W(grid[i],x0,sigma)*values[i])
     x0=geom[2,0:3]
     sigma=geom[2,6]
-    J0=geom[2,3:6]
-    dv=numpy.product(GetGridDxDyDz(grid))
+    dv=GetGridDV(grid)
+    w=GetGaussianWeights(geom,grid,gains)
+    return dv*numpy.dot(w*values,grid-x0)/(sigma*sigma)
+def ChiFocusGrad(inj,geom,grid,gains):
+    cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
+    return FocusGrad(CurSqField(cur),geom,grid,gains)
+def OmegaFocusGrad(inj,geom,grid,gains):
     cur=GetPotentialAndCurrent(inj,geom,grid,gains)[1]
-    omega_i=lambda i: W(grid[i],x0,sigma)*(numpy.dot(cur[i],J0)**2)
-    return dv*numpy.sum([omega_i(i) for i in range(len(grid))])
+    return FocusGrad(RowDot(cur,geom[2,3:6])**2,geom,grid,gains)
+def KsiFocusGrad(inj,geom,grid,gains):
+    activ=GetActivationFunction(inj,geom,grid,gains)[:,0]
+    return FocusGrad(activ**2,geom,grid,gains)
+def RatioAdjoint(a,b,ua,ub,scale=1.):
+    #Adjoint field of scale*a/b from those of a and b
+    return (scale/b)*ua-(scale*a/(b*b))*ub
+def fprime_Phi(inj,geom,grid,gains):
+    a=PhiN(inj,geom,grid,gains)
+    b=PhiC(inj,geom,grid,gains)
+    c=VolumeNerve(geom,grid)
+    d=VolumeCore(geom,grid)
+    u=RatioAdjoint(a,b,PhiNAdjoint(inj,geom,grid,gains),PhiCAdjoint(inj,geom,grid,gains),d/float(c))
+    return GetAdjointProduct(u,grid,gains)
+def fprime_Chi(inj,geom,grid,gains):
+    a=PhiN(inj,geom,grid,gains)
+    b=Chi(inj,geom,grid,gains)
+    u=RatioAdjoint(a,b,PhiNAdjoint(inj,geom,grid,gains),ChiAdjoint(inj,geom,grid,gains))
+    return GetAdjointProduct(u,grid,gains)
+def fprime_Omega(inj,geom,grid,gains):
+    a=PhiN(inj,geom,grid,gains)
+    b=Omega(inj,geom,grid,gains)
+    u=RatioAdjoint(a,b,PhiNAdjoint(inj,geom,grid,gains),OmegaAdjoint(inj,geom,grid,gains))
+    return GetAdjointProduct(u,grid,gains)
+def fprime_Ksi(inj,geom,grid,gains):
+    a=PhiN(inj,geom,grid,gains)
+    b=Ksi(inj,geom,grid,gains)
+    u=RatioAdjoint(a,b,PhiNAdjoint(inj,geom,grid,gains),KsiAdjoint(inj,geom,grid,gains),1000000)
+    return GetAdjointProduct(u,grid,gains)
+def fprime_ChiFocus(inj,geom,grid,gains):
+    #Gradient of f_Chi with respect to the focus position
+    a=PhiN(inj,geom,grid,gains)
+    b=Chi(inj,geom,grid,gains)
+    return -a/(b*b)*ChiFocusGrad(inj,geom,grid,gains)
+def fprime_OmegaFocus(inj,geom,grid,gains):
+    a=PhiN(inj,geom,grid,gains)
+    b=Omega(inj,geom,grid,gains)
+    return -a/(b*b)*OmegaFocusGrad(inj,geom,grid,gains)
+def fprime_KsiFocus(inj,geom,grid,gains):
+    a=PhiN(inj,geom,grid,gains)
+    b=Ksi(inj,geom,grid,gains)
+    return -1000000*a/(b*b)*KsiFocusGrad(inj,geom,grid,gains)
+def ConstrainedGrad(grad):
+    #Gradient with respect to cinj, with inj=[cinj,-sum(cinj)]
+    return grad[:-1]-grad[-1]
+#Quadratic forms.  Every metric is a weighted sum of squared linear maps of inj, so it is
+#inj^T Q inj for a (n_electrodes,n_electrodes) matrix Q of the gains, grid and geometry.
+#Once Q is built (O(len(grid)*n_electrodes^2)) a metric costs O(n_electrodes^2), and the
+#minimum of a ratio objective is the solution of a generalized eigenproblem.
+def CurrentMap(gains,dxdydz,k):
+    #The matrix of the k-th current component: cur[:,k]=numpy.dot(CurrentMap(gains,dxdydz,k),inj)
+    return -conductivity*(gains[k+1]-gains[0])/dxdydz[k]
+def ActivationMap(gains,dxdydz):
+    dz=dxdydz[2]
+    return (gains[3]+gains[4]-2*gains[0])/(dz*dz)
+@Timed('Products')
+def WeightedGram(M,w=None):
+    #M^T diag(w) M, only over the rows where w is not zero
+    if w is None:
+        return numpy.dot(M.T,M)
+    rows=numpy.flatnonzero(w)
+    if len(rows)<len(w):
+        M=M[rows]
+        w=w[rows]
+    return numpy.dot(M.T,w[:,None]*M)
+def PhiNMatrix(geom,grid,gains):
+    dv=GetGridDV(grid)
+    dxdydz=GetFiniteDifferenceDxDyDz(grid)
+    return dv*sum(WeightedGram(CurrentMap(gains,dxdydz,k)) for k in range(3))
+def PhiCMatrix(geom,grid,gains):
+    dv=GetGridDV(grid)
+    dxdydz=GetFiniteDifferenceDxDyDz(grid)
+    mask=InsideCoreMask(geom,grid)
+    return dv*sum(WeightedGram(CurrentMap(gains,dxdydz,k),mask) for k in range(3))
+def ChiMatrix(geom,grid,gains):
+    dv=GetGridDV(grid)
+    dxdydz=GetFiniteDifferenceDxDyDz(grid)
+    w=GaussianWeights(grid,geom[2,0:3],geom[2,6])
+    return dv*sum(WeightedGram(CurrentMap(gains,dxdydz,k),w) for k in range(3))
+def OmegaMatrix(geom,grid,gains):
+    J0=geom[2,3:6]
+    dv=GetGridDV(grid)
+    dxdydz=GetFiniteDifferenceDxDyDz(grid)
+    w=GaussianWeights(grid,geom[2,0:3],geom[2,6])
+    M=sum(J0[k]*CurrentMap(gains,dxdydz,k) for k in range(3))
+    return dv*WeightedGram(M,w)
+def KsiMatrix(geom,grid,gains):
+    dv=GetGridDV(grid)
+    w=GaussianWeights(grid,geom[2,0:3],geom[2,6])
+    return dv*WeightedGram(ActivationMap(gains,GetFiniteDifferenceDxDyDz(grid)),w)
+def QuadraticForm(Q,inj):
+    return numpy.dot(inj,numpy.dot(Q,inj))
+def BatchQuadraticForm(Q,injs):
+    #QuadraticForm(Q,injs[:,j]) for all patterns j
+    return numpy.sum(injs*numpy.dot(Q,injs),axis=0)
+def ConstraintMatrix(NumberOfElectrodes):
+    #inj=numpy.dot(P,cinj) with inj=[cinj,-sum(cinj)]
+    N=NumberOfElectrodes
+    return numpy.vstack((numpy.eye(N-1),-numpy.ones((1,N-1))))
+def SolveRatio(Qa,Qb,scale=1.):
+    #The minimum of scale*(inj^T Qa inj)/(inj^T Qb inj) with sum(inj)=0, and the normalized inj.
+    #It is the largest eigenvalue lambda of Qb x = lambda Qa x restricted to sum(inj)=0,
+    #Qa (PhiN) being positive definite.
+    P=ConstraintMatrix(len(Qa))
+    A=numpy.dot(P.T,numpy.dot(Qa,P))
+    B=numpy.dot(P.T,numpy.dot(Qb,P))
+    values,vectors=scipy.linalg.eigh(B,A)
+    inj=numpy.dot(P,vectors[:,-1])
+    return scale/values[-1],inj/numpy.linalg.norm(inj)
+
+class QuadraticForms:
+    #The Q matrices of the metrics, built on first use and kept for the last value of the geometry
+    #row they depend on, as the RegionMasks: PhiN depends on the gains only and is kept for good,
+    #PhiC on the core (geom[0]), Chi, Omega and Ksi on the focus (geom[2]).
+    Builders={'PhiN':(PhiNMatrix,None),'PhiC':(PhiCMatrix,0),'Chi':(ChiMatrix,2),
+              'Omega':(OmegaMatrix,2),'Ksi':(KsiMatrix,2)}
+    #objective: (numerator, denominator, scale)
+    Objectives={'Phi':('PhiN','PhiC',None),'Chi':('PhiN','Chi',1.),
+                'Omega':('PhiN','Omega',1.),'Ksi':('PhiN','Ksi',1000000.)}
+    def __init__(self,grid,gains):
+        self.grid=grid
+        self.gains=gains
+        self.matrices={}
+        self.built=0 #number of matrices built
+    def Q(self,name,geom):
+        builder,row=self.Builders[name]
+        key=None if row is None else geom[row].tobytes()
+        if name not in self.matrices or self.matrices[name][0]!=key:
+            self.matrices[name]=(key,builder(geom,self.grid,self.gains))
+            self.built+=1
+        return self.matrices[name][1]
+    def Metric(self,name,inj,geom):
+        return QuadraticForm(self.Q(name,geom),inj)
+    def Scale(self,name,geom):
+        scale=self.Objectives[name][2]
+        if scale is None:
+            #f_Phi=PhiN*VolumeCore/(PhiC*VolumeNerve)
+            return VolumeCore(geom,self.grid)/float(VolumeNerve(geom,self.grid))
+        return scale
+    def Objective(self,name,inj,geom):
+        a,b,_=self.Objectives[name]
+        return self.Scale(name,geom)*self.Metric(a,inj,geom)/self.Metric(b,inj,geom)
+    def ObjectiveGrad(self,name,inj,geom):
+        a,b,_=self.Objectives[name]
+        Qa=self.Q(a,geom)
+        Qb=self.Q(b,geom)
+        qa=QuadraticForm(Qa,inj)
+        qb=QuadraticForm(Qb,inj)
+        return self.Scale(name,geom)*(2*numpy.dot(Qa,inj)/qb-2*qa*numpy.dot(Qb,inj)/(qb*qb))
+    def BatchMetrics(self,injs,geom):
+        #BatchMetrics from the Q matrices
+        injs=numpy.asarray(injs,float)
+        metrics=dict((name,BatchQuadraticForm(self.Q(name,geom),injs)) for name in BatchMetricNames)
+        return BatchObjectives(metrics,geom,self.grid)
+    def Solve(self,name,geom):
+        #The minimum of the objective and the normalized inj where it is reached
+        a,b,_=self.Objectives[name]
+        return SolveRatio(self.Q(a,geom),self.Q(b,geom),self.Scale(name,geom))
 def Normalize(inj,geom,grid,gains):
     #A way to scale injected currents.  This should produce comparable current densities throughout the nerve.
     return numpy.array((1/PhiN(inj,geom,grid,gains))**.5 *inj,float)
@@ -440,26 +1469,62 @@ def InjFromCinj(cinj,NumberOfElectrodes):
     temp[0:CN]=cinj
     temp[CN]=-sum(cinj)
     return numpy.array(temp,float)
-def SymmetricalMatch(inj1,inj2):
+def SymmetricalMatch(inj1,inj2,geom=None):
     # try to find a transformation T (combining rotations and symmetries)
     # that minimizes the L2 norm between inj1 and T(inj2)
+    # (only the transformations leaving geom invariant, see AllowedSymmetries)
     bestinj2=inj2;
-    bestnorm=numpy.norm(inj1-bestinj2,2)
-    newinj2=inj2;
-    for mirrortype in range(0,4):
-        newinj2=Mirror(newinj2,mirrortype)
-        for i in range(0,4):
-            newinj2=Rotation(newinj2)
-            newnorm=numpy.norm(inj1-newinj2,2)
-            if (newnorm<bestnorm):
-                bestnorm=newnorm
-                bestinj2=newinj2
+    bestnorm=numpy.linalg.norm(inj1-bestinj2,2)
+    for newinj2 in SymmetricalImages(inj2,geom)[1:]:
+        newnorm=numpy.linalg.norm(inj1-newinj2,2)
+        if (newnorm<bestnorm):
+            bestnorm=newnorm
+            bestinj2=newinj2
     return bestinj2
+def AllowedSymmetries(geom,tol=1e-9):
+    # (axial,exchange): which symmetries of the electrodes leave the geometry invariant, so that
+    # the metrics of inj and of its transformation are equal.  The cuffs are centered on the
+    # nerve axis, but the angles of the electrodes are not known: the rotations and the mirrors
+    # through planes containing the axis (axial) need the core and the focus on the axis and J0
+    # along it.  Exchanging the outer cuffs needs SymmetricalCuffs, the core and the focus
+    # centered on the central cuff (at the center of the nerve), and J0 along or across the axis.
+    axis=geom[1,0:3]
+    J0=geom[2,3:6]
+    scale=tol*max(1.,numpy.linalg.norm(J0))
+    axial=(numpy.linalg.norm(geom[0,0:2]-axis[0:2])<=tol and numpy.linalg.norm(geom[2,0:2]-axis[0:2])<=tol
+           and numpy.linalg.norm(J0[0:2])<=scale)
+    exchange=(SymmetricalCuffs and abs(geom[0,2]-axis[2])<=tol and abs(geom[2,2]-axis[2])<=tol
+              and (abs(J0[2])<=scale or numpy.linalg.norm(J0[0:2])<=scale))
+    return axial,exchange
+def SymmetricalImages(inj,geom=None):
+    # inj and its transformations by the symmetries of the 3 cuffs of 4 electrodes: the 4
+    # rotations, with or without a mirror, with or without exchanging the outer cuffs.
+    # With geom, only the symmetries of AllowedSymmetries(geom), else all of them.
+    # Only inj for other numbers of electrodes.
+    if len(inj)!=12:
+        return [inj]
+    axial,exchange=(True,True) if geom is None else AllowedSymmetries(geom)
+    images=[]
+    for mirrortype in ((0,3) if exchange else (0,)):
+        for reflection in ((0,1) if axial else (0,)):
+            newinj=Mirror(Mirror(inj,mirrortype),reflection)
+            for i in range(0,4 if axial else 1):
+                images.append(newinj)
+                newinj=Rotation(newinj)
+    return images
+def SymmetricalDistance(inj1,inj2,geom=None):
+    # L2 distance between the normalized inj1 and the closest transformation of the normalized
+    # inj2 or -inj2: the metrics are ratios of quadratic forms, invariant to the scale of inj
+    inj1=inj1/numpy.linalg.norm(inj1)
+    inj2=inj2/numpy.linalg.norm(inj2)
+    return min(numpy.linalg.norm(inj1-sign*image) for image in SymmetricalImages(inj2,geom) for sign in (1,-1))
 
 def Rotation(v):
-    mat=numpy.diag(numpy.ones(11),1)
-    mat[11,0]=1
-    return mat*v
+    # rotation of a quarter turn of each cuff (electrodes 4k to 4k+3)
+    mat=numpy.zeros((12,12))
+    for i in range(0,12):
+        mat[i,4*(i//4)+(i+1)%4]=1
+    return numpy.dot(mat,v)
 def Mirror(v,type):
     if type==0:
         #type 0: identity
@@ -467,20 +1532,13 @@ def Mirror(v,type):
     elif type==1:
         # type 1: mirror through a horizontal plane containing z
         mat=numpy.zeros((12,12));
-        for i in range(0,4):
-            mat[i,4-i]=1
-        for i in range(4,8):
-            mat[i,8-i]=1
-        for i in range(8,12):
-            mat[i,12-i]=1
+        for i in range(0,12):
+            mat[i,4*(i//4)+3-i%4]=1
     elif type==2:
         #type 2: mirror through a vertical plane containing z
         mat=numpy.zeros((12,12));
-        for i in range(0,6):
-            mat[2*i,2*i]=1
-        for i in range(1,6):
-            mat[2*i-1,2*i+1]=1
-            mat[2*i+1,2*i-1]=1
+        for i in range(0,12):
+            mat[i,4*(i//4)+(4-i%4)%4]=1
     elif type==3:
         # type 3: mirror through the central electrode (only if intercuff distances
         # are equal)
@@ -491,4 +1549,170 @@ def Mirror(v,type):
             mat[i,i]=1
         for i in range(8,12):
             mat[i,i-8]=1
-    return mat*v
+    return numpy.dot(mat,v)
+
+#The workspace of the MultiStart worker processes, with the settings of the calling workspace.
+MultiStartWorkspace=None
+MultiStartGeom=None
+MultiStartMemory=[]
+
+def SharedArray(array,memory):
+    #Copies array to a new shared memory block, appended to memory, and returns how to attach it.
+    block=shared_memory.SharedMemory(create=True,size=max(1,array.nbytes))
+    memory.append(block)
+    numpy.ndarray(array.shape,dtype=array.dtype,buffer=block.buf)[...]=array
+    return (block.name,array.shape,array.dtype.str)
+def AttachSharedArray(shared):
+    if isinstance(shared,(numpy.ndarray,StencilGains)):
+        return shared
+    if isinstance(shared[0],StencilGains):
+        return shared[0].WithBase(AttachSharedArray(shared[1]))
+    if isinstance(shared[1],dict):
+        return Grid(AttachSharedArray(shared[0]),**shared[1])
+    name,shape,dtype=shared
+    block=shared_memory.SharedMemory(name=name)
+    MultiStartMemory.append(block)
+    return numpy.ndarray(shape,dtype=dtype,buffer=block.buf)
+def InitMultiStartWorker(grid,gains,settings):
+    global MultiStartWorkspace,MultiStartGeom
+    ws=workspace(None,None,grid=AttachSharedArray(grid),gains=AttachSharedArray(gains))
+    for name,value in settings.items():
+        setattr(ws,name,value)
+    ws.Verbose=False
+    MultiStartWorkspace=ws
+    MultiStartGeom=numpy.array(settings['geom'])
+def RunStart(task):
+    return RunStartOn(MultiStartWorkspace,MultiStartGeom,task)
+def RunStartOn(ws,geom,task):
+    #One start of workspace.MultiStart on the workspace ws, from the geometry geom
+    optimizer,start,seed=task
+    ws.geom=numpy.array(geom)
+    numpy.random.seed(seed)
+    t0=time.time()
+    x=getattr(ws,optimizer)()
+    elapsed=time.time()-t0
+    if isinstance(x,tuple):
+        x=x[0] #OptimizeKsi also returns all the iterates.
+    CN=ws.ConstrainedNumberOfElectrodes
+    return dict(Start=start,Seed=seed,Value=float(ws.CurrentFunc(x)),Inj=InjFromCinj(x[0:CN],ws.NumberOfElectrodes),
+                Focus=numpy.array(x[CN:CN+3] if len(x)>CN else ws.geom[2,0:3]),Time=elapsed,Process=os.getpid())
+
+class MultiStartResults:
+    #The starts of workspace.MultiStart (in order) and their distinct optima, ranked by value.
+    #Starts whose focus is within tol and whose injections match up to SymmetricalDistance<tol
+    #(with the symmetries of geom with this focus) are merged into the best of them.
+    def __init__(self,optimizer,starts,walltime,tol,geom=None):
+        self.Optimizer=optimizer
+        self.Starts=sorted(starts,key=lambda s: s['Start'])
+        self.WallTime=walltime
+        self.Optima=[]
+        for s in sorted(self.Starts,key=lambda s: s['Value']):
+            if geom is not None:
+                geom=numpy.array(geom)
+                geom[2,0:3]=s['Focus']
+            for optimum in self.Optima:
+                if numpy.linalg.norm(optimum['Focus']-s['Focus'])<tol and SymmetricalDistance(optimum['Inj'],s['Inj'],geom)<tol:
+                    optimum['Starts'].append(s['Start'])
+                    optimum['Time']+=s['Time']
+                    break
+            else:
+                self.Optima.append(dict(Rank=len(self.Optima)+1,Value=s['Value'],Inj=s['Inj'],Focus=s['Focus'],Starts=[s['Start']],Time=s['Time']))
+    def Best(self):
+        return self.Optima[0]
+    def Table(self):
+        lines=["%s: %d starts, %d optima, %.3f s (%.3f s in the starts)"%(self.Optimizer,len(self.Starts),len(self.Optima),self.WallTime,sum(s['Time'] for s in self.Starts)),
+               "%5s %14s %6s %10s  %s"%("rank","value","hits","time (s)","starts")]
+        for optimum in self.Optima:
+            lines.append("%5d %14.6g %6d %10.3f  %s"%(optimum['Rank'],optimum['Value'],len(optimum['Starts']),optimum['Time'],optimum['Starts']))
+        return "\n".join(lines)
+    def __str__(self):
+        return self.Table()
+
+class OptimizationTrace:
+    #The iterations of one optimization: for each, the objective and the gradient norm at the
+    #iterate, the numbers of evaluations, and the time split between the gain products, the masks
+    #and the weights (the Timed functions) and the rest.  The objective and the gradient are
+    #wrapped (Objective, Gradient) to record the evaluations of the optimizer, and Callback looks
+    #the iterate up among them: no evaluation is added.  Used as a context manager, it is the
+    #ActiveTrace of the Timed functions.
+    Categories=['Products','Masks','Weights']
+    Columns=['Iteration','Objective','GradientNorm','FunctionEvaluations','GradientEvaluations','Time']+Categories+['Other']
+    def __init__(self,name='',printing=False):
+        self.Name=name
+        self.Printing=printing
+        self.Records=[]
+        self.FunctionEvaluations=0
+        self.GradientEvaluations=0
+        self.Times=dict((category,0.) for category in self.Categories)
+        self.Timing=False
+        self.values={} #x.tobytes() -> objective, since the last iterate
+        self.gradients={}
+        self.previous=None
+    def __enter__(self):
+        global ActiveTrace
+        self.outer=ActiveTrace
+        ActiveTrace=self
+        self.previous=(time.perf_counter(),dict(self.Times))
+        if self.Printing:
+            print(self.Header())
+        return self
+    def __exit__(self,exc_type,exc_value,traceback):
+        global ActiveTrace
+        ActiveTrace=self.outer
+    def Objective(self,f):
+        def objective(x):
+            value=f(x)
+            self.FunctionEvaluations+=1
+            self.values[numpy.asarray(x,float).tobytes()]=value
+            return value
+        return objective
+    def Gradient(self,fprime):
+        if fprime is None:
+            return None #finite differences, counted as function evaluations
+        def gradient(x):
+            value=fprime(x)
+            self.GradientEvaluations+=1
+            self.gradients[numpy.asarray(x,float).tobytes()]=value
+            return value
+        return gradient
+    def Callback(self,x):
+        key=numpy.asarray(x,float).tobytes()
+        now=time.perf_counter()
+        t0,times0=self.previous
+        record=dict(Iteration=len(self.Records)+1,Objective=float(self.values.get(key,numpy.nan)),
+                    GradientNorm=float(numpy.linalg.norm(self.gradients[key])) if key in self.gradients else numpy.nan,
+                    FunctionEvaluations=self.FunctionEvaluations,GradientEvaluations=self.GradientEvaluations,Time=now-t0)
+        for category in self.Categories:
+            record[category]=self.Times[category]-times0[category]
+        record['Other']=record['Time']-sum(record[category] for category in self.Categories)
+        self.Records.append(record)
+        #the evaluations of the next iteration start from this iterate
+        self.values={key:self.values[key]} if key in self.values else {}
+        self.gradients={key:self.gradients[key]} if key in self.gradients else {}
+        self.previous=(now,dict(self.Times))
+        if self.Printing:
+            print(self.Row(record))
+    def __len__(self):
+        return len(self.Records)
+    def Column(self,name):
+        return numpy.array([record[name] for record in self.Records])
+    def Header(self):
+        return "%s: %5s %14s %10s %6s %6s %10s %10s %10s %10s %10s"%((self.Name,'iter','objective','|grad|','nfev','ngev','time (s)')+tuple(c.lower() for c in self.Categories)+('other',))
+    def Row(self,record):
+        return "%s: %5d %14.6g %10.3g %6d %6d %10.4f %10.4f %10.4f %10.4f %10.4f"%((self.Name,)+tuple(record[c] for c in self.Columns))
+    def Table(self):
+        return "\n".join([self.Header()]+[self.Row(record) for record in self.Records])
+    def __str__(self):
+        return self.Table()
+    def SaveJSON(self,filename):
+        #{"Name":..., "Columns":[...], "Records":[{column:value}...]}, with null for missing values
+        records=[dict((c,None if numpy.isnan(r[c]) else r[c]) for c in self.Columns) for r in self.Records]
+        with open(filename,'w') as fid:
+            json.dump(dict(Name=self.Name,Columns=self.Columns,Records=records),fid,indent=1)
+    def SaveCSV(self,filename):
+        #One line per iteration, with the Columns as header and empty missing values
+        with open(filename,'w',newline='') as fid:
+            writer=csv.DictWriter(fid,fieldnames=self.Columns)
+            writer.writeheader()
+            for r in self.Records:
+                writer.writerow(dict((c,'' if numpy.isnan(r[c]) else repr(r[c])) for c in self.Columns))
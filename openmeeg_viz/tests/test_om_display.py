@@ -1,5 +1,7 @@
 import sys
 from os import path as op
+import shutil
+import tempfile
 import openmeeg as om
 import numpy as np
 from openmeeg_viz import display_vtp # visualiation with VTK
@@ -23,3 +25,58 @@ def test_display_vtp():
 def test_display_vtk():
     potentials = np.random.random_sample((m.nb_vertices(),1))
     assert(display_vtk(op.join(base_dir,"brain.vtk"), potentials) == None)
+
+def test_add_source_arrays():
+    import vtk
+    from numpy.testing import assert_array_equal
+    from vtk.util.numpy_support import vtk_to_numpy
+    from openmeeg_viz.om_display import add_source_arrays
+    poly = vtk.vtkPolyData()
+    data = np.random.random_sample((10, 3))
+    expected = data.copy()
+    add_source_arrays(poly.GetPointData(), data, 'Potentials')
+    del data  # the VTK arrays keep the memory alive
+    for j in range(3):
+        array = poly.GetPointData().GetArray('Potentials-'+str(j))
+        assert_array_equal(vtk_to_numpy(array), expected[:, j])
+
+def test_triangles_to_cell_array():
+    import warnings
+    import vtk
+    from openmeeg_viz.om_display import triangles_to_cell_array
+    triangles = np.array([[0, 1, 2], [2, 3, 0], [1, 3, 2]])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        polys = triangles_to_cell_array(triangles)
+    assert(polys.GetNumberOfCells() == len(triangles))
+    ids = vtk.vtkIdList()
+    for j, triangle in enumerate(triangles):
+        polys.GetCellAtId(j, ids)
+        assert([ids.GetId(i) for i in range(3)] == list(triangle))
+
+def test_poly_metadata():
+    import vtk
+    from openmeeg_viz.om_display import get_metadata
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(op.join(base_dir, 'sample.vtp'))
+    reader.Update()
+    poly = reader.GetOutput()
+    metadata = get_metadata(poly, op.join(base_dir, 'sample.vtp'))
+    assert(metadata is get_metadata(poly, op.join(base_dir, 'sample.vtp')))
+    # the cache keeps only the last files
+    from openmeeg_viz import om_display
+    tempdir = tempfile.mkdtemp()
+    try:
+        for j in range(om_display.MAX_METADATA + 2):
+            fname = op.join(tempdir, 'sample%d.vtp' % j)
+            shutil.copy(op.join(base_dir, 'sample.vtp'), fname)
+            get_metadata(poly, fname)
+        assert(len(om_display._metadata_cache) == om_display.MAX_METADATA)
+    finally:
+        shutil.rmtree(tempdir)
+    assert(metadata.nb_sources == 2)
+    assert(metadata.nb_meshes == 3)
+    assert(metadata.cell_ranges[-1, 1] == poly.GetNumberOfCells())
+    labels = poly.GetCellData().GetAbstractArray('Names')
+    for name, first in zip(metadata.mesh_names, metadata.first_cells):
+        assert(labels.GetValue(int(first)) == name)
@@ -0,0 +1,67 @@
+import numpy as np
+from numpy.testing import assert_array_equal
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
+
+from openmeeg_viz import om_picker
+from openmeeg_viz.om_picker import MeshPicker, poly_triangles
+
+
+def _sphere():
+    sphere = vtk.vtkSphereSource()
+    sphere.SetThetaResolution(40)
+    sphere.SetPhiResolution(40)
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(sphere.GetOutputPort())
+    triangles.Update()
+    poly = triangles.GetOutput()
+    for attributes, n in ((poly.GetPointData(), poly.GetNumberOfPoints()),
+                          (poly.GetCellData(), poly.GetNumberOfCells())):
+        indices = numpy_to_vtk(np.arange(n, dtype=np.float64), deep=1)
+        indices.SetName('Indices')
+        attributes.AddArray(indices)
+    return poly
+
+
+def test_mesh_picker():
+    poly = _sphere()
+    bounds = (-0.5, 0.1, -0.2, 0.3, -1., 1.)
+    planes = vtk.vtkPlanes()
+    planes.SetBounds(bounds)
+    points = vtk_to_numpy(poly.GetPoints().GetData())
+    picker = MeshPicker(poly, leaf_size=16)
+    for cells, coords in ((False, points),
+                          (True, points[poly_triangles(poly)].mean(axis=1))):
+        inside = np.ones(len(coords), dtype=bool)
+        for k in range(3):
+            inside &= (coords[:, k] >= bounds[2 * k]) & \
+                (coords[:, k] <= bounds[2 * k + 1])
+        ids = picker.frustum(planes, cells=cells)
+        assert_array_equal(np.sort(ids), np.flatnonzero(inside))
+        data = picker.extract(ids, cells=cells)
+        attributes = data.GetCellData() if cells else data.GetPointData()
+        assert_array_equal(np.sort(vtk_to_numpy(
+            attributes.GetArray('Indices'))), np.flatnonzero(inside))
+        # the nearest among the picked ones
+        position = np.array([-2., 0., 0.])
+        nearest = picker.nearest(position, ids, cells=cells)
+        distances = ((coords[ids] - position) ** 2).sum(axis=1)
+        assert(nearest == ids[np.argmin(distances)])
+    assert(picker.nearest([0., 0., 2.]) ==
+           np.argmin(((points - [0., 0., 2.]) ** 2).sum(axis=1)))
+
+
+def test_get_picker():
+    polys = [_sphere() for _ in range(om_picker.MAX_PICKERS + 2)]
+    picker = om_picker.get_picker(polys[0])
+    assert(om_picker.get_picker(polys[0]) is picker)
+    for poly in polys:
+        om_picker.get_picker(poly)
+    # only the last meshes are kept
+    assert(len(om_picker._pickers) == om_picker.MAX_PICKERS)
+    assert(id(polys[0]) not in om_picker._pickers)
+    picker = om_picker.get_picker(polys[-1])
+    assert(picker.poly is polys[-1])
+    # rebuilt when the points change
+    polys[-1].GetPoints().Modified()
+    assert(om_picker.get_picker(polys[-1]) is not picker)
@@ -0,0 +1,44 @@
+from os import path as op
+import shutil
+import tempfile
+
+from openmeeg_viz import om_snapshot, render_snapshots
+
+
+base_dir = op.join(op.dirname(__file__), 'data')
+
+
+def test_render_snapshots():
+    views = ('left', 'top')
+    images = render_snapshots([op.join(base_dir, 'brain.tri'),
+                               op.join(base_dir, 'sample.geom')],
+                              views=views, size=(120, 100))
+    assert(len(images) == 2)
+    for image in images:
+        assert(sorted(image.keys()) == sorted(views))
+        assert(image['left'].shape == (100, 120, 3))
+        # something was drawn over the white background
+        assert((image['left'] != 255).any())
+    # the caller's process keeps no render window
+    assert(om_snapshot._renderer is None)
+
+
+def test_render_snapshots_pool():
+    out_dir = tempfile.mkdtemp()
+    try:
+        images = render_snapshots(op.join(base_dir, '*.tri'), out_dir=out_dir,
+                                  views=('front',), n_jobs=2,
+                                  return_images=False)
+        assert(images == [None] * 3)
+        for name in ('brain', 'head', 'skull'):
+            assert(op.exists(op.join(out_dir, name + '.tri_front.png')))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def test_render_snapshots_few_files():
+    """No more workers than files"""
+    images = render_snapshots(op.join(base_dir, 'brain.tri'),
+                              views=('front',), size=(60, 50), n_jobs=8)
+    assert(len(images) == 1 and images[0]['front'].shape == (50, 60, 3))
+    assert(om_snapshot._renderer is None)
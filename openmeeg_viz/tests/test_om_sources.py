@@ -0,0 +1,45 @@
+from os import path as op
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+from openmeeg_viz.om_sources import read_matrix, LazySources
+
+
+def test_read_matrix():
+    tempdir = tempfile.mkdtemp()
+    try:
+        data = np.random.random_sample((7, 5))
+        # OpenMEEG binary format: sizes then column major values
+        fname = op.join(tempdir, 'leadfield.bin')
+        with open(fname, 'wb') as fid:
+            np.array(data.shape, dtype=np.uint32).tofile(fid)
+            data.T.tofile(fid)
+        assert_array_equal(read_matrix(fname), data)
+        fname = op.join(tempdir, 'leadfield.npy')
+        np.save(fname, data)
+        assert_array_equal(read_matrix(fname), data)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def test_lazy_sources():
+    data = np.random.random_sample((7, 5))
+    sources = LazySources(data, 'Potentials', cache_size=2)
+    assert(sources.n_sources == 5)
+    assert(sources.column(1) is sources.column(1))
+    sources.column(2)
+    sources.column(3)  # source 1 is dropped from the cache
+    assert(sorted(sources._cache.keys()) == [2, 3])
+    assert_array_equal(sources.rows([4, 0]), data[[4, 0]])
+
+    point_data = vtk.vtkPolyData().GetPointData()
+    for j in (0, 4):
+        sources.activate(point_data, j)
+        assert(point_data.GetNumberOfArrays() == 1)
+        assert(point_data.GetScalars().GetName() == 'Potentials-%d' % j)
+        assert_array_equal(vtk_to_numpy(point_data.GetScalars()), data[:, j])
@@ -76,6 +76,18 @@ def check_usage(module, force_help=False):
         assert_true('Usage:' in out.stdout.getvalue())
 
 
+def check_usage_error(module, args):
+    """Helper to ensure a bad command line prints usage and exits with 2"""
+    with ArgvSetter(args) as out:
+        try:
+            module.run()
+        except SystemExit as e:
+            assert_true(e.code == 2)
+        else:
+            raise AssertionError('%s did not exit' % (args,))
+        assert_true('Usage:' in out.stderr.getvalue())
+
+
 def test_om_viz():
     """Test om_viz"""
     from mayavi import mlab
@@ -85,3 +97,62 @@ def test_om_viz():
     check_usage(om_viz)
     with ArgvSetter((geom_fname,)):
         om_viz.run()
+
+
+def test_read_tri_cache():
+    """Test the binary sidecar cache of read_tri"""
+    import numpy as np
+    from numpy.testing import assert_array_equal
+    import om_viz
+    from openmeeg_viz.om_mesh import _load_tri_cache
+
+    fname = op.join(tempdir, 'brain.tri')
+    shutil.copy(op.join(base_dir, 'brain.tri'), fname)
+    points, normals, faces = om_viz.read_tri(fname)
+    assert_true(points.dtype == np.float64 and faces.dtype == np.int32)
+    assert_true(_load_tri_cache(fname) is None)
+    for _ in range(2):  # the second read is served by the cache
+        mesh = om_viz.Mesh(fname, cache=True)
+        assert_array_equal(mesh.points, points)
+        assert_array_equal(mesh.normals, normals)
+        assert_array_equal(mesh.faces, faces)
+    assert_true(_load_tri_cache(fname) is not None)
+    # blocks of 0 rows do not consume the header of the next block
+    for text, n_points in (('- 3\n0 0 0 0 0 1\n1 0 0 0 0 1\n0 1 0 0 0 1\n'
+                            '- 0 0 0\n', 3), ('- 0\n- 0 0 0\n', 0)):
+        fname = op.join(tempdir, 'empty%d.tri' % n_points)
+        with open(fname, 'w') as fid:
+            fid.write(text)
+        for cache in (False, True, True):
+            points, normals, faces = om_viz.read_tri(fname, cache=cache)
+            assert_true(points.shape == (n_points, 3))
+            assert_true(normals.shape == (n_points, 3))
+            assert_true(faces.shape == (0, 3) and faces.dtype == np.int32)
+
+
+def test_load_meshes():
+    """Test concurrent loading of the meshes of a .geom file"""
+    from numpy.testing import assert_array_equal
+    import om_viz
+
+    fnames = om_viz.read_geom(geom_fname)
+    meshes = om_viz.load_meshes(fnames, n_jobs=2, verbose=False)
+    assert_true(len(meshes) == len(fnames))
+    for fname, mesh in zip(fnames, meshes):
+        assert_array_equal(mesh.points, om_viz.read_tri(fname)[0])
+
+
+def test_parse_args():
+    """Test the options of the command line"""
+    import om_viz
+
+    fnames, options = om_viz._parse_args(['--jobs', '2', 'a.tri', '--cache',
+                                          '--size=300x200', 'b.geom'])
+    assert_true(fnames == ['a.tri', 'b.geom'])
+    assert_true(options['n_jobs'] == 2 and options['cache'])
+    assert_true(options['size'] == (300, 200))
+    for args in (('a.tri', '--jobs'), ('--jobs', 'a.tri'),
+                 ('--jobs', '--cache', 'a.tri'), ('--jobs=0', 'a.tri'),
+                 ('--size', '300', 'a.tri'), ('--color', 'red', 'a.tri'),
+                 ('snapshot', 'a.tri'), ('snapshot', '--out')):
+        check_usage_error(om_viz, args)
@@ -0,0 +1,131 @@
+from os import path as op
+import shutil
+import tempfile
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+import vtk
+from vtk.util.numpy_support import vtk_to_numpy
+
+from openmeeg_viz.om_vtk_writer import (VTKStreamWriter, structured_order,
+                                        write_vtk)
+
+
+def _read(fname):
+    if fname.endswith('.vtu'):
+        reader = vtk.vtkXMLUnstructuredGridReader()
+    elif fname.endswith('.vts'):
+        reader = vtk.vtkXMLStructuredGridReader()
+    else:
+        reader = vtk.vtkDataSetReader()
+        reader.ReadAllScalarsOn()
+        reader.ReadAllVectorsOn()
+    reader.SetFileName(fname)
+    reader.Update()
+    return reader.GetOutput()
+
+
+def test_write_vtk():
+    tempdir = tempfile.mkdtemp()
+    try:
+        dims = (3, 4, 5)
+        # a grid stored with z fastest, as the grids of omgopt
+        x, y, z = np.meshgrid(*[np.arange(d, dtype=float) for d in dims],
+                              indexing='ij')
+        points = np.column_stack((x.ravel(), y.ravel(), z.ravel()))
+        potential = np.random.random_sample(len(points))
+        current = np.random.random_sample((len(points), 3))
+        point_data = [('Potential', potential), ('Current', current),
+                      ('Magnitude', potential[:, None])]
+        order = structured_order(dims)
+        # VTK structured points: x fastest
+        assert_array_equal(points[order[:3]], [[0, 0, 0], [1, 0, 0],
+                                               [2, 0, 0]])
+        for fname, kwargs in [('points.vtk', dict()),
+                              ('ascii.vtk', dict(binary=False)),
+                              ('points.vtu', dict()),
+                              ('grid.vtk', dict(dims=dims, order=order)),
+                              ('grid.vts', dict(dims=dims, order=order))]:
+            fname = op.join(tempdir, fname)
+            # small chunks to check that they are concatenated
+            write_vtk(fname, points, point_data, chunk_size=7, **kwargs)
+            data = _read(fname)
+            rows = kwargs.get('order', np.arange(len(points)))
+            assert(data.GetNumberOfPoints() == len(points))
+            assert_allclose(vtk_to_numpy(data.GetPoints().GetData()),
+                            points[rows], rtol=1e-6)
+            for name, array in point_data:
+                assert_allclose(
+                    vtk_to_numpy(data.GetPointData().GetArray(name)),
+                    np.squeeze(array[rows]), rtol=1e-6)
+            if 'dims' in kwargs:
+                assert(data.GetExtent() == (0, 2, 0, 3, 0, 4))
+            else:
+                assert(data.GetNumberOfCells() == len(points))
+        # no point, e.g. an empty trimmed field
+        fname = op.join(tempdir, 'empty.vtk')
+        write_vtk(fname, points[:0], [('Potential', potential[:0])])
+        assert(_read(fname).GetNumberOfPoints() == 0)
+        with pytest.raises(ValueError):
+            write_vtk(op.join(tempdir, 'grid.vts'), points)
+        with pytest.raises(ValueError):
+            write_vtk(op.join(tempdir, 'grid.vtk'), points, dims=(2, 2, 2))
+        with pytest.raises(ValueError):
+            write_vtk(op.join(tempdir, 'points.vtk'), points,
+                      [('Potential', potential[1:])])
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def test_stream_writer():
+    tempdir = tempfile.mkdtemp()
+    try:
+        dims = (3, 4, 5)
+        points = np.random.random_sample((60, 3))
+        potential = np.random.random_sample(60)
+        current = np.random.random_sample((60, 3))
+        order = structured_order(dims)
+        for start, stop in [(0, 7), (7, 32), (32, 60)]:
+            assert_array_equal(structured_order(dims, start, stop),
+                               order[start:stop])
+        # the title of legacy files is the file name by default
+        for fname, kwargs in [('points.vtk', dict(title='t')),
+                              ('ascii.vtk', dict(binary=False, title='t')),
+                              ('points.vtu', dict()),
+                              ('grid.vtk', dict(dims=dims, title='t')),
+                              ('grid.vts', dict(dims=dims))]:
+            stream = op.join(tempdir, 'stream_' + fname)
+            fname = op.join(tempdir, fname)
+            write_vtk(fname, points[order], [('Potential', potential[order]),
+                                             ('Current', current[order])],
+                      **kwargs)
+            with VTKStreamWriter(stream, **kwargs) as writer:
+                for start, stop in [(0, 7), (7, 7), (7, 60)]:
+                    rows = order[start:stop]
+                    writer.append(points[rows],
+                                  [('Potential', potential[rows]),
+                                   ('Current', current[rows])])
+            with open(fname, 'rb') as fid, open(stream, 'rb') as f:
+                assert(fid.read() == f.read())
+            if 'dims' not in kwargs:
+                continue
+            # appended in the storage order of the grid
+            with VTKStreamWriter(stream, reorder=True, **kwargs) as writer:
+                for rows in [slice(0, 13), slice(13, 60)]:
+                    writer.append(points[rows],
+                                  [('Potential', potential[rows]),
+                                   ('Current', current[rows])])
+            with open(fname, 'rb') as fid, open(stream, 'rb') as f:
+                assert(fid.read() == f.read())
+        with pytest.raises(ValueError):
+            VTKStreamWriter(op.join(tempdir, 'points.vtk'), reorder=True)
+        # nothing written on errors
+        fname = op.join(tempdir, 'error.vtk')
+        with pytest.raises(RuntimeError):
+            with VTKStreamWriter(fname) as writer:
+                writer.append(points, [('Potential', potential)])
+                raise RuntimeError
+        assert(not op.exists(fname))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
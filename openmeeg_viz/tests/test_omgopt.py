@@ -0,0 +1,580 @@
+import csv
+import json
+import os
+from os import path as op
+import shutil
+import tempfile
+import tracemalloc
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+import pytest
+
+from openmeeg_viz import omgopt
+
+
+def _problem(n=8, n_electrodes=12):
+    rng = np.random.RandomState(42)
+    grid = omgopt.GenerateCubicGrid(-1., 1., n, -1., 1., n, -12., 12., n)
+    geom = np.array([[0., 0., 0., 5., .3, 0., 0.],
+                     [0., 0., 0., 12., .95, 0., 0.],
+                     [.1, -.2, 1., .6, 0., .8, .3]])
+    gains = rng.randn(5, len(grid), n_electrodes)
+    inj = omgopt.InjFromCinj(rng.randn(n_electrodes - 1), n_electrodes)
+    return inj, geom, grid, gains
+
+
+def test_masks():
+    inj, geom, grid, gains = _problem()
+    for mask, is_inside in ((omgopt.InsideNerveMask, omgopt.IsInsideNerve),
+                            (omgopt.InsideCoreMask, omgopt.IsInsideCore),
+                            (omgopt.NearFocusMask, omgopt.IsNearFocus)):
+        assert_array_equal(mask(geom, grid),
+                           [is_inside(x, geom) for x in grid])
+    x0, sigma = geom[2, 0:3], geom[2, 6]
+    assert_array_equal(omgopt.GaussianWeights(grid, x0, sigma),
+                       [omgopt.W(x, x0, sigma) for x in grid])
+    for trim, is_inside in ((omgopt.TrimFieldNerve, omgopt.IsInsideNerve),
+                            (omgopt.TrimFieldCore, omgopt.IsInsideCore),
+                            (omgopt.TrimFieldFocus, omgopt.IsNearFocus)):
+        for field in (gains[0], gains[0][:, :3], gains[0][:, :1]):
+            assert_array_equal(trim(geom, grid, field),
+                               [field[i] * is_inside(grid[i], geom)
+                                for i in range(len(grid))])
+
+
+def test_region_masks():
+    inj, geom, grid, gains = _problem()
+    masks = omgopt.RegionMasks(grid)
+    assert_array_equal(masks.Core(geom), omgopt.InsideCoreMask(geom, grid))
+    assert(masks.Core(geom) is masks.Core(geom))
+    masks.Weights(geom)
+    assert(masks.computed == 2)
+    geom[2, 0] += .1  # a new focus does not change the core
+    masks.Core(geom)
+    masks.Weights(geom)
+    assert(masks.computed == 3)
+
+
+def test_workspace_compaction():
+    """The gains are only kept inside the nerve"""
+    inj, geom, grid, gains = _problem()
+    ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+    ws.geom = geom.copy()
+    nerve = omgopt.InsideNerveMask(ws.geom, grid)
+    assert(len(ws.grid) == nerve.sum() < len(grid))
+    assert_array_equal(ws.grid, grid[nerve > 0])
+    trimmed = omgopt.TrimFieldNerve(ws.geom, grid, gains.transpose(1, 0, 2))
+    trimmed = trimmed.transpose(1, 0, 2)
+    ws.UseQuadraticForms = False
+    for name in ('Phi', 'Chi', 'Omega', 'Ksi'):
+        func = getattr(omgopt, 'f_' + name)
+        assert_allclose(getattr(ws, 'f_' + name)(inj),
+                        func(inj, ws.geom, grid, trimmed), rtol=1e-12)
+
+
+def test_metrics():
+    """The metrics are equal to the per-point loops up to summation order
+    (rtol 1e-12)"""
+    inj, geom, grid, gains = _problem()
+    x0, sigma, J0 = geom[2, 0:3], geom[2, 6], geom[2, 3:6]
+    dv = np.prod(omgopt.GetGridDxDyDz(grid))
+    cur = omgopt.GetPotentialAndCurrent(inj, geom, grid, gains)[1]
+    activ = omgopt.GetActivationFunction(inj, geom, grid, gains)
+    n = range(len(grid))
+    assert_allclose(omgopt.GetCurSq(cur)[:, 0],
+                    [np.dot(cur[i], cur[i]) for i in n], rtol=1e-12)
+    assert_allclose(omgopt.GetCurrentMagnitude(cur)[:, 0],
+                    [np.linalg.norm(cur[i]) for i in n], rtol=1e-12)
+    assert_allclose(omgopt.PhiN(inj, geom, grid, gains),
+                    dv * np.sum([np.dot(cur[i], cur[i]) for i in n]),
+                    rtol=1e-12)
+    assert_allclose(omgopt.PhiC(inj, geom, grid, gains),
+                    dv * np.sum([omgopt.IsInsideCore(grid[i], geom) *
+                                 np.dot(cur[i], cur[i]) for i in n]),
+                    rtol=1e-12)
+    assert_allclose(omgopt.Chi(inj, geom, grid, gains),
+                    dv * np.sum([omgopt.W(grid[i], x0, sigma) *
+                                 np.dot(cur[i], cur[i]) for i in n]),
+                    rtol=1e-12)
+    assert_allclose(omgopt.Ksi(inj, geom, grid, gains),
+                    dv * np.sum([omgopt.W(grid[i], x0, sigma) *
+                                 (activ[i] ** 2) for i in n]),
+                    rtol=1e-12)
+    assert_allclose(omgopt.Omega(inj, geom, grid, gains),
+                    dv * np.sum([omgopt.W(grid[i], x0, sigma) *
+                                 (np.dot(cur[i], J0) ** 2) for i in n]),
+                    rtol=1e-12)
+
+
+def test_field_cache():
+    """The metrics share the gain products of the same injection"""
+    inj, geom, grid, gains = _problem()
+    cache = omgopt.FieldCache(grid, gains)
+    for func in (omgopt.f_Phi, omgopt.f_Chi, omgopt.f_Omega, omgopt.f_Ksi):
+        products = cache.products
+        assert(func(inj, geom, grid, cache) == func(inj, geom, grid, gains))
+        assert(cache.products <= products + 1)
+    assert(cache.products == 1)
+    fields = cache.Fields(inj)
+    for k in range(len(gains)):
+        assert_array_equal(fields[k], np.dot(gains[k], inj))
+    cache.Fields(-inj)
+    assert(cache.products == 2)
+
+
+def _check_grad(func, grad, x, eps=1e-6):
+    """Compare grad with centered finite differences of func"""
+    numerical = np.array([(func(x + eps * e) - func(x - eps * e)) / (2 * eps)
+                          for e in np.eye(len(x))])
+    assert_allclose(grad(x), numerical, rtol=1e-5,
+                    atol=1e-7 * np.abs(numerical).max())
+
+
+def test_gradients():
+    inj, geom, grid, gains = _problem()
+    cache = omgopt.FieldCache(grid, gains)
+    for name in ('PhiN', 'PhiC', 'Chi', 'Omega', 'Ksi'):
+        func, grad = getattr(omgopt, name), getattr(omgopt, name + 'Grad')
+        _check_grad(lambda x: func(x, geom, grid, gains),
+                    lambda x: grad(x, geom, grid, cache), inj)
+    for name in ('Phi', 'Chi', 'Omega', 'Ksi'):
+        func = getattr(omgopt, 'f_' + name)
+        grad = getattr(omgopt, 'fprime_' + name)
+        _check_grad(lambda x: func(x, geom, grid, gains),
+                    lambda x: grad(x, geom, grid, cache), inj)
+        if name == 'Phi':
+            continue
+        focus_grad = getattr(omgopt, 'fprime_%sFocus' % name)
+
+        def func_focus(x0):
+            focus_geom = geom.copy()
+            focus_geom[2, 0:3] = x0
+            return func(inj, focus_geom, grid, gains)
+
+        def grad_focus(x0):
+            focus_geom = geom.copy()
+            focus_geom[2, 0:3] = x0
+            return focus_grad(inj, focus_geom, grid, cache)
+        _check_grad(func_focus, grad_focus, geom[2, 0:3])
+
+
+def test_workspace_gradients():
+    """The gradients of the cinj (and focus) parameterizations"""
+    inj, geom, grid, gains = _problem()
+    ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+    ws.geom = geom.copy()
+    cinj = inj[:-1]
+    for name in ('Phi', 'Chi', 'Omega', 'Ksi'):
+        _check_grad(getattr(ws, 'Constrained_f_' + name),
+                    getattr(ws, 'Constrained_fprime_' + name), cinj)
+    x = np.concatenate((cinj, geom[2, 0:3]))
+    for name in ('Chi', 'Omega', 'Ksi'):
+        _check_grad(getattr(ws, 'f_%sGeom' % name),
+                    getattr(ws, 'fprime_%sGeom' % name), x)
+
+
+def test_quadratic_forms():
+    inj, geom, grid, gains = _problem()
+    forms = omgopt.QuadraticForms(grid, gains)
+    for name in ('PhiN', 'PhiC', 'Chi', 'Omega', 'Ksi'):
+        assert_allclose(forms.Metric(name, inj, geom),
+                        getattr(omgopt, name)(inj, geom, grid, gains),
+                        rtol=1e-10)
+    assert(len(forms.matrices) == 5 and forms.built == 5)
+    for name in ('Phi', 'Chi', 'Omega', 'Ksi'):
+        func = getattr(omgopt, 'f_' + name)
+        grad = getattr(omgopt, 'fprime_' + name)
+        assert_allclose(forms.Objective(name, inj, geom),
+                        func(inj, geom, grid, gains), rtol=1e-10)
+        assert_allclose(forms.ObjectiveGrad(name, inj, geom),
+                        grad(inj, geom, grid, gains), rtol=1e-8,
+                        atol=1e-10 * np.abs(grad(inj, geom, grid, gains)).max())
+        # the direct minimum is a stationary point below random injections
+        value, best = forms.Solve(name, geom)
+        assert_allclose(best.sum(), 0, atol=1e-12)
+        assert_allclose(value, func(best, geom, grid, gains), rtol=1e-8)
+        cgrad = omgopt.ConstrainedGrad(grad(best, geom, grid, gains))
+        assert(np.abs(cgrad).max() < 1e-6 * np.abs(
+            omgopt.ConstrainedGrad(grad(inj, geom, grid, gains))).max())
+        for seed in range(5):
+            other = omgopt.InjFromCinj(np.random.RandomState(seed).randn(
+                len(inj) - 1), len(inj))
+            assert(value <= func(other, geom, grid, gains))
+    # the focus matrices are rebuilt for a new focus, not PhiN and PhiC,
+    # and only the last focus is kept
+    for step in range(3):
+        geom[2, 0] += .1
+        forms.Metric('Chi', inj, geom)
+        forms.Metric('PhiN', inj, geom)
+        forms.Metric('PhiC', inj, geom)
+    assert(forms.built == 8)
+    assert(len(forms.matrices) == 5)
+    assert_allclose(forms.Metric('Chi', inj, geom),
+                    omgopt.Chi(inj, geom, grid, gains), rtol=1e-10)
+
+
+def test_workspace_solve():
+    """The eigenproblem and BFGS reach the same minimum"""
+    inj, geom, grid, gains = _problem()
+    ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+    ws.Verbose = False
+    value = ws.Solve('Chi')
+    assert_allclose(ws.f_Chi(ws.inj), value, rtol=1e-10)
+    np.random.seed(0)
+    ws.UseQuadraticForms = False
+    ws.OptimizeChi()
+    assert_allclose(ws.f_Chi(ws.inj), value, rtol=1e-5)
+
+
+def test_gain_store():
+    inj, geom, grid, gains = _problem(n=5, n_electrodes=4)
+    trimmed = omgopt.TrimFieldNerve(geom, grid, gains.transpose(1, 0, 2))
+    trimmed = trimmed.transpose(1, 0, 2)
+    rows = np.flatnonzero(omgopt.InsideNerveMask(geom, grid))
+    tempdir = tempfile.mkdtemp()
+    try:
+        prefix = op.join(tempdir, 'nerve')
+        for gain, suffix in zip(gains, omgopt.GainSuffixes):
+            np.savetxt(prefix + suffix + '.gain', gain)
+        text = omgopt.LoadStackedGains(geom, grid, prefix)
+        assert_allclose(text, trimmed, rtol=1e-15)
+        assert_array_equal(omgopt.LoadGains(geom, grid, prefix)[3], text[3])
+        fname = omgopt.ConvertGains(geom, grid, prefix)
+        assert(fname == prefix + '.gains.npy')
+        # only the rows inside the nerve are stored, and mapped as is
+        stored = omgopt.LoadStackedGains(geom, grid, prefix, rows)
+        assert(isinstance(stored, np.memmap))
+        assert(stored.shape == (5, len(rows), 4))
+        assert_array_equal(stored, text[:, rows])
+        ws = omgopt.workspace(None, prefix, grid=grid)
+        assert(isinstance(ws.gains, np.memmap))
+        assert_array_equal(ws.gains, text[:, ws.NerveRows])
+        # other rows are copied, with zeros outside the nerve
+        assert_array_equal(omgopt.LoadStackedGains(geom, grid, prefix), text)
+        some = np.array([0, rows[1], rows[-1], len(grid) - 1])
+        assert_array_equal(omgopt.LoadStackedGains(geom, grid, prefix, some),
+                           text[:, some])
+        os.remove(fname)
+        # OpenMEEG binary matrices, one per gain
+        for gain, suffix in zip(gains, omgopt.GainSuffixes):
+            with open(prefix + suffix + '.bin', 'wb') as fid:
+                np.array(gain.shape, dtype=np.uint32).tofile(fid)
+                gain.T.tofile(fid)
+        assert_array_equal(omgopt.LoadStackedGains(geom, grid, prefix),
+                           text)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def test_symmetries():
+    inj = np.random.RandomState(0).randn(12)
+    images = omgopt.SymmetricalImages(inj)
+    assert(len(images) == 16)
+    assert(len(set(tuple(image) for image in images)) == 16)
+    for image in images:
+        # the transformations permute the electrodes
+        assert_allclose(np.sort(image), np.sort(inj))
+        assert_allclose(omgopt.SymmetricalDistance(-2 * image, inj), 0,
+                        atol=1e-12)
+    assert_array_equal(omgopt.SymmetricalMatch(images[5], inj), images[5])
+    assert(len(omgopt.SymmetricalImages(inj[:4])) == 1)
+    # only the symmetries leaving the geometry invariant
+    geom = np.array([[0., 0., 0., 5., .3, 0., 0.],
+                     [0., 0., 0., 12., .95, 0., 0.],
+                     [0., 0., 0., 0., 0., 1., .3]])
+    rotated = omgopt.Rotation(inj)
+    assert(len(omgopt.SymmetricalImages(inj, geom)) == 8)
+    assert_allclose(omgopt.SymmetricalDistance(rotated, inj, geom), 0,
+                    atol=1e-12)
+    omgopt.SymmetricalCuffs = True
+    try:
+        assert(len(omgopt.SymmetricalImages(inj, geom)) == 16)
+        geom[2, 2] = 1.
+        assert(len(omgopt.SymmetricalImages(inj, geom)) == 8)
+    finally:
+        omgopt.SymmetricalCuffs = False
+    # off-axis focus: no symmetry, the rotated optimum is another one
+    geom[2, 0:3] = [.1, -.2, 1.]
+    assert(len(omgopt.SymmetricalImages(inj, geom)) == 1)
+    assert(omgopt.SymmetricalDistance(rotated, inj, geom) > .1)
+    for focus, optima in (([.1, -.2, 1.], [[0, 2], [1]]),
+                          ([0., 0., 0.], [[0, 1, 2]])):
+        # the focus of the starts, as found by the *Geom optimizers
+        starts = [dict(Start=k, Value=1. + k, Inj=x, Focus=np.array(focus),
+                       Time=0.)
+                  for k, x in enumerate((inj, rotated, -2 * inj))]
+        results = omgopt.MultiStartResults('OptimizeChiGeom', starts, 0.,
+                                           1e-3, geom)
+        assert([o['Starts'] for o in results.Optima] == optima)
+
+
+def test_multi_start():
+    inj, geom, grid, gains = _problem()
+    ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+    ws.Verbose = False
+    geom, inj = ws.geom.copy(), ws.inj.copy()
+    random_state = np.random.get_state()
+    serial = ws.MultiStart('OptimizeChi', 4, processes=1)
+    # run on the workspace, restored afterwards
+    assert(omgopt.MultiStartWorkspace is None)
+    assert_array_equal(ws.geom, geom)
+    assert_array_equal(ws.inj, inj)
+    assert(not ws.Verbose and ws.LastTrace is None)
+    assert_array_equal(np.random.get_state()[1], random_state[1])
+    pooled = ws.MultiStart('OptimizeChi', 4, processes=2)
+    assert([s['Start'] for s in pooled.Starts] == [0, 1, 2, 3])
+    for s1, s2 in zip(serial.Starts, pooled.Starts):
+        assert_allclose(s1['Inj'], s2['Inj'])
+        assert(s1['Value'] == s2['Value'])
+    # the Chi ratio has one minimum, reached by all starts
+    best = serial.Best()
+    assert(sorted(best['Starts']) == [0, 1, 2, 3])
+    assert_allclose(best['Value'], ws.Solve('Chi'), rtol=1e-5)
+    assert([o['Value'] for o in serial.Optima] ==
+           sorted(o['Value'] for o in serial.Optima))
+    assert('OptimizeChi: 4 starts' in serial.Table())
+
+
+def test_batch_metrics():
+    inj, geom, grid, gains = _problem()
+    # the workspace only keeps the nerve
+    gains = gains * omgopt.InsideNerveMask(geom, grid)[None, :, None]
+    rng = np.random.RandomState(0)
+    injs = rng.randn(12, 7)
+    injs[-1] = -injs[:-1].sum(axis=0)
+    pot, cur = omgopt.GetBatchPotentialAndCurrent(injs, geom, grid, gains)
+    activation = omgopt.GetBatchActivationFunction(injs, geom, grid, gains)
+    ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+    ws.geom = geom.copy()
+    # chunks of grid points smaller than the grid and not dividing it
+    chunked = omgopt.BatchMetrics(injs, geom, grid, gains, chunk=50)
+    cached = omgopt.BatchMetrics(injs, geom, grid, omgopt.FieldCache(grid,
+                                                                    gains))
+    quadratic = ws.Q.BatchMetrics(injs, geom)
+    assert_array_equal(ws.BatchMetrics(injs)['Chi'], quadratic['Chi'])
+    for j in range(injs.shape[1]):
+        pot1, cur1 = omgopt.GetPotentialAndCurrent(injs[:, j], geom, grid,
+                                                   gains)
+        assert_allclose(pot[:, j], pot1[:, 0], rtol=1e-12)
+        assert_allclose(cur[:, :, j], cur1, rtol=1e-12)
+        assert_allclose(activation[:, j], omgopt.GetActivationFunction(
+            injs[:, j], geom, grid, gains)[:, 0], rtol=1e-12)
+        for name in ('PhiN', 'PhiC', 'Chi', 'Omega', 'Ksi', 'f_Phi', 'f_Chi',
+                     'f_Omega', 'f_Ksi'):
+            value = getattr(omgopt, name)(injs[:, j], geom, grid, gains)
+            for metrics in (chunked, cached, quadratic):
+                assert_allclose(metrics[name][j], value, rtol=1e-10)
+    # the chunks with their temporaries fit in BatchBytes
+    inj, geom, grid, gains = _problem(n=20)
+    injs = rng.randn(12, 256)
+    batch_bytes = omgopt.BatchBytes
+    omgopt.BatchBytes = 2 ** 20
+    tracemalloc.start()
+    try:
+        omgopt.BatchMetrics(injs, geom, grid, gains)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        omgopt.BatchBytes = batch_bytes
+    assert(omgopt.BatchChunkSize(5, 256) < len(grid))
+    assert(peak < 1.1 * 2 ** 20)
+
+
+def test_stencil_gains():
+    """The currents from the base gain alone, against the five gains"""
+    n = 12
+    grid = omgopt.GenerateCubicGrid(-1., 1., n, -1., 1., n, -12., 12., 2 * n)
+    rng = np.random.RandomState(0)
+    k = rng.randn(12, 3) * [1., 1., .15]
+    # smooth gains, known on the shifted grids
+    shifted = [grid, omgopt.CreateDGrid(grid, 0), omgopt.CreateDGrid(grid, 1),
+               omgopt.CreateDGrid(grid, 2), omgopt.CreateNegDGrid(grid, 2)]
+    gains = np.array([np.sin(np.dot(g, k.T)) for g in shifted])
+    geom = np.array([[0., 0., 0., 5., .3, 0., 0.],
+                     [0., 0., 0., 12., .95, 0., 0.],
+                     [.1, -.2, 1., .6, 0., .8, .3]])
+    inj = omgopt.InjFromCinj(rng.randn(11), 12)
+    errors = omgopt.StencilErrors(inj, geom, grid, gains)
+    assert(errors['Potential'] == 0)
+    for name in ('Current', 'Activation', 'f_Phi', 'f_Chi', 'f_Omega',
+                 'f_Ksi'):
+        assert(errors[name] < .1)
+    assert('f_Chi' in omgopt.StencilReport(errors))
+
+    ws = omgopt.workspace(None, None, grid=grid, gains=gains, stencil=True)
+    ws.geom = geom.copy()
+    stencil = ws.gains
+    assert(isinstance(stencil, omgopt.StencilGains))
+    assert(stencil.shape == (5, len(ws.grid), 12))
+    dense = np.asarray(stencil)
+    assert_array_equal(dense[0], gains[0, ws.NerveRows])
+    assert_allclose(stencil.Fields(inj), omgopt.StackedProduct(dense, inj),
+                    rtol=1e-10, atol=1e-12)
+    u = rng.randn(5, len(ws.grid))
+    assert_allclose(stencil.AdjointProduct(u),
+                    omgopt.StackedAdjointProduct(dense, u), rtol=1e-10)
+    # rows of the gains, without the dense gains
+    rows = np.array([3, 0, 40, len(ws.grid) - 1])
+    assert_allclose(stencil[:, rows], dense[:, rows], rtol=1e-12, atol=1e-12)
+    assert_allclose(stencil[1:4, 5:9, 2], dense[1:4, 5:9, 2], rtol=1e-12,
+                    atol=1e-12)
+    assert_allclose(stencil[4, 7], dense[4, 7], rtol=1e-12, atol=1e-12)
+    for index in ((Ellipsis, 0), (0, 1, 2, 3), (0,)):
+        with pytest.raises(TypeError):
+            stencil[index]
+    assert(len(stencil.NoDzz) == 0)
+    injs = rng.randn(12, 3)
+    assert_allclose(stencil.BatchFields(slice(10, 50), injs),
+                    omgopt.StackedBatchProduct(dense[:, 10:50], injs),
+                    rtol=1e-10, atol=1e-12)
+    ws.UseQuadraticForms = False
+    _check_grad(ws.f_Chi, ws.fprime_Chi, inj)
+    ws.UseQuadraticForms = True
+    assert_allclose(ws.f_Chi(inj), omgopt.f_Chi(inj, geom, ws.grid, dense),
+                    rtol=1e-10)
+    # the rows of two z layers have no second difference along z
+    rows = np.flatnonzero(np.isin(grid[:, 2], np.unique(grid[:, 2])[3:5]))
+    with pytest.warns(UserWarning, match='second difference'):
+        stencil = omgopt.StencilGains(grid, rows, gains[0, rows])
+    assert_array_equal(stencil.NoDzz, np.arange(len(rows)))
+    assert_array_equal(stencil.WithBase(gains[0, rows]).NoDzz, stencil.NoDzz)
+
+
+def test_grid():
+    inj, geom, grid, gains = _problem()
+    cubic = omgopt.Grid(grid)
+    assert(cubic.Dimensions == (8, 8, 8))
+    assert(cubic.Bounds == ((-1., 1.), (-1., 1.), (-12., 12.)))
+    assert(cubic.Spacing == omgopt.GetGridDxDyDz(grid))
+    assert(omgopt.GetDimensions(cubic) == omgopt.GetDimensions(grid))
+    # the metrics do not depend on where the geometry comes from
+    for name in ('f_Phi', 'f_Chi', 'f_Omega', 'f_Ksi'):
+        func = getattr(omgopt, name)
+        assert(func(inj, geom, cubic, gains) == func(inj, geom, grid, gains))
+    rows = np.flatnonzero(omgopt.InsideNerveMask(geom, grid))
+    nerve = cubic[rows]
+    assert(isinstance(nerve, omgopt.Grid) and not nerve.IsFull())
+    assert(nerve.DV == cubic.DV)
+    assert(not isinstance(cubic - geom[2, 0:3], omgopt.Grid))
+    ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+    assert(ws.grid.Spacing == cubic.Spacing and ws.FullGrid.IsFull())
+    tempdir = tempfile.mkdtemp()
+    try:
+        fname = op.join(tempdir, 'grid.header')
+        omgopt.SaveGridHeader(grid, fname)
+        header = omgopt.LoadGridHeader(fname)
+        loaded = omgopt.Grid(grid, **header)
+        assert(loaded.Spacing == cubic.Spacing)
+        assert(loaded.Dimensions == cubic.Dimensions)
+        assert(loaded.Bounds == cubic.Bounds)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def test_grid_files():
+    args = (-1., 1., 5, -1.5, 1., 4, -12., 12., 7)
+    reference = np.resize(omgopt.GenerateMGrid(*args), (5 * 4 * 7, 3))
+    points = omgopt.CubicGridPoints(*args)
+    assert_array_equal(omgopt.GenerateCubicGrid(*args), reference)
+    assert_array_equal(points[[3, 0, 139]], reference[[3, 0, 139]])
+    tempdir = tempfile.mkdtemp()
+    try:
+        # chunks smaller than the grid and not dividing it
+        omgopt.SaveGridFiles(*args, dir=tempdir, name='grid', chunk=17)
+        omgopt.SaveGridFiles(*args, dir=tempdir, name='bin', binary=True,
+                             chunk=17)
+        shifted = dict(dx=omgopt.CreateDGrid(reference, 0),
+                       dy=omgopt.CreateDGrid(reference, 1),
+                       dz=omgopt.CreateDGrid(reference, 2))
+        shifted['-dz'] = omgopt.CreateNegDGrid(reference, 2)
+        shifted[''] = reference
+        for suffix, grid in shifted.items():
+            fname = op.join(tempdir, 'grid' + suffix)
+            assert_array_equal(omgopt.LoadCubicGrid(fname), grid)
+            assert_array_equal(np.load(op.join(tempdir, 'bin' + suffix +
+                                               '.npy')), grid)
+            np.savetxt(fname + '.ref', grid)
+            with open(fname, 'rb') as fid, open(fname + '.ref', 'rb') as ref:
+                assert(fid.read() == ref.read())
+        omgopt.SaveGridVTK(reference, 5, 4, 7, op.join(tempdir, 'ref.vtk'))
+        with open(op.join(tempdir, 'grid.vtk'), 'rb') as fid:
+            streamed = fid.read()
+        with open(op.join(tempdir, 'ref.vtk'), 'rb') as fid:
+            assert(streamed == fid.read().replace(b'ref.vtk', b'grid.vtk'))
+        for fname in ('grid', 'bin.npy'):
+            grid = omgopt.LoadGrid(op.join(tempdir, fname))
+            assert_array_equal(grid, reference)
+            assert(grid.Spacing == omgopt.Grid(reference).Spacing)
+            assert(grid.Dimensions == (5, 4, 7))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def test_fields_vtk():
+    inj, geom, grid, gains = _problem(n=10)
+    tempdir = tempfile.mkdtemp()
+    try:
+        for ext in (None, '.vts'):
+            # chunks smaller than the grid and not dividing it
+            for chunk, prefix in ((37, 'chunk'), (len(grid), 'full')):
+                omgopt.SaveFieldsVTK(inj, geom, grid, gains,
+                                     op.join(tempdir, prefix), ext, chunk)
+            for fname in os.listdir(tempdir):
+                if not fname.startswith('full'):
+                    continue
+                with open(op.join(tempdir, fname), 'rb') as fid:
+                    full = fid.read().replace(b'full', b'chunk')
+                with open(op.join(tempdir, 'chunk' + fname[4:]), 'rb') as fid:
+                    assert(fid.read() == full)
+        assert(op.exists(op.join(tempdir, 'chunk_fields.vts')))
+        assert(op.exists(op.join(tempdir, 'chunk_cur_nerve.vtk')))
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def test_optimization_trace():
+    """The trace records the evaluations of fmin_bfgs at the iterates"""
+    inj, geom, grid, gains = _problem()
+    ws = omgopt.workspace(None, None, grid=grid, gains=gains)
+    ws.Verbose = False
+    ws.UseQuadraticForms = False
+    np.random.seed(0)
+    evaluations = []
+    f = ws.Constrained_f_Ksi
+    ws.Constrained_f_Ksi = lambda x: evaluations.append(1) or f(x)
+    xopt, iterates = ws.OptimizeKsi()
+    trace = ws.LastTrace
+    assert(len(trace) == len(iterates) - 1)
+    assert(trace.FunctionEvaluations == len(evaluations))
+    assert_allclose(trace.Column('Objective'),
+                    [f(x) for x in iterates[1:]], rtol=1e-12)
+    assert_allclose(trace.Column('GradientNorm'),
+                    [np.linalg.norm(ws.Constrained_fprime_Ksi(x))
+                     for x in iterates[1:]], rtol=1e-12)
+    assert((trace.Column('Products') > 0).all())
+    assert_allclose(trace.Column('Time'),
+                    sum(trace.Column(c) for c in ('Products', 'Masks',
+                                                  'Weights', 'Other')))
+    assert(omgopt.ActiveTrace is None)
+    # finite differences: no gradient to record
+    ws.UseGradient = False
+    ws.OptimizeChi()
+    assert(np.isnan(ws.LastTrace.Column('GradientNorm')).all())
+    assert(ws.LastTrace.GradientEvaluations == 0)
+    tempdir = tempfile.mkdtemp()
+    try:
+        trace.SaveJSON(op.join(tempdir, 'trace.json'))
+        with open(op.join(tempdir, 'trace.json')) as fid:
+            saved = json.load(fid)
+        assert(saved['Columns'] == omgopt.OptimizationTrace.Columns)
+        assert(saved['Records'] == trace.Records)
+        ws.LastTrace.SaveCSV(op.join(tempdir, 'trace.csv'))
+        with open(op.join(tempdir, 'trace.csv')) as fid:
+            rows = list(csv.DictReader(fid))
+        assert(len(rows) == len(ws.LastTrace))
+        assert(rows[-1]['GradientNorm'] == '')
+        assert_allclose([float(row['Objective']) for row in rows],
+                        ws.LastTrace.Column('Objective'), rtol=1e-15)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)